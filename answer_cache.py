@@ -0,0 +1,197 @@
+#answer_cache.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from embedding_function import normalize_text
+from ingest_manifest import read_corpus_version
+
+ANSWER_CACHE_PATH = "answer_cache.sqlite3"
+SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+
+class AnswerCache:
+    # Stores answers keyed on the question embedding. A question with the same
+    # normalized text, or with cosine similarity above the threshold to a
+    # stored one, gets the stored answer and sources without an LLM call.
+    # Entries expire after `ttl_seconds`, the least recently used are evicted
+    # beyond `max_entries`, and everything is dropped when populate_database
+    # changes the collection.
+
+    def __init__(self, path=ANSWER_CACHE_PATH, chroma_path="chroma", threshold=SIMILARITY_THRESHOLD,
+                 ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES, clock=time.time):
+        self.chroma_path = chroma_path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                query TEXT NOT NULL UNIQUE,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                sources TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._load()
+
+    def lookup(self, query_text, query_embedding):
+        with self._lock:
+            self._check_corpus_version()
+            now = self.clock()
+            row = self._by_query.get(normalize_text(query_text))
+            if row is None and len(self._ids):
+                query = _unit(query_embedding)
+                if query.shape[0] == self._matrix.shape[1]:
+                    similarities = self._matrix @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        row = self._ids[best]
+
+            entry = self._fetch(row) if row is not None else None
+            if entry is not None and now - entry["created_at"] > self.ttl_seconds:
+                self._delete([row])
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.saved_prompt_tokens += entry["prompt_tokens"]
+            self.saved_completion_tokens += entry["completion_tokens"]
+            self._conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (now, row))
+            self._conn.commit()
+            return {"response": entry["answer"], "sources": entry["sources"]}
+
+    def put(self, query_text, query_embedding, answer, sources, prompt_tokens=0, completion_tokens=0):
+        with self._lock:
+            self._check_corpus_version()
+            now = self.clock()
+            embedding = _unit(query_embedding)
+            query_key = normalize_text(query_text)
+            replaced = query_key in self._by_query
+            cursor = self._conn.execute(
+                """
+                INSERT OR REPLACE INTO answers
+                    (query, embedding, answer, sources, prompt_tokens, completion_tokens, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (query_key, embedding.tobytes(), answer,
+                 json.dumps(sources), prompt_tokens, completion_tokens, now, now),
+            )
+            expired = [row for (row,) in self._conn.execute(
+                "SELECT id FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))]
+            overflow = [row for (row,) in self._conn.execute(
+                "SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?", (self.max_entries,))]
+            self._delete(expired + overflow, commit=False)
+            self._conn.commit()
+
+            if replaced or expired or overflow or self._matrix.shape[1] != embedding.shape[0]:
+                self._load_index()
+            else:
+                # Common case: append to the resident matrix instead of reloading it.
+                self._ids.append(cursor.lastrowid)
+                self._by_query[query_key] = cursor.lastrowid
+                self._matrix = np.vstack([self._matrix, embedding])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_prompt_tokens": self.saved_prompt_tokens,
+            "saved_completion_tokens": self.saved_completion_tokens,
+            "entries": len(self._ids),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+            self._load_index()
+
+    def _load(self):
+        self._corpus_version = read_corpus_version(self.chroma_path)
+        stored = self._conn.execute("SELECT value FROM meta WHERE key = 'corpus_version'").fetchone()
+        if stored is None or stored[0] != self._corpus_version:
+            self._reset_for_version()
+        self._load_index()
+
+    def _check_corpus_version(self):
+        version = read_corpus_version(self.chroma_path)
+        if version != self._corpus_version:
+            self._corpus_version = version
+            self._reset_for_version()
+            self._load_index()
+
+    def _reset_for_version(self):
+        # Answers were built from a different collection; none can be trusted.
+        self._conn.execute("DELETE FROM answers")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('corpus_version', ?)", (self._corpus_version,)
+        )
+        self._conn.commit()
+
+    def _load_index(self):
+        # Keep the normalized question embeddings resident for vectorized lookup.
+        rows = self._conn.execute("SELECT id, query, embedding FROM answers").fetchall()
+        self._ids = [row_id for row_id, _query, _blob in rows]
+        self._by_query = {query: row_id for row_id, query, _blob in rows}
+        if rows:
+            self._matrix = np.vstack([np.frombuffer(blob, dtype=np.float32) for _id, _query, blob in rows])
+        else:
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def _fetch(self, row):
+        found = self._conn.execute(
+            "SELECT answer, sources, prompt_tokens, completion_tokens, created_at FROM answers WHERE id = ?",
+            (row,),
+        ).fetchone()
+        if found is None:
+            return None
+        answer, sources, prompt_tokens, completion_tokens, created_at = found
+        return {
+            "answer": answer,
+            "sources": json.loads(sources),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "created_at": created_at,
+        }
+
+    def _delete(self, rows, commit=True):
+        if not rows:
+            return
+        self._conn.executemany("DELETE FROM answers WHERE id = ?", [(row,) for row in rows])
+        if commit:
+            self._conn.commit()
+            self._load_index()
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -1,17 +1,19 @@
 import streamlit as st
-import json
 import os
-from query_data import query_rag
+from chat_history import append_turn, clear_history, load_history, render_history
+from chat_store import CHAT_STORE_PATH, USERS_JSON_PATH, ChatStore
+from query_client import QueryServiceClient, QueryServiceError
 from dotenv import load_dotenv
-from voice_recorder import record_audio, speech_to_text_whisper
+from warmup import selected, warm_up
 import hashlib
 from cryptography.fernet import Fernet
-import openai
 
 load_dotenv()
 
 
 def check_openai_api_key(api_key):
+    # The openai SDK is slow to import and only needed when registering
+    import openai
     client = openai.OpenAI(api_key=api_key)
     try:
         client.models.list()
@@ -42,83 +44,71 @@ def load_or_generate_key(key_file="encryption_key.key"):
             file.write(key)
         return key
 
-# Load the encryption key
-ENCRYPTION_KEY = load_or_generate_key()
-cipher = Fernet(ENCRYPTION_KEY)
+# Load the encryption key once per server process, when an API key is first encrypted or decrypted
+@st.cache_resource
+def get_cipher():
+    return Fernet(load_or_generate_key())
 
 # Function to hash passwords
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-def load_user_data(file_path):
-    if not os.path.exists(file_path) or os.stat(file_path).st_size == 0:
-        return {}  # Return empty dictionary if the file doesn't exist or is empty
-
-    with open(file_path, "r") as file:
-        try:
-            return json.load(file)
-        except json.JSONDecodeError:
-            # If the file is not a valid JSON, return an empty dictionary
-            return {}
-
-# Function to save users and their messages to a single JSON file
-def save_user_data(users, filename):
-    with open(filename, 'w') as file:
-        json.dump(users, file, indent=4)
-
-# Function to clear messages for a specific user
-def clear_user_messages(username, users):
-    if username in users:
-        users[username]['messages'] = []  # Clear messages for the user
-    return users
-
 # Function to encrypt the API key
 def encrypt_api_key(api_key):
-    return cipher.encrypt(api_key.encode()).decode()
+    return get_cipher().encrypt(api_key.encode()).decode()
 
 # Function to decrypt the API key
 def decrypt_api_key(encrypted_api_key):
-    return cipher.decrypt(encrypted_api_key.encode()).decode()
+    return get_cipher().decrypt(encrypted_api_key.encode()).decode()
 
 # Function to forward messages with a watermark and icon
-def forward_message(user_prompt, assistant_response, recipient, users, sender):
-    if recipient in users:
-        if users[recipient].get("receive_forwarded_messages", True):  # Check preference
-            users[recipient]["messages"].append({
-                "role": "user",
-                "content": f"🔄 [Forwarded from {sender}]: {user_prompt}"  # Icon added
-            })
-            users[recipient]["messages"].append({
-                "role": "assistant",
-                "content": f"🔄 [Forwarded from {sender}]: {assistant_response}"  # Icon added
-            })
-            save_user_data(users, "users_data.json")
-            return True
-        else:
-            return False  # User opted out of receiving forwarded messages
-    return False
+def forward_message(user_prompt, assistant_response, recipient, store, sender):
+    # False if the recipient opted out of receiving forwarded messages
+    return store.forward(sender, recipient, user_prompt, assistant_response)
+
+# Questions go to query_service.py; one connection pool per server process
+@st.cache_resource
+def get_query_client():
+    return QueryServiceClient()
+
+# One chat store per server process; imports users_data.json on first start
+@st.cache_resource
+def get_chat_store():
+    store = ChatStore(CHAT_STORE_PATH)
+    migrated = store.migrate_from_json(USERS_JSON_PATH)
+    if migrated:
+        print(f"📦 Migrated {migrated} users from {USERS_JSON_PATH}")
+    return store
+
+# Voice input loads Whisper and torch on first use; WARMUP=voice loads them in the background at server start
+@st.cache_resource
+def start_warmup():
+    def warm_up_voice():
+        import voice_recorder
+        voice_recorder.warm_up()
+    return warm_up(selected({"voice": warm_up_voice}))
+
+start_warmup()
 
 # Define the Streamlit interface
 st.title(":violet[Hermingarda] - Your PNA Assistant")
 
 # User authentication section
-users_file = "users_data.json"
-users = load_user_data(users_file)
+store = get_chat_store()
 
-# Check if user is logged in from the persisted JSON file
+# Check if user is logged in from the persisted store
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 
 if "username" not in st.session_state:
     st.session_state.username = ""
 
-# Check if any user is logged in from the file, and update session state
-for user, data in users.items():
-    if data.get("logged_in"):
+# Check if any user is logged in from the store, and update session state
+if not st.session_state.logged_in:
+    logged_in_user = store.logged_in_user()
+    if logged_in_user:
         st.session_state.logged_in = True
-        st.session_state.username = user
-        st.session_state.messages = data.get("messages", [])
-        break
+        st.session_state.username = logged_in_user
 
 # Registration and login forms
 if not st.session_state.logged_in:
@@ -131,17 +121,17 @@ if not st.session_state.logged_in:
         login_password = st.text_input("Password", type="password", key="login_password")
 
         if st.button("Login"):
-            if login_username in users and users[login_username]["password"] == hash_password(login_password):
+            login_user = store.get_user(login_username)
+            if login_user and login_user["password"] == hash_password(login_password):
                 st.success(f"Welcome back, {login_username}!")
                 st.session_state.logged_in = True
                 st.session_state.username = login_username
 
-                # Update the logged_in state in the JSON file
-                users[login_username]["logged_in"] = True
-                save_user_data(users, users_file)
+                # Update the logged_in state in the store
+                store.set_logged_in(login_username, True)
 
-                # Load messages for the logged-in user
-                st.session_state.messages = users[login_username].get("messages", [])
+                # Load the latest page of messages for the logged-in user
+                load_history(store, login_username)
 
                 st.rerun()  # Force rerun to hide login/register after successful login
             else:
@@ -155,70 +145,92 @@ if not st.session_state.logged_in:
         register_api_key = st.text_input("API Key", type="password", key="register_api_key")  # API Key input
 
         if st.button("Register"):
-                if register_username in users:
+                if store.get_user(register_username):
                     st.error("Username already exists.")
                 else:
                     # Validate the API key before registering the user
                     if check_openai_api_key(register_api_key):
-                        users[register_username] = {
-                            "password": hash_password(register_password),
-                            "api_key": encrypt_api_key(register_api_key),  # Encrypt the API key
-                            "messages": [],
-                            "receive_forwarded_messages": True,  # Default preference
-                            "logged_in": False  # User is not logged in by default
-                        }
-                        save_user_data(users, users_file)
-                        st.success("Registration successful! You can now log in.")
-                        # Redirect to login (this is optional, depending on your app design)
-                        st.session_state.logged_in = False  # Ensure logged in state is false
-                        st.session_state.username = ""
+                        # create_user fails if another session took the name meanwhile
+                        if store.create_user(
+                            register_username,
+                            hash_password(register_password),
+                            encrypt_api_key(register_api_key),  # Encrypt the API key
+                        ):
+                            st.success("Registration successful! You can now log in.")
+                            # Redirect to login (this is optional, depending on your app design)
+                            st.session_state.logged_in = False  # Ensure logged in state is false
+                            st.session_state.username = ""
+                        else:
+                            st.error("Username already exists.")
                     else:
                         st.error("Invalid API Key. Please check and try again.")
 
 # If logged in, show the chat interface
 if st.session_state.logged_in:
     username = st.session_state.username
+    user = store.get_user(username)
 
-    # Display chat messages in the main area
+    # Display the latest chat messages in the main area; older pages load on demand
     if "messages" not in st.session_state:
-        st.session_state.messages = users[username].get("messages", [])
+        load_history(store, username)
 
-    for idx, message in enumerate(st.session_state.messages):  # Use index for unique keys
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    render_history(store, username)
 
     # Input text box for the query (main area)
     prompt = st.chat_input("Ask a question based on the medical research documents...")
 
     if prompt:
-        st.session_state.messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        # Fetch response using the query_rag function, passing the user prompt
-        response = query_rag(prompt, decrypt_api_key(users[username]["api_key"]))  # Decrypt API key for usage
-        st.session_state.messages.append({"role": "assistant", "content": response})
-
-        with st.chat_message("assistant"):
-            st.markdown(response)
-
-        # Save the updated messages to the JSON file
-        users[username]["messages"] = st.session_state.messages
-        save_user_data(users, users_file)
+        # Stream the response from the query service, passing the user prompt
+        try:
+            sources, deltas = get_query_client().answer_stream(prompt, decrypt_api_key(user["api_key"]),  # Decrypt API key for usage
+                                                               st.session_state.get("shards"))  # None or empty: every specialty
+
+            with st.chat_message("assistant"):
+                st.caption(f"Sources: {', '.join(str(source) for source in sources)}")  # Shown before generation starts
+                response = st.write_stream(deltas)
+        except QueryServiceError as e:
+            st.error(f"Could not get an answer: {e}")
+        else:
+            # Append only the new turn to the store
+            append_turn(store, username, [{"role": "user", "content": prompt},
+                                          {"role": "assistant", "content": response}])
 
     # Sidebar for functionalities
     with st.sidebar:
         # User preferences
         st.subheader("User Preferences")
         receive_forwarded = st.checkbox("Receive Messages",
-                                        value=users[username].get("receive_forwarded_messages"))
-        users[username]["receive_forwarded_messages"] = receive_forwarded
+                                        value=user["receive_forwarded_messages"])
         
         # Save Preferences button
         if st.button("Save Preferences"):
-            save_user_data(users, users_file)  # Save preferences
+            store.set_receive_forwarded_messages(username, receive_forwarded)  # Save preferences
             st.success("Preferences saved successfully!")
 
+        # Restrict questions to some specialties when the corpus has several shards
+        try:
+            shard_names = [shard["name"] for shard in get_query_client().shards()]
+        except QueryServiceError:
+            shard_names = []
+        if len(shard_names) > 1:
+            st.subheader("Specialties")
+            st.multiselect("Search only in:", options=shard_names, key="shards",
+                           help="Leave empty to search every specialty.")
+
+        # Usage summary for this user's API key, as recorded by the query service
+        st.subheader("Usage")
+        try:
+            usage = get_query_client().usage(decrypt_api_key(user["api_key"]))["summary"]
+        except QueryServiceError:
+            st.caption("Usage unavailable: the query service is unreachable.")
+        else:
+            for label, totals in (("Today", usage["today"]), (f"Last {usage['days']} days", usage["period"])):
+                st.caption(f"{label}: {totals['requests']} questions ({totals['cached']} cached), "
+                           f"{totals['prompt_tokens'] + totals['completion_tokens']:,} tokens, ${totals['cost']:.4f}")
+
         # Add a separator line
         st.markdown("---")  # Horizontal line for separation
 
@@ -227,41 +239,45 @@ if st.session_state.logged_in:
             last_user_message = st.session_state.messages[-2]["content"]
             last_assistant_message = st.session_state.messages[-1]["content"]
 
-            recipient = st.selectbox("Forward to:", options=list(users.keys()), key="forward_recipient")
+            recipient = st.selectbox("Forward to:", options=store.usernames(), key="forward_recipient")
             if st.button("Forward", key="forward_button"):  # Unique key
-                if forward_message(last_user_message, last_assistant_message, recipient, users, username):
+                if forward_message(last_user_message, last_assistant_message, recipient, store, username):
                     st.success(f"Message forwarded to {recipient}!")
                 else:
                     st.warning(f"{recipient} has opted out of receiving forwarded messages.")
 
         # Clear chat history button
         if st.button("Clear Chat History"):
-            st.session_state.messages = clear_user_messages(username, users)[username]['messages']
-            save_user_data(users, users_file)
+            store.clear_messages(username)
+            clear_history()
             st.success("Chat history cleared!")
             st.rerun()
 
         # Audio recording option
         if st.button("Record Audio Prompt"):
-            audio_file = record_audio()
-            transcribed_text = speech_to_text_whisper(audio_file)
-            st.session_state.messages.append({"role": "user", "content": transcribed_text})
+            from voice_recorder import record_and_transcribe  # Loaded on first use, see start_warmup
+            transcribed_text = record_and_transcribe()  # Transcribes while recording
 
-            response = query_rag(transcribed_text, decrypt_api_key(users[username]["api_key"]))  # Decrypt API key for usage
-            st.session_state.messages.append({"role": "assistant", "content": response})
-
-            users[username]["messages"] = st.session_state.messages
-            save_user_data(users, users_file)
+            if not (transcribed_text or "").strip():
+                st.warning("No speech detected")  # Nothing to ask; the user can record again
+            else:
+                try:
+                    response = get_query_client().answer(transcribed_text, decrypt_api_key(user["api_key"]),  # Decrypt API key for usage
+                                                         st.session_state.get("shards"))["response"]
+                except QueryServiceError as e:
+                    st.error(f"Could not get an answer: {e}")
+                else:
+                    append_turn(store, username, [{"role": "user", "content": transcribed_text},
+                                                  {"role": "assistant", "content": response}])
 
-            st.rerun()
+                    st.rerun()
 
         # Ensure logout button stays at the bottom
         st.markdown("---")  # Another separator line
         if st.button("Logout"):
-            users[username]["logged_in"] = False  # Update logged_in state
-            save_user_data(users, users_file)  # Save to file
+            store.set_logged_in(username, False)  # Update logged_in state
             st.session_state.logged_in = False
             st.session_state.username = ""
-            st.session_state.messages = []
+            clear_history()
             st.success("Logged out successfully!")
             st.rerun()  # Reload to reset the session
\ No newline at end of file
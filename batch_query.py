@@ -0,0 +1,138 @@
+#batch_query.py
+#
+#   python batch_query.py questions.jsonl API_KEY --output answers.jsonl --concurrency 8
+#
+# Answers a file of questions in one process: JSONL lines or CSV rows with a
+# "question" and an optional "id" (the line or row number otherwise). Every
+# answer is appended to the output as soon as it completes, so an
+# interrupted run picks up where it stopped when started again with the same
+# output; questions that failed are retried.
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_SIZE = 100  # questions per embedding request and vector search
+
+
+def read_questions(path):
+    with open(path, encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [_json_row(path, line_number, line) for line_number, line in enumerate(file, start=1)
+                    if line.strip()]
+    questions = []
+    seen = set()
+    for number, row in enumerate(rows, start=1):
+        # An id of 0 is still an id; CSV leaves a missing one empty.
+        question_id = str(row["id"] if row.get("id") not in (None, "") else number)
+        if question_id in seen:
+            raise ValueError(f"{path}: duplicate question id {question_id}")
+        if not isinstance(row.get("question"), str) or not row["question"].strip():
+            raise ValueError(f"{path}: question {question_id} is empty")
+        seen.add(question_id)
+        questions.append({"id": question_id, "question": row["question"].strip()})
+    return questions
+
+
+def _json_row(path, line_number, line):
+    try:
+        row = json.loads(line)
+    except json.JSONDecodeError as error:
+        raise ValueError(f"{path}:{line_number}: invalid JSON ({error.msg})") from None
+    if not isinstance(row, dict):
+        raise ValueError(f'{path}:{line_number}: expected an object like {{"question": "..."}}, '
+                         f"got {type(row).__name__}")
+    return row
+
+
+def load_completed(output_path):
+    # IDs already answered. Failed answers are dropped from the file, so a
+    # resumed run writes them afresh instead of leaving both versions.
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, encoding="utf-8") as file:
+        # A run killed mid-write leaves a truncated last line.
+        records = []
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    answered = [record for record in records if "error" not in record]
+    if len(answered) != len(records):
+        with open(output_path + ".tmp", "w", encoding="utf-8") as file:
+            for record in answered:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+    return {record["id"] for record in answered}
+
+
+async def run_batch(engine, questions, api_key, output_path, concurrency=BATCH_CONCURRENCY, batch_size=BATCH_SIZE,
+                    k=5):
+    # Returns totals for the questions answered in this run.
+    completed = load_completed(output_path)
+    pending = [question for question in questions if question["id"] not in completed]
+    summary = {"skipped": len(questions) - len(pending), "answered": 0, "cached": 0, "failed": 0,
+               "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+    if summary["skipped"]:
+        print(f"⏭️ {summary['skipped']} questions already answered in {output_path}")
+
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output:
+        for batch_start in range(0, len(pending), batch_size):
+            batch = pending[batch_start:batch_start + batch_size]
+            async for index, result in engine.aquery_batch([question["question"] for question in batch], api_key,
+                                                           k=k, concurrency=concurrency):
+                output.write(json.dumps({**batch[index], **result}, ensure_ascii=False) + "\n")
+                output.flush()
+                if "error" in result:
+                    summary["failed"] += 1
+                    print(f"❌ {batch[index]['id']}: {result['error']}")
+                    continue
+                summary["answered"] += 1
+                summary["cached"] += result["cached"]
+                for key in ("prompt_tokens", "completion_tokens", "cost"):
+                    summary[key] += result.get("usage", {}).get(key, 0)
+            done = batch_start + len(batch)
+            print(f"📦 {done}/{len(pending)} questions in {time.perf_counter() - start:.1f}s "
+                  f"({summary['cached']} cached, {summary['failed']} failed)")
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("questions", help="JSONL or CSV file with a question (and optionally an id) per line.")
+    parser.add_argument("api_key", type=str, help="User's OpenAI API key.")
+    parser.add_argument("--output", required=True, help="JSONL file to append answers to; resumed if it exists.")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help="Maximum completions in flight.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Questions per embedding request and vector search.")
+    parser.add_argument("--k", type=int, default=5, help="Chunks per prompt.")
+    args = parser.parse_args()
+
+    from query_data import create_engine
+
+    questions = read_questions(args.questions)
+    engine = create_engine()
+    engine.report_context = False  # one line per question would bury the progress
+    summary = asyncio.run(run_batch(engine, questions, args.api_key, args.output, args.concurrency,
+                                    args.batch_size, args.k))
+    rate = (summary["answered"] + summary["failed"]) / summary["seconds"] if summary["seconds"] else 0.0
+    print(f"✅ {summary['answered']} answered ({summary['cached']} cached), {summary['failed']} failed, "
+          f"{summary['skipped']} skipped in {summary['seconds']:.1f}s ({rate:.1f} questions/s)")
+    print(f"Tokens: {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion; "
+          f"cost ${summary['cost']:.4f}")
+    if summary["failed"]:
+        print(f"🔁 Run again with the same --output to retry the {summary['failed']} failed questions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Benchmark: chat view rerun time as the stored history grows.
+#
+#   python -m benchmarks.bench_chat_render --sizes 100,1000,10000,50000
+#
+# Runs the chat history block through Streamlit's AppTest, once rendering the
+# whole history with one st.chat_message per message (what app.py did) and
+# once through chat_history.render_history, which renders the latest page.
+# Times are for a rerun of an already-open session.
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from streamlit.testing.v1 import AppTest
+
+from chat_store import ChatStore
+
+ANSWER = "A nitrofurantoína 100 mg de 6/6 horas durante 5 a 7 dias, ou fosfomicina 3 g em dose única. " * 3
+
+
+def render_all(path):
+    from chat_store import ChatStore
+    import streamlit as st
+
+    store = ChatStore(path)
+    if "messages" not in st.session_state:
+        st.session_state.messages = store.all_messages("bench")
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+
+def render_paged(path):
+    from chat_history import load_history, render_history
+    from chat_store import ChatStore
+    import streamlit as st
+
+    store = ChatStore(path)
+    if "messages" not in st.session_state:
+        load_history(store, "bench")
+    render_history(store, "bench")
+
+
+def fill(path, count):
+    store = ChatStore(path)
+    store.create_user("bench", "hash", "key")
+    store.append_messages("bench", [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"[{i}] {ANSWER}"} for i in range(count)
+    ])
+    store.close()
+
+
+def rerun_ms(script, path, reruns):
+    app = AppTest.from_function(script, args=(path,), default_timeout=600)
+    app.run()
+    latencies = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies), len(app.chat_message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--reruns", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9}  {'render all':>12}  {'paged':>12}  {'elements':>9}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "chat.sqlite3")
+            fill(path, size)
+            before, _ = rerun_ms(render_all, path, args.reruns)
+            after, elements = rerun_ms(render_paged, path, args.reruns)
+            print(f"{size:>9}  {before:>9.1f} ms  {after:>9.1f} ms  {elements:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Benchmark: the SQLite chat store vs rewriting users_data.json.
+#
+#   python -m benchmarks.bench_chat_store --users 1000 --messages 10000
+#
+# Fills a store with `users` x `messages`, then times what a chat rerun and a
+# new turn cost: looking up the user, loading the latest history page and
+# appending a question/answer pair. The JSON numbers are what app.py used to
+# pay per rerun (parse everything) and per message (rewrite everything); they
+# are measured at --json-messages per user, since the full size would not fit
+# in memory as Python objects, and grow linearly with total history.
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from chat_store import ChatStore
+
+QUESTION = "Qual é a terapêutica de primeira linha para a cistite não complicada na mulher? "
+ANSWER = "A nitrofurantoína 100 mg de 6/6 horas durante 5 a 7 dias, ou fosfomicina 3 g em dose única. "
+
+
+def message(role, index, size):
+    text = QUESTION if role == "user" else ANSWER
+    return {"role": role, "content": (f"[{index}] " + text * (size // len(text) + 1))[:size]}
+
+
+def history(count, size):
+    return [message("user" if i % 2 == 0 else "assistant", i, size) for i in range(count)]
+
+
+def percentiles(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    return np.percentile(milliseconds, 50), np.percentile(milliseconds, 95)
+
+
+def timed(fn, samples):
+    latencies = []
+    for i in range(samples):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, seconds):
+    p50, p95 = percentiles(seconds)
+    print(f"{name:<28} p50 {p50:9.3f} ms   p95 {p95:9.3f} ms")
+
+
+def bench_store(path, args):
+    store = ChatStore(path)
+    start = time.perf_counter()
+    messages = history(args.messages, args.message_bytes)
+    for user in range(args.users):
+        store.create_user(f"user{user}", "hash", "key")
+        store.append_messages(f"user{user}", messages)
+    print(f"🗄️  Filled {args.users} users x {args.messages} messages in {time.perf_counter() - start:.1f}s "
+          f"({os.path.getsize(path) / 1e6:.0f} MB)")
+    store.close()
+
+    start = time.perf_counter()
+    store = ChatStore(path)
+    print(f"{'open':<28} {(time.perf_counter() - start) * 1000:9.3f} ms")
+
+    rng = random.Random(0)
+    users = [f"user{rng.randrange(args.users)}" for _ in range(args.samples)]
+    report("get_user", timed(lambda i: store.get_user(users[i]), args.samples))
+    report(f"latest {args.page} messages", timed(lambda i: store.messages(users[i], limit=args.page), args.samples))
+    report(f"older {args.page} messages",
+           timed(lambda i: store.messages(users[i], limit=args.page, before=args.messages // 2), args.samples))
+    turn = [message("user", 0, args.message_bytes), message("assistant", 1, args.message_bytes)]
+    report("append turn", timed(lambda i: store.append_messages(users[i], turn), args.samples))
+    store.close()
+
+
+def bench_json(path, args):
+    # What app.py did before the store: parse all users on every rerun and
+    # rewrite the whole file with indent=4 after every message.
+    messages = history(args.json_messages, args.message_bytes)
+    users = {f"user{user}": {"password": "hash", "api_key": "key", "messages": list(messages),
+                             "receive_forwarded_messages": True, "logged_in": False}
+             for user in range(args.users)}
+    with open(path, "w") as file:
+        json.dump(users, file, indent=4)
+    print(f"📄 users_data.json with {args.users} users x {args.json_messages} messages "
+          f"({os.path.getsize(path) / 1e6:.0f} MB)")
+
+    def load(_):
+        with open(path) as file:
+            return json.load(file)
+
+    def save(_):
+        users["user0"]["messages"].extend([message("user", 0, 10), message("assistant", 1, 10)])
+        with open(path, "w") as file:
+            json.dump(users, file, indent=4)
+
+    samples = max(1, args.samples // 20)
+    report("json load (every rerun)", timed(load, samples))
+    report("json save (every message)", timed(save, samples))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10000, help="Messages per user in the store.")
+    parser.add_argument("--json-messages", type=int, default=100, help="Messages per user in the JSON file.")
+    parser.add_argument("--message-bytes", type=int, default=120)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        bench_store(os.path.join(path, "chat.sqlite3"), args)
+        bench_json(os.path.join(path, "users_data.json"), args)
+
+
+if __name__ == "__main__":
+    main()
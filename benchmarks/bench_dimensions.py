@@ -0,0 +1,93 @@
+# Benchmark: searching truncated embeddings and rescoring at full precision.
+#
+#   python -m benchmarks.bench_dimensions --chunks 20000 --dimensions 256,512,1024
+#
+# The corpus is synthetic topic text embedded with MatryoshkaStubEmbeddings
+# (3072 dims, leading dimensions weighted like text-embedding-3), so it runs
+# offline and gives the same numbers every time. Queries are a few words
+# taken from a chunk. Ground truth is exact cosine top-k over the full
+# vectors. "search MB" is the matrix the first pass scans, which has to stay
+# in RAM to be fast; the full vectors are only touched for the candidates.
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_vector_store import percentile
+from benchmarks.stubs import MatryoshkaStubEmbeddings
+from vector_store import NumpyStore
+
+
+def synthetic_corpus(chunks, topics=200, words_per_topic=40, length=40, seed=0):
+    rng = np.random.default_rng(seed)
+    vocabulary = [[f"t{topic}w{word}" for word in range(words_per_topic)] for topic in range(topics)]
+    common = [f"comum{word}" for word in range(300)]
+    texts = []
+    for _ in range(chunks):
+        topic, other = rng.integers(0, topics, 2)
+        words = list(rng.choice(vocabulary[topic], length // 2)) + list(rng.choice(vocabulary[other], length // 4))
+        words += list(rng.choice(common, length - len(words)))
+        texts.append(" ".join(words))
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=20_000)
+    parser.add_argument("--dimensions", default="256,512,1024")
+    parser.add_argument("--rescore-factors", default="1,4,10")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    embeddings = MatryoshkaStubEmbeddings()
+    texts = synthetic_corpus(args.chunks)
+    start = time.perf_counter()
+    vectors = np.concatenate([np.asarray(embeddings.embed_documents(texts[offset:offset + 1000]), dtype=np.float32)
+                              for offset in range(0, len(texts), 1000)])
+    print(f"{args.chunks} chunks x {embeddings.dimensions} dims embedded in {time.perf_counter() - start:.1f}s")
+
+    rng = np.random.default_rng(1)
+    questions = [" ".join(rng.choice(texts[pick].split(), 6, replace=False))
+                 for pick in rng.integers(0, args.chunks, args.queries)]
+    queries = np.asarray(embeddings.embed_documents(questions), dtype=np.float32)
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+
+    ids = [str(i) for i in range(args.chunks)]
+    settings = [(None, None)] + [(int(d), int(f)) for d in args.dimensions.split(",")
+                                 for f in args.rescore_factors.split(",")]
+    print(f"{args.queries} queries, k={args.k}")
+    print(f"{'dims':>6} {'rescore':>8} {'search MB':>10} {'disk MB':>8} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8}")
+
+    with tempfile.TemporaryDirectory() as path:
+        store = NumpyStore(path, "bench")
+        for offset in range(0, args.chunks, store.max_batch_size):
+            batch = slice(offset, offset + store.max_batch_size)
+            store.upsert(ids[batch], vectors[batch].tolist(), ["" for _ in ids[batch]],
+                         [{"id": i} for i in ids[batch]])
+
+        for dimensions, factor in settings:
+            # The first search with a new setting builds that truncated copy once.
+            store = NumpyStore(path, "bench", search_dimensions=dimensions, rescore_factor=factor or 4)
+            store.search([queries[0].tolist()], k=args.k)
+            searched = store._reduced if store._reduced is not None else store._vectors
+            files = [store._path("vectors.f32")] + ([store._reduced_path()] if store._reduced is not None else [])
+            disk = sum(os.path.getsize(file) for file in files)
+
+            latencies = []
+            hits = 0
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                results = store.search([query.tolist()], k=args.k)[0]
+                latencies.append(time.perf_counter() - start)
+                hits += len({int(doc.metadata["id"]) for doc, _ in results} & set(expected.tolist()))
+            print(f"{dimensions or embeddings.dimensions:>6} {factor or '-':>8} {searched.nbytes / 1e6:10.1f} "
+                  f"{disk / 1e6:8.1f} {hits / truth.size:9.3f} {percentile(latencies, 50):8.2f} "
+                  f"{percentile(latencies, 99):8.2f}")
+
+
+if __name__ == "__main__":
+    main()
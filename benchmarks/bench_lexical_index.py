@@ -0,0 +1,76 @@
+# Benchmark: BM25 query latency on array-backed postings.
+#
+#   python -m benchmarks.bench_lexical_index --docs 1000000 --tokens-per-doc 40
+#
+# A synthetic Zipf-distributed corpus is built straight into CompactPostings
+# (going through SQLite would only measure ingestion). Latency is reported
+# per query term, bucketed by how many postings the term has.
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from lexical_index import CompactPostings
+
+
+def build(docs, tokens_per_doc, vocabulary_size, seed=0):
+    rng = np.random.default_rng(seed)
+    terms = (rng.zipf(1.2, size=docs * tokens_per_doc) - 1) % vocabulary_size
+    doc_ids = np.repeat(np.arange(docs, dtype=np.int64), tokens_per_doc)
+
+    # Collapse (term, doc) pairs into term frequencies, sorted by term then doc.
+    keys = terms.astype(np.int64) * docs + doc_ids
+    keys, tfs = np.unique(keys, return_counts=True)
+    posting_terms = keys // docs
+    posting_docs = (keys % docs).astype(np.int32)
+
+    offsets = np.searchsorted(posting_terms, np.arange(vocabulary_size + 1)).astype(np.int64)
+    vocabulary = {f"t{term}": term for term in range(vocabulary_size)}
+    lengths = np.full(docs, tokens_per_doc, dtype=np.float32)
+    return CompactPostings(vocabulary, offsets, posting_docs, tfs.astype(np.uint16), lengths)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=1_000_000)
+    parser.add_argument("--tokens-per-doc", type=int, default=40)
+    parser.add_argument("--vocabulary", type=int, default=200_000)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    postings = build(args.docs, args.tokens_per_doc, args.vocabulary)
+    print(f"built {args.docs} docs, {len(postings.docs)} postings in {time.perf_counter() - start:.1f}s")
+    print(f"postings memory: {(postings.docs.nbytes + postings.tfs.nbytes + postings.norms.nbytes) / 2**20:.0f} MB")
+
+    df = np.diff(postings.offsets)
+    buckets = [(1, 100), (100, 1_000), (1_000, 10_000), (10_000, 100_000), (100_000, None)]
+    for low, high in buckets:
+        mask = (df >= low) if high is None else (df >= low) & (df < high)
+        candidates = np.flatnonzero(mask)[:20]
+        if not len(candidates):
+            continue
+        latencies = []
+        for term in candidates:
+            for _ in range(args.repeats // 10 or 1):
+                begin = time.perf_counter()
+                postings.search([f"t{term}"], k=20)
+                latencies.append((time.perf_counter() - begin) * 1e6)
+        label = f"df {low}-{high or 'max'}"
+        print(f"{label:<18} median {statistics.median(latencies):9.1f} µs/term")
+
+    # A realistic multi-term query mixes rare and mid-frequency terms.
+    query = [f"t{term}" for term in np.flatnonzero((df >= 100) & (df < 5_000))[:4]]
+    latencies = []
+    for _ in range(args.repeats):
+        begin = time.perf_counter()
+        postings.search(query, k=20)
+        latencies.append((time.perf_counter() - begin) * 1e6)
+    print(f"4-term query       median {statistics.median(latencies):9.1f} µs "
+          f"({statistics.median(latencies) / len(query):.1f} µs/term)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Benchmark: serial vs process-pool PDF parsing and splitting.
+#
+#   python -m benchmarks.bench_parallel_ingest --workers 4 --copies 64
+#
+# The PDFs under data/ are copied --copies times into a temp folder so the
+# single guideline in the repo is enough to load every core.
+
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import populate_database
+
+
+def run(sources, workers):
+    start = time.perf_counter()
+    chunk_ids = {}
+    for source, chunks in populate_database.iter_parsed_files(sources, workers):
+        chunk_ids[source] = [chunk.metadata["id"] for chunk in chunks]
+    return time.perf_counter() - start, chunk_ids
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--copies", type=int, default=32)
+    args = parser.parse_args()
+
+    originals = sorted(Path(populate_database.DATA_PATH).glob("**/*.pdf"))
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = []
+        for copy in range(args.copies):
+            for original in originals:
+                target = Path(tmp) / f"{copy}-{original.name}"
+                shutil.copyfile(original, target)
+                sources.append(str(target))
+
+        serial_time, serial_ids = run(sources, workers=1)
+        parallel_time, parallel_ids = run(sources, workers=args.workers)
+
+    assert serial_ids == parallel_ids, "parallel run produced different chunk IDs"
+    chunks = sum(len(ids) for ids in serial_ids.values())
+    peak_worker_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    peak_main_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"{len(sources)} PDFs, {chunks} chunks")
+    print(f"serial:       {serial_time:.2f}s ({len(sources) / serial_time:.1f} files/s)")
+    print(f"{args.workers} workers:    {parallel_time:.2f}s ({len(sources) / parallel_time:.1f} files/s)")
+    print(f"speedup:      {serial_time / parallel_time:.2f}x")
+    print(f"peak RSS:     main {peak_main_mb:.0f} MB, largest worker {peak_worker_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Benchmark: per-query Chroma/OpenAI construction vs a long-lived RagEngine.
+#
+#   python -m benchmarks.bench_query_engine --queries 50 --chunks 2000
+#
+# Embeddings and chat completions are stubbed, so the numbers isolate what the
+# engine saves: re-opening the store and rebuilding HTTP clients per question.
+
+import argparse
+import statistics
+import tempfile
+import time
+
+from langchain_chroma import Chroma
+from langchain_core.prompts import ChatPromptTemplate
+from openai import OpenAI
+
+from benchmarks.stubs import StubChatClient, StubEmbeddings
+from query_data import COLLECTION_NAME, PROMPT_TEMPLATE, RagEngine
+
+QUESTIONS = [
+    "qual é a terapêutica de 1ª linha para a bacteriúria assintomática na grávida?",
+    "quando está indicada a urocultura de controlo?",
+    "fosfomicina 3g dose única",
+    "tratamento da pielonefrite aguda em ambulatório",
+    "cistite recorrente na mulher profilaxia",
+]
+
+
+def build_corpus(path, embeddings, chunks):
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=path)
+    words = "cistite pielonefrite bacteriúria grávida fosfomicina amoxicilina urocultura nitrofurantoína".split()
+    texts = [" ".join(words[(i + j) % len(words)] for j in range(40)) + f" secção {i}" for i in range(chunks)]
+    for start in range(0, chunks, 500):
+        batch = texts[start:start + 500]
+        db.add_texts(batch, metadatas=[{"id": f"bench:{start + i}"} for i in range(len(batch))],
+                     ids=[f"bench:{start + i}" for i in range(len(batch))])
+
+
+def query_per_call(path, embeddings, chat, query_text, api_key):
+    # What query_rag did before the engine: new client, new store, new template.
+    OpenAI(api_key=api_key)
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=path)
+    results = db.similarity_search_with_score(query_text, k=5)
+    context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
+    prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE).format(context=context_text, question=query_text)
+    return chat.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": prompt}])
+
+
+def timed(fn, queries):
+    latencies = []
+    for i in range(queries):
+        start = time.perf_counter()
+        fn(QUESTIONS[i % len(QUESTIONS)])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<10} p50 {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--chunks", type=int, default=2000)
+    args = parser.parse_args()
+
+    embeddings = StubEmbeddings()
+    chat = StubChatClient()
+    api_key = "sk-bench"
+
+    with tempfile.TemporaryDirectory() as path:
+        build_corpus(path, embeddings, args.chunks)
+
+        before = timed(lambda q: query_per_call(path, embeddings, chat, q, api_key), args.queries)
+
+        engine = RagEngine(persist_directory=path, embedding_function=embeddings,
+                           client_factory=lambda api_key: chat)
+        after = timed(lambda q: engine.query(q, api_key), args.queries)
+
+    report("per-call", before)
+    report("engine", after)
+    print(f"speedup    {statistics.median(before) / statistics.median(after):.1f}x (p50)")
+
+
+if __name__ == "__main__":
+    main()
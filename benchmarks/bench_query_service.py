@@ -0,0 +1,82 @@
+# Benchmark: query service throughput as concurrent users grow.
+#
+#   python -m benchmarks.bench_query_service --users 1 2 4 8 16 32 --latency 0.5
+#
+# Starts the service on a local port with stubbed embeddings and a stubbed
+# chat backend that takes `--latency` seconds per completion, then has each
+# user (one API key each) send `--requests` questions back to back over HTTP.
+# Reports answers per second and p50/p95 latency per concurrency level. With
+# the old in-script calls a session could only ever have one question in
+# flight, i.e. 1/latency answers per second per Streamlit thread.
+
+import argparse
+import asyncio
+import contextlib
+import io
+import statistics
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.bench_query_engine import QUESTIONS, build_corpus
+from benchmarks.stubs import AsyncStubChatClient, StubEmbeddings
+from query_data import RagEngine
+from query_service import QueryService, serve
+
+
+async def user(session, url, api_key, requests, latencies, statuses):
+    for i in range(requests):
+        start = time.perf_counter()
+        async with session.post(f"{url}/answer", json={"query": QUESTIONS[i % len(QUESTIONS)]},
+                                headers={"Authorization": f"Bearer {api_key}"}) as response:
+            await response.read()
+            statuses.append(response.status)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def load(service, users, requests):
+    runner = await serve(service, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    latencies, statuses = [], []
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            start = time.perf_counter()
+            await asyncio.gather(*(user(session, url, f"sk-user-{n}", requests, latencies, statuses)
+                                   for n in range(users)))
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+    return latencies, statuses, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=5, help="Questions per user.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per stubbed completion.")
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--max-concurrent", type=int, default=16)
+    args = parser.parse_args()
+
+    embeddings = StubEmbeddings()
+    with tempfile.TemporaryDirectory() as path:
+        build_corpus(path, embeddings, args.chunks)
+        engine = RagEngine(persist_directory=path, embedding_function=embeddings,
+                           async_client_factory=lambda api_key: AsyncStubChatClient(api_key, latency=args.latency))
+
+        print(f"🚦 {args.requests} questions per user, {args.latency * 1000:.0f} ms per completion, "
+              f"{args.max_concurrent} slots")
+        for users in args.users:
+            service = QueryService(engine, max_concurrent=args.max_concurrent, max_queue=max(64, users))
+            with contextlib.redirect_stdout(io.StringIO()):  # per-answer usage lines
+                latencies, statuses, elapsed = asyncio.run(load(service, users, args.requests))
+            latencies.sort()
+            p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+            ok = statuses.count(200)
+            print(f"{users:>3} users   {ok / elapsed:6.1f} answers/s   p50 {statistics.median(latencies):7.0f} ms   "
+                  f"p95 {p95:7.0f} ms   errors {len(statuses) - ok}")
+
+
+if __name__ == "__main__":
+    main()
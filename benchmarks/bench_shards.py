@@ -0,0 +1,79 @@
+# Benchmark: ingest time, query latency and recall as the corpus is split
+# over more shards.
+#
+#   python -m benchmarks.bench_shards --vectors 100000 --shards 1,2,4,8
+#   python -m benchmarks.bench_shards --backend chroma --vectors 20000
+#
+# Vectors are assigned to shards round-robin by a fake source path, as
+# hash:N sharding would. Every search fans out to all shards (per-shard top-k
+# merged by score), so recall against exact top-k should not move; "one
+# shard" is the latency of a query restricted to a single shard. With fewer
+# cores than shards, the fan-out mostly costs thread hand-offs.
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_vector_store import percentile, synthetic
+from shards import ShardedStore
+from vector_store import get_vector_store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--backend", default="numpy", choices=["chroma", "numpy", "numpy-int8"])
+    args = parser.parse_args()
+
+    vectors = synthetic(args.vectors, args.dimensions, clusters=max(10, args.vectors // 1000))
+    rng = np.random.default_rng(1)
+    picks = rng.integers(0, args.vectors, args.queries)
+    queries = vectors[picks] + 0.3 * rng.standard_normal((args.queries, args.dimensions)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+
+    ids = [str(i) for i in range(args.vectors)]
+    print(f"{args.vectors} vectors x {args.dimensions} dims, {args.queries} queries, k={args.k}, "
+          f"{args.backend} backend, {os.cpu_count()} CPUs")
+    print(f"{'shards':>6} {'ingest s':>9} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8} {'one shard p50':>14}")
+
+    for count in [int(value) for value in args.shards.split(",")]:
+        with tempfile.TemporaryDirectory() as path:
+            store = ShardedStore(lambda name: get_vector_store(args.backend, persist_directory=path,
+                                                               collection_name=name),
+                                 [f"shard-{index}" for index in range(count)],
+                                 shard_of=lambda source: source.split("/")[1])
+            metadatas = [{"id": i, "source": f"data/shard-{int(i) % count}/x.pdf"} for i in ids]
+            start = time.perf_counter()
+            for offset in range(0, args.vectors, store.max_batch_size):
+                batch = slice(offset, offset + store.max_batch_size)
+                store.upsert(ids[batch], vectors[batch].tolist(), ["" for _ in ids[batch]], metadatas[batch])
+            ingest = time.perf_counter() - start
+
+            latencies = []
+            single = []
+            hits = 0
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                results = store.search([query.tolist()], k=args.k)[0]
+                latencies.append(time.perf_counter() - start)
+                hits += len({int(doc.metadata["id"]) for doc, _ in results} & set(expected.tolist()))
+
+                start = time.perf_counter()
+                store.search([query.tolist()], k=args.k, shards=["shard-0"])
+                single.append(time.perf_counter() - start)
+
+            recall = hits / (args.queries * args.k)
+            print(f"{count:6d} {ingest:9.1f} {recall:9.3f} {percentile(latencies, 50):8.2f} "
+                  f"{percentile(latencies, 99):8.2f} {percentile(single, 50):14.2f}")
+
+
+if __name__ == "__main__":
+    main()
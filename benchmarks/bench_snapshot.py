@@ -0,0 +1,115 @@
+# Benchmark: size and time-to-first-query of a snapshot file against the
+# Chroma directory it was exported from.
+#
+#   python -m benchmarks.bench_snapshot --vectors 20000
+#
+# Builds a Chroma store of synthetic chunks (vectors from bench_vector_store,
+# ~600 characters of text and the usual metadata each), exports and imports
+# it, then opens each in fresh interpreters: "import" is loading the backend's
+# modules, "first query" is opening the store and answering one search. The
+# OS page cache stays warm between runs, so this is the replica's start-up
+# cost, not disk read time.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_vector_store import synthetic
+from shards import write_shard_names
+from snapshot import SNAPSHOT_FILE, export_snapshot, import_snapshot
+from vector_store import COLLECTION_NAME, get_vector_store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child: the query is a fixed vector so no embedding model is needed.
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from vector_store import get_vector_store
+if {backend!r} == "chroma":
+    import langchain_chroma
+else:
+    import snapshot
+imported = time.perf_counter()
+store = get_vector_store({backend!r}, persist_directory={path!r}, collection_name={name!r})
+results = store.search([[1.0] * {dimensions}], k=5)
+done = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "first_query_ms": (done - imported) * 1000,
+                  "results": len(results[0])}}))
+"""
+
+
+def directory_size(path, exclude=()):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _dirs, names in os.walk(path)
+               for name in names if name not in exclude)
+
+
+def cold_start(backend, path, dimensions, repeats):
+    runs = []
+    for _ in range(repeats):
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE.format(backend=backend, path=path, name=COLLECTION_NAME,
+                                                dimensions=dimensions)],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        )
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return {key: statistics.median(run[key] for run in runs) for key in ("import_ms", "first_query_ms")}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=20_000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    vectors = synthetic(args.vectors, args.dimensions, clusters=max(10, args.vectors // 1000))
+    rng = np.random.default_rng(2)
+    words = np.array(["cistite", "pielonefrite", "fosfomicina", "urocultura", "grávida", "profilaxia",
+                      "bacteriúria", "antibioterapia", "ceftriaxona", "recorrente", "assintomática"])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "chroma")
+        store = get_vector_store("chroma", persist_directory=source)
+        start = time.perf_counter()
+        for offset in range(0, args.vectors, store.max_batch_size):
+            rows = range(offset, min(offset + store.max_batch_size, args.vectors))
+            store.upsert(
+                [f"data/norma{row // 40}.pdf:{row % 40}:0" for row in rows],
+                vectors[rows.start:rows.stop].tolist(),
+                [" ".join(rng.choice(words, 50)) for _ in rows],
+                [{"id": f"data/norma{row // 40}.pdf:{row % 40}:0", "source": f"data/norma{row // 40}.pdf",
+                  "page": row % 40} for row in rows],
+            )
+        write_shard_names(source, [COLLECTION_NAME])
+        print(f"{args.vectors} chunks x {args.dimensions} dims; Chroma built in {time.perf_counter() - start:.1f}s")
+
+        snapshot_path = os.path.join(workdir, "corpus.snap")
+        start = time.perf_counter()
+        export_snapshot(snapshot_path, source, backend="chroma")
+        exported = time.perf_counter() - start
+        replica = os.path.join(workdir, "replica")
+        start = time.perf_counter()
+        import_snapshot(snapshot_path, replica, lexical=False)
+        imported = time.perf_counter() - start
+        print(f"Export {exported:.1f}s, import (checksum and copy) {imported:.1f}s")
+
+        print(f"{'store':<10} {'size MB':>8} {'import ms':>10} {'first query ms':>15} {'total ms':>9}")
+        for backend, path, size in (
+            ("chroma", source, directory_size(source)),
+            ("snapshot", replica, os.path.getsize(os.path.join(replica, SNAPSHOT_FILE))),
+        ):
+            timings = cold_start(backend, path, args.dimensions, args.repeats)
+            print(f"{backend:<10} {size / 1e6:8.1f} {timings['import_ms']:10.0f} {timings['first_query_ms']:15.1f} "
+                  f"{timings['import_ms'] + timings['first_query_ms']:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# Benchmark: cold-start import time of the app and the CLIs.
+#
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup --write-baseline benchmarks/baselines/startup.json
+#   python -m benchmarks.bench_startup --baseline benchmarks/baselines/startup.json
+#
+# Each entry point is imported in a fresh interpreter, --repeats times, and
+# the median import time is reported with the packages that took longest.
+# "app" runs app.py's import statements only, since the script itself needs
+# a Streamlit session. Exits with status 1 when an entry point loads one of
+# the LAZY packages at import time, or when its median grew past the allowed
+# margin over the baseline (timings only compare on the same machine).
+
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ["app", "query_data", "query_service", "query_client", "populate_database", "voice_recorder"]
+# Loaded on first use only: the Whisper/torch stack, audio I/O, the vector
+# store, the OpenAI SDK, the tokenizer, the cross-encoder and the PDF parser.
+LAZY = {"torch", "whisper", "sounddevice", "scipy", "chromadb", "langchain_chroma", "openai", "langchain_openai",
+        "tiktoken", "onnxruntime", "tokenizers", "langchain_community", "langchain_text_splitters", "pypdf"}
+
+# Runs in the child: imports the code and reports what it cost.
+PROBE = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+exec(compile({code!r}, "<startup>", "exec"))
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": sorted(set(sys.modules) - before)}}))
+"""
+
+
+def import_code(entry):
+    if entry != "app":
+        return f"import {entry}"
+    with open(os.path.join(ROOT, "app.py"), encoding="utf-8") as file:
+        source = file.read()
+    return "\n".join(ast.get_source_segment(source, node) for node in ast.parse(source).body
+                     if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def measure_once(entry):
+    # Returns (seconds, {package: self seconds}, loaded modules).
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(code=import_code(entry))],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    loaded = set(report["modules"])
+    packages = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | name", nested names indented.
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, _cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if name in loaded and own.strip().isdigit():
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0.0) + int(own) / 1e6
+    return report["seconds"], packages, loaded
+
+
+def measure(entry, repeats=5):
+    runs = [measure_once(entry) for _ in range(repeats)]
+    seconds = [run[0] for run in runs]
+    packages, loaded = runs[-1][1], runs[-1][2]
+    return {
+        "median_ms": statistics.median(seconds) * 1000,
+        "min_ms": min(seconds) * 1000,
+        "modules": len(loaded),
+        "slowest": {package: round(value * 1000, 1) for package, value in
+                    sorted(packages.items(), key=lambda item: -item[1])[:5]},
+        "lazy_loaded": sorted({name.split(".")[0] for name in loaded} & LAZY),
+    }
+
+
+def compare_to_baseline(results, baseline, max_regression=0.5, min_ms=50.0):
+    # A slowdown counts when it is both relative and larger than `min_ms`,
+    # so small entry points do not fail on noise.
+    regressions = []
+    for entry, result in results.items():
+        if result["lazy_loaded"]:
+            regressions.append(f"{entry} imports {', '.join(result['lazy_loaded'])} at startup")
+        before = baseline.get(entry, {}).get("median_ms")
+        after = result["median_ms"]
+        if before and after > before * (1 + max_regression) and after - before > min_ms:
+            regressions.append(f"{entry} import {before:.0f} ms -> {after:.0f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entry", action="append", choices=ENTRY_POINTS,
+                        help="Entry point to measure; repeat for several (default: all).")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--baseline", help="Compare against this stored result.")
+    parser.add_argument("--write-baseline", help="Store this run as the baseline.")
+    parser.add_argument("--max-regression", type=float, default=0.5,
+                        help="Allowed relative slowdown of the median, e.g. 0.5 for +50%%.")
+    args = parser.parse_args()
+
+    results = {}
+    for entry in args.entry or ENTRY_POINTS:
+        results[entry] = result = measure(entry, args.repeats)
+        slowest = ", ".join(f"{package} {ms:.0f}" for package, ms in result["slowest"].items())
+        print(f"{entry:<18} median {result['median_ms']:7.0f} ms   min {result['min_ms']:7.0f} ms   "
+              f"{result['modules']:5d} modules   slowest: {slowest}")
+
+    if args.write_baseline:
+        os.makedirs(os.path.dirname(args.write_baseline) or ".", exist_ok=True)
+        with open(args.write_baseline, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+        print(f"💾 Wrote {args.write_baseline}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    regressions = compare_to_baseline(results, baseline, args.max_regression)
+    if regressions:
+        for regression in regressions:
+            print(f"❌ {regression}")
+        sys.exit(1)
+    print("✅ No startup regressions" + (" against baseline" if args.baseline else ""))
+
+
+if __name__ == "__main__":
+    main()
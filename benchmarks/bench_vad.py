@@ -0,0 +1,95 @@
+# Benchmark: voice activity detection throughput and memory.
+#
+#   python -m benchmarks.bench_vad --loops 150 --rate 44100
+#
+# Plays the dictation fixture (looped into a long dictation) through a fake
+# input stream, as record_audio would read it, once through the previous
+# list-of-chunks loop with a mean-absolute-value silence check and once
+# through StreamResampler + VoiceActivityDetector. Reports audio seconds
+# processed per wall-clock second, per-block latency, peak Python memory and
+# how much audio each keeps.
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.stubs import FakeInputStream
+from vad import StreamResampler, VoiceActivityDetector
+
+FIXTURE = "benchmarks/datasets/voice/dictation_44k.wav"
+
+
+def legacy(stream, fs, blocks):
+    # What record_audio did before: keep every chunk, then concatenate.
+    audio_data = []
+    for _ in range(blocks):
+        chunk = stream.read(int(fs * 0.2))[0]
+        audio_data.append(chunk)
+        np.abs(chunk).mean() < 0.01
+    return len(np.concatenate(audio_data))
+
+
+def streaming(stream, fs, blocks, block_seconds, latencies):
+    kept = 0
+
+    def on_audio(piece):
+        nonlocal kept
+        kept += len(piece)
+
+    resampler = StreamResampler(fs)
+    # Never stop early, so both paths read the same audio.
+    vad = VoiceActivityDetector(on_audio=on_audio, silence_duration=3600)
+    for _ in range(blocks):
+        chunk = stream.read(int(fs * block_seconds))[0]
+        start = time.perf_counter()
+        vad.process(resampler.process(chunk[:, 0]))
+        latencies.append(time.perf_counter() - start)
+    vad.finish()
+    return kept
+
+
+def measure(fn, make_stream):
+    # Timed and traced in separate runs: tracemalloc slows allocation-heavy code.
+    stream = make_stream()
+    start = time.perf_counter()
+    samples = fn(stream)
+    elapsed = time.perf_counter() - start
+    stream = make_stream()
+    tracemalloc.start()
+    fn(stream)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return samples, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--loops", type=int, default=150, help="Fixture repetitions (4 s each).")
+    parser.add_argument("--rate", type=int, default=44100, help="Device sample rate.")
+    parser.add_argument("--block", type=float, default=0.1, help="Seconds read per block.")
+    args = parser.parse_args()
+
+    def stream():
+        return FakeInputStream(FIXTURE, samplerate=args.rate, loops=args.loops)
+
+    seconds = len(stream().audio) / args.rate
+    print(f"🎙️  {seconds:.0f} s of audio at {args.rate} Hz")
+
+    kept, elapsed, peak = measure(lambda source: legacy(source, args.rate, int(seconds / 0.2)), stream)
+    print(f"{'list + mean(abs)':<18} {seconds / elapsed:8.0f}x realtime   peak {peak / 1e6:7.1f} MB   "
+          f"keeps {kept / args.rate:6.1f} s")
+
+    latencies = []
+    kept, elapsed, peak = measure(
+        lambda source: streaming(source, args.rate, int(seconds / args.block), args.block, latencies), stream)
+    # Only the untraced run's block latencies.
+    p50, p95 = np.percentile(np.asarray(latencies[:len(latencies) // 2]) * 1e6, [50, 95])
+    print(f"{'ring buffer VAD':<18} {seconds / elapsed:8.0f}x realtime   peak {peak / 1e6:7.1f} MB   "
+          f"keeps {kept / 16000:6.1f} s of speech at 16 kHz")
+    print(f"per {args.block * 1000:.0f} ms block: p50 {p50:.0f} µs   p95 {p95:.0f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Benchmark: recall@5 and latency of the vector store backends.
+#
+#   python -m benchmarks.bench_vector_store --vectors 100000 --dimensions 256
+#
+# Vectors are drawn around random cluster centres so neighbourhoods exist;
+# queries are perturbed corpus vectors. Ground truth is exact cosine top-k.
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from vector_store import get_vector_store
+
+
+def synthetic(count, dimensions, clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, count)] + 0.6 * rng.standard_normal((count, dimensions)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def percentile(values, q):
+    return float(np.percentile(np.asarray(values) * 1000, q))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--backends", default="chroma,numpy,numpy-int8")
+    args = parser.parse_args()
+
+    vectors = synthetic(args.vectors, args.dimensions, clusters=max(10, args.vectors // 1000))
+    rng = np.random.default_rng(1)
+    picks = rng.integers(0, args.vectors, args.queries)
+    queries = vectors[picks] + 0.3 * rng.standard_normal((args.queries, args.dimensions)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+
+    ids = [str(i) for i in range(args.vectors)]
+    print(f"{args.vectors} vectors x {args.dimensions} dims, {args.queries} queries, k={args.k}")
+    print(f"{'backend':<12} {'ingest s':>9} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8} {'batched ms/q':>13}")
+
+    for backend in args.backends.split(","):
+        with tempfile.TemporaryDirectory() as path:
+            store = get_vector_store(backend, persist_directory=path)
+            start = time.perf_counter()
+            for offset in range(0, args.vectors, store.max_batch_size):
+                batch = slice(offset, offset + store.max_batch_size)
+                store.upsert(ids[batch], vectors[batch].tolist(), ["" for _ in ids[batch]],
+                             [{"id": i} for i in ids[batch]])
+            ingest = time.perf_counter() - start
+
+            latencies = []
+            hits = 0
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                results = store.search([query.tolist()], k=args.k)[0]
+                latencies.append(time.perf_counter() - start)
+                found = {int(doc.metadata["id"]) for doc, _ in results}
+                hits += len(found & set(expected.tolist()))
+
+            start = time.perf_counter()
+            store.search(queries.tolist(), k=args.k)
+            batched = (time.perf_counter() - start) * 1000 / args.queries
+
+            recall = hits / (args.queries * args.k)
+            print(f"{backend:<12} {ingest:9.1f} {recall:9.3f} {percentile(latencies, 50):8.2f} "
+                  f"{percentile(latencies, 99):8.2f} {batched:13.2f}")
+
+
+if __name__ == "__main__":
+    main()
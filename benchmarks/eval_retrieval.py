@@ -0,0 +1,303 @@
+# Offline retrieval evaluation: recall@k, MRR and nDCG@k over a versioned
+# question set, plus per-stage latency of the query path.
+#
+#   python -m benchmarks.eval_retrieval --k 5 --output results.json
+#   python -m benchmarks.eval_retrieval --baseline benchmarks/baselines/dgs_itu_v1.json
+#   python -m benchmarks.eval_retrieval --write-baseline benchmarks/baselines/dgs_itu_v1.json
+#
+# Embeddings and chat completions are stubbed, so runs are deterministic and
+# need no API key. A chunk counts as relevant when it contains one of the
+# question's evidence snippets, so the labels stay valid when --chunk-size or
+# --chunk-overlap change the chunk IDs. Exits with status 1 when a metric
+# falls below the baseline by more than the allowed margin.
+
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from langchain_core.documents import Document
+
+from benchmarks.stubs import StubChatClient, StubEmbeddings
+from chunker import StructuredChunker
+from lexical_index import LexicalIndex, fold
+from populate_database import CHUNK_OVERLAP, CHUNK_SIZE, calculate_chunk_ids, split_documents
+from query_data import CHAT_MODEL, RagEngine
+from reranker import Reranker, get_scorer
+from vector_store import COLLECTION_NAME, VECTOR_STORE_BACKEND, get_vector_store
+
+DATASETS_PATH = os.path.join(os.path.dirname(__file__), "datasets")
+DEFAULT_DATASET = "dgs_itu_v1"
+STAGES = ["embed_query", "search", "build_prompt", "generate"]
+QUALITY_METRICS = ["recall", "mrr", "ndcg"]
+
+
+def load_dataset(name):
+    # A dataset is a directory with the extracted corpus pages and the
+    # questions; new versions get a new directory so baselines stay comparable.
+    path = os.path.join(DATASETS_PATH, name)
+    with open(os.path.join(path, "pages.jsonl"), encoding="utf-8") as file:
+        pages = [json.loads(line) for line in file if line.strip()]
+    with open(os.path.join(path, "questions.jsonl"), encoding="utf-8") as file:
+        questions = [json.loads(line) for line in file if line.strip()]
+    documents = [
+        Document(page_content=page["text"], metadata={"source": page["source"], "page": page["page"]})
+        for page in pages
+    ]
+    return documents, questions
+
+
+def normalize_evidence(text):
+    # PDF extraction uses U+2010 for hyphens and inserts stray line breaks.
+    return " ".join(fold(text).replace("‐", "-").split())
+
+
+def relevant_chunk_ids(chunks, question):
+    snippets = [normalize_evidence(snippet) for snippet in question["evidence"]]
+    return {
+        chunk.metadata["id"]
+        for chunk in chunks
+        if any(snippet in normalize_evidence(chunk.page_content) for snippet in snippets)
+    }
+
+
+def recall_at_k(ranked, relevant, k):
+    return len(set(ranked[:k]) & relevant) / len(relevant) if relevant else 0.0
+
+
+def reciprocal_rank(ranked, relevant):
+    for rank, chunk_id in enumerate(ranked):
+        if chunk_id in relevant:
+            return 1.0 / (rank + 1)
+    return 0.0
+
+
+def ndcg_at_k(ranked, relevant, k):
+    # Binary relevance.
+    dcg = sum(1.0 / math.log2(rank + 2) for rank, chunk_id in enumerate(ranked[:k]) if chunk_id in relevant)
+    ideal = sum(1.0 / math.log2(rank + 2) for rank in range(min(len(relevant), k)))
+    return dcg / ideal if ideal else 0.0
+
+
+def build_engine(path, chunks, embeddings, backend, hybrid, reranker=None):
+    store = get_vector_store(
+        backend=backend,
+        persist_directory=path,
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+    )
+    ids = [chunk.metadata["id"] for chunk in chunks]
+    texts = [chunk.page_content for chunk in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    store.upsert(ids=ids, embeddings=embeddings.embed_documents(texts), documents=texts, metadatas=metadatas)
+    store.optimize()
+
+    lexical_index = None
+    if hybrid:
+        lexical_index = LexicalIndex(os.path.join(path, "lexical_index.sqlite3"))
+        lexical_index.upsert(ids, texts, metadatas)
+        lexical_index.commit()
+
+    return RagEngine(
+        persist_directory=path,
+        embedding_function=embeddings,
+        client_factory=StubChatClient,
+        lexical_index=lexical_index,
+        backend=backend,
+        report_context=False,
+        reranker=Reranker(get_scorer(reranker)) if reranker else None,
+    )
+
+
+def summarize_latencies(seconds):
+    milliseconds = sorted(value * 1000 for value in seconds)
+    return {
+        "mean_ms": statistics.fmean(milliseconds),
+        "p50_ms": statistics.median(milliseconds),
+        "p95_ms": milliseconds[max(0, math.ceil(len(milliseconds) * 0.95) - 1)],
+    }
+
+
+def evaluate(dataset=DEFAULT_DATASET, k=5, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+             backend=None, hybrid=True, repeats=3, reranker=None, chunker="page"):
+    backend = backend or VECTOR_STORE_BACKEND
+    documents, questions = load_dataset(dataset)
+    if chunker == "structured":
+        chunks = StructuredChunker(chunk_size, chunk_overlap).split_documents(documents)
+    else:
+        chunks = calculate_chunk_ids(split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+    embeddings = StubEmbeddings()
+
+    per_question = []
+    timings = {stage: [] for stage in STAGES + ["total"]}
+    with tempfile.TemporaryDirectory() as path:
+        engine = build_engine(path, chunks, embeddings, backend, hybrid, reranker)
+        client = engine.client("sk-eval")
+
+        for question in questions:
+            relevant = relevant_chunk_ids(chunks, question)
+            for _ in range(repeats):
+                # The same calls RagEngine.query makes, timed one by one.
+                start = time.perf_counter()
+                query_embedding = embeddings.embed_query(question["question"])
+                embedded = time.perf_counter()
+                results = engine.retrieve(question["question"], k=k, query_embedding=query_embedding)
+                searched = time.perf_counter()
+                messages = engine.build_messages(question["question"], results)
+                built = time.perf_counter()
+                client.chat.completions.create(model=CHAT_MODEL, messages=messages)
+                generated = time.perf_counter()
+
+                for stage, seconds in zip(STAGES, [embedded - start, searched - embedded,
+                                                   built - searched, generated - built]):
+                    timings[stage].append(seconds)
+                timings["total"].append(generated - start)
+
+            ranked = [doc.metadata.get("id") for doc, _score in results]
+            per_question.append({
+                "id": question["id"],
+                "retrieved": ranked,
+                "relevant": sorted(relevant),
+                "recall": recall_at_k(ranked, relevant, k),
+                "mrr": reciprocal_rank(ranked, relevant),
+                "ndcg": ndcg_at_k(ranked, relevant, k),
+            })
+        context = engine.context_builder.stats()
+        rerank = engine.reranker.stats() if engine.reranker else None
+
+    return {
+        "config": {
+            "dataset": dataset,
+            "k": k,
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "backend": backend,
+            "hybrid": hybrid,
+            "embeddings": f"stub-{embeddings.dimensions}",
+            # Only present when set, so older baselines still match.
+            **({"reranker": reranker} if reranker else {}),
+            **({"chunker": chunker} if chunker != "page" else {}),
+        },
+        "chunks": len(chunks),
+        "questions": len(questions),
+        "metrics": {
+            metric: statistics.fmean(entry[metric] for entry in per_question) for metric in QUALITY_METRICS
+        },
+        "latency": {stage: summarize_latencies(seconds) for stage, seconds in timings.items()},
+        "context": {
+            "mean_tokens": context["context_tokens"] / context["queries"],
+            "mean_tokens_saved": context["tokens_saved"] / context["queries"],
+        },
+        **({"rerank": rerank} if rerank else {}),
+        "per_question": per_question,
+    }
+
+
+def compare_to_baseline(results, baseline, max_regression=0.02, max_latency_regression=None):
+    # Returns a list of human-readable regressions; empty means the run passes.
+    # Quality is compared in absolute terms, latency as a relative slowdown of
+    # the p50 (off by default: timings only compare on the same machine).
+    regressions = []
+    if results["config"] != baseline["config"]:
+        regressions.append(f"config differs from baseline: {results['config']} vs {baseline['config']}")
+        return regressions
+
+    for metric in QUALITY_METRICS:
+        drop = baseline["metrics"][metric] - results["metrics"][metric]
+        if drop > max_regression:
+            regressions.append(
+                f"{metric} dropped {drop:.3f} "
+                f"({baseline['metrics'][metric]:.3f} -> {results['metrics'][metric]:.3f})"
+            )
+
+    if max_latency_regression is not None:
+        for stage in STAGES + ["total"]:
+            before = baseline["latency"][stage]["p50_ms"]
+            after = results["latency"][stage]["p50_ms"]
+            if before and after > before * (1 + max_latency_regression):
+                regressions.append(f"{stage} p50 {before:.2f} ms -> {after:.2f} ms")
+    return regressions
+
+
+def print_report(results):
+    config = results["config"]
+    print(f"📊 {config['dataset']}: {results['questions']} questions, {results['chunks']} chunks "
+          f"(chunker={config.get('chunker', 'page')}, chunk_size={config['chunk_size']}, "
+          f"overlap={config['chunk_overlap']}, "
+          f"backend={config['backend']}, hybrid={config['hybrid']})")
+    metrics = results["metrics"]
+    print(f"recall@{config['k']} {metrics['recall']:.3f}   MRR {metrics['mrr']:.3f}   "
+          f"nDCG@{config['k']} {metrics['ndcg']:.3f}")
+    for stage, latency in results["latency"].items():
+        print(f"{stage:<13} p50 {latency['p50_ms']:7.3f} ms   p95 {latency['p95_ms']:7.3f} ms")
+    if "context" in results:
+        print(f"context       {results['context']['mean_tokens']:.0f} tokens per query, "
+              f"{results['context']['mean_tokens_saved']:.0f} saved")
+    if "rerank" in results:
+        rerank = results["rerank"]
+        print(f"rerank        p50 {rerank['p50_ms']:7.3f} ms   p95 {rerank['p95_ms']:7.3f} ms   "
+              f"{rerank['cache_hits']}/{rerank['calls']} cached, {rerank['over_budget']} over budget")
+    missed = [entry["id"] for entry in results["per_question"] if not entry["recall"]]
+    if missed:
+        print(f"Missed: {', '.join(missed)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=DEFAULT_DATASET)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--chunker", choices=["page", "structured"], default="page")
+    parser.add_argument("--backend", default=None, help="Vector store backend (default: VECTOR_STORE_BACKEND).")
+    parser.add_argument("--dense-only", action="store_true", help="Disable BM25 fusion.")
+    parser.add_argument("--reranker", choices=["lexical", "cross-encoder"], default=None,
+                        help="Over-fetch and rerank the candidates with this scorer.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per question.")
+    parser.add_argument("--output", help="Write the JSON results here.")
+    parser.add_argument("--baseline", help="Compare against this stored result.")
+    parser.add_argument("--write-baseline", help="Store this run as the baseline.")
+    parser.add_argument("--max-regression", type=float, default=0.02,
+                        help="Allowed absolute drop in recall, MRR or nDCG.")
+    parser.add_argument("--max-latency-regression", type=float, default=None,
+                        help="Allowed relative p50 slowdown per stage, e.g. 0.5 for +50%%.")
+    args = parser.parse_args()
+
+    results = evaluate(
+        dataset=args.dataset,
+        k=args.k,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        backend=args.backend,
+        hybrid=not args.dense_only,
+        repeats=args.repeats,
+        reranker=args.reranker,
+        chunker=args.chunker,
+    )
+    print_report(results)
+
+    for path in [args.output, args.write_baseline]:
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(results, file, indent=2, ensure_ascii=False)
+                file.write("\n")
+            print(f"💾 Wrote {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, args.max_regression, args.max_latency_regression)
+        if regressions:
+            for regression in regressions:
+                print(f"❌ {regression}")
+            sys.exit(1)
+        print("✅ No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# A local stand-in for the OpenAI HTTP API, used by tests and benchmarks.
+#
+# It serves deterministic embeddings and can inject latency and HTTP 429
+# responses, so retry and rate-limit handling can be exercised offline.
+
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def fake_embedding(text, dimensions=64):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeOpenAIServer:
+
+    def __init__(self, latency=0.0, rate_limit_every=0, dimensions=64):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.dimensions = dimensions
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server._lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                    limited = server.rate_limit_every and server.requests % server.rate_limit_every == 0
+                try:
+                    time.sleep(server.latency)
+                    if limited:
+                        with server._lock:
+                            server.rate_limited += 1
+                        self._reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}})
+                    elif self.path.endswith("/embeddings"):
+                        self._reply(200, server._embeddings(body))
+                    else:
+                        self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _embeddings(self, body):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for index, text in enumerate(texts):
+            vector = fake_embedding(str(text), self.dimensions)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text).split()) for text in texts)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
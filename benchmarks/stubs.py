@@ -0,0 +1,181 @@
+# Deterministic, offline stand-ins for the OpenAI embedding and chat backends.
+
+import asyncio
+import hashlib
+import re
+import time
+import unicodedata
+from types import SimpleNamespace
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def fold(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+class StubEmbeddings(Embeddings):
+    # Hashed bag-of-words vectors: texts sharing words land close together,
+    # which is enough for retrieval metrics to mean something offline.
+
+    def __init__(self, dimensions=256, latency=0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token in TOKEN_PATTERN.findall(fold(text)):
+            digest = hashlib.md5(token.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+class MatryoshkaStubEmbeddings(Embeddings):
+    # Like StubEmbeddings, but the hashed bag of words is projected through a
+    # fixed random matrix whose columns shrink with their index, so the
+    # leading dimensions carry most of the signal, as in text-embedding-3.
+
+    def __init__(self, dimensions=3072, buckets=2048, seed=0):
+        self.dimensions = dimensions
+        self.buckets = buckets
+        rng = np.random.default_rng(seed)
+        scales = 1.0 / np.sqrt(1.0 + np.arange(dimensions) / 32.0)
+        self._projection = (rng.standard_normal((buckets, dimensions)) * scales).astype(np.float32)
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        counts = np.zeros((len(texts), self.buckets), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in TOKEN_PATTERN.findall(fold(text)):
+                digest = hashlib.md5(token.encode("utf-8")).digest()
+                counts[row, int.from_bytes(digest[:4], "little") % self.buckets] += 1.0
+        vectors = counts @ self._projection
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (vectors / norms).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def stub_answer(messages):
+    # Echo the first line of context so answers depend on retrieval.
+    prompt = messages[-1]["content"]
+    context = prompt.split("Context:", 1)[-1].strip()
+    return "Resposta: " + context.split("\n", 1)[0][:200]
+
+
+def stub_response(messages, model):
+    content = stub_answer(messages)
+    prompt_tokens = sum(len(message["content"].split()) for message in messages)
+    completion_tokens = len(content.split())
+    return SimpleNamespace(
+        model=model,
+        choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        ),
+    )
+
+
+def stub_stream(messages, model):
+    # Word-by-word deltas, then a final usage-only chunk as with
+    # stream_options={"include_usage": True}.
+    response = stub_response(messages, model)
+    for word in response.choices[0].message.content.split(" "):
+        delta = SimpleNamespace(content=word + " ")
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+    yield SimpleNamespace(choices=[], usage=response.usage)
+
+
+class StubChatClient:
+    # Mimics the `client.chat.completions.create` surface of openai.OpenAI.
+
+    def __init__(self, api_key=None, latency=0.0):
+        self.api_key = api_key
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        if stream:
+            return stub_stream(messages, model)
+        return stub_response(messages, model)
+
+
+class AsyncStubChatClient:
+    # Mimics the `client.chat.completions.create` surface of openai.AsyncOpenAI.
+
+    def __init__(self, api_key=None, latency=0.0):
+        self.api_key = api_key
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if stream:
+            return self._stream(messages, model)
+        return stub_response(messages, model)
+
+    async def _stream(self, messages, model):
+        for chunk in stub_stream(messages, model):
+            yield chunk
+
+
+class FakeInputStream:
+    # Plays a WAV file through the sounddevice.InputStream interface, followed
+    # by a low noise floor, so recorders run from fixtures without a microphone.
+
+    def __init__(self, path, samplerate=None, channels=1, dtype="float32", loops=1, noise=0.002, seed=0):
+        from scipy.io import wavfile
+        from scipy.signal import resample_poly
+
+        rate, audio = wavfile.read(path)
+        audio = audio.astype(np.float32) / 32768 if audio.dtype == np.int16 else audio.astype(np.float32)
+        if samplerate and samplerate != rate:
+            divisor = np.gcd(int(samplerate), int(rate))
+            audio = resample_poly(audio, int(samplerate) // divisor, int(rate) // divisor).astype(np.float32)
+        self.samplerate = samplerate or rate
+        self.channels = channels
+        self.audio = np.tile(audio, loops)
+        self.rng = np.random.default_rng(seed)
+        self.noise = noise
+        self.position = 0
+        self.frames_read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def read(self, frames):
+        chunk = self.audio[self.position:self.position + frames]
+        self.position += len(chunk)
+        if len(chunk) < frames:
+            tail = (self.noise * self.rng.standard_normal(frames - len(chunk))).astype(np.float32)
+            chunk = np.concatenate([chunk, tail])
+        self.frames_read += frames
+        return np.repeat(chunk[:, None], self.channels, axis=1), False
@@ -0,0 +1,70 @@
+#chat_history.py
+
+import functools
+
+import streamlit as st
+
+from chat_store import HISTORY_PAGE_SIZE
+
+ROLE_LABELS = {"user": "🧑 **You**", "assistant": "🤖 **Hermingarda**"}
+
+
+# The chat view keeps a bounded window in session state instead of the whole
+# history: `messages` holds the latest page plus this session's new turns
+# (as {"seq", "role", "content"}), and `older_pages` holds the pages the user
+# asked for with "Load older messages", oldest first. A rerun therefore
+# renders the same number of elements however long the stored history is.
+
+def load_history(store, username, page_size=HISTORY_PAGE_SIZE):
+    st.session_state.messages = store.messages(username, limit=page_size)
+    st.session_state.older_pages = []
+
+
+def clear_history():
+    st.session_state.messages = []
+    st.session_state.older_pages = []
+
+
+def append_turn(store, username, turn):
+    # Persist a user/assistant pair and keep it in the window with its seq.
+    for message, seq in zip(turn, store.append_messages(username, turn)):
+        st.session_state.messages.append({"seq": seq, **message})
+
+
+def first_loaded_seq():
+    if st.session_state.get("older_pages"):
+        return st.session_state.older_pages[0][0][0]
+    for message in st.session_state.get("messages", []):
+        if message.get("seq") is not None:
+            return message["seq"]
+    return None
+
+
+def load_older_page(store, username, page_size=HISTORY_PAGE_SIZE):
+    page = store.messages(username, limit=page_size, before=first_loaded_seq())
+    if page:
+        older_pages = st.session_state.setdefault("older_pages", [])
+        older_pages.insert(0, tuple((message["seq"], message["role"], message["content"]) for message in page))
+
+
+@functools.lru_cache(maxsize=256)
+def page_markdown(page):
+    # An older page is rendered as one markdown block, built once per page.
+    # Being one large, unchanging element it is also served from Streamlit's
+    # forward-message cache on later reruns instead of being re-sent.
+    return "\n\n---\n\n".join(f"{ROLE_LABELS.get(role, role)}\n\n{content}" for _seq, role, content in page)
+
+
+def render_history(store, username, page_size=HISTORY_PAGE_SIZE):
+    first_seq = first_loaded_seq()
+    if first_seq is not None and store.messages(username, limit=1, before=first_seq):
+        st.button("⬆️ Load older messages", key="load_older_messages",
+                  on_click=load_older_page, args=(store, username, page_size))
+
+    for page in st.session_state.get("older_pages", []):
+        with st.expander(f"Messages {page[0][0]}–{page[-1][0]}", expanded=True):
+            st.markdown(page_markdown(page))
+
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
@@ -0,0 +1,198 @@
+#chat_store.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+CHAT_STORE_PATH = "chat_store.sqlite3"
+USERS_JSON_PATH = "users_data.json"
+HISTORY_PAGE_SIZE = 50
+
+
+class ChatStore:
+    # Users, preferences and chat histories in SQLite (WAL), replacing the
+    # users_data.json file that was rewritten in full on every change. Each
+    # write is its own transaction and only touches the rows it changes, so
+    # concurrent sessions no longer overwrite each other. Messages are
+    # clustered by (username, seq), so a page of one user's history is a
+    # single range read no matter how many users or messages there are.
+
+    def __init__(self, path=CHAT_STORE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                api_key TEXT NOT NULL,
+                receive_forwarded_messages INTEGER NOT NULL DEFAULT 1,
+                logged_in INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                username TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (username, seq)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+
+    def get_user(self, username):
+        row = self._conn.execute(
+            "SELECT password, api_key, receive_forwarded_messages, logged_in FROM users WHERE username = ?",
+            (username,),
+        ).fetchone()
+        if row is None:
+            return None
+        password, api_key, receive_forwarded_messages, logged_in = row
+        return {
+            "password": password,
+            "api_key": api_key,
+            "receive_forwarded_messages": bool(receive_forwarded_messages),
+            "logged_in": bool(logged_in),
+        }
+
+    def usernames(self):
+        return [username for (username,) in self._conn.execute("SELECT username FROM users ORDER BY username")]
+
+    def create_user(self, username, password, api_key, receive_forwarded_messages=True):
+        # Returns False if the username is taken.
+        try:
+            with self._transaction():
+                self._conn.execute(
+                    "INSERT INTO users (username, password, api_key, receive_forwarded_messages) "
+                    "VALUES (?, ?, ?, ?)",
+                    (username, password, api_key, int(receive_forwarded_messages)),
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def set_receive_forwarded_messages(self, username, receive):
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE users SET receive_forwarded_messages = ? WHERE username = ?", (int(receive), username)
+            )
+
+    def set_logged_in(self, username, logged_in):
+        with self._transaction():
+            self._conn.execute("UPDATE users SET logged_in = ? WHERE username = ?", (int(logged_in), username))
+
+    def logged_in_user(self):
+        row = self._conn.execute("SELECT username FROM users WHERE logged_in = 1 LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def append_messages(self, username, messages):
+        # Appends [{"role", "content"}] atomically; returns the new seq numbers.
+        with self._transaction():
+            return self._append(username, messages)
+
+    def messages(self, username, limit=HISTORY_PAGE_SIZE, before=None):
+        # One page of history, oldest first: the `limit` messages preceding
+        # seq `before` (or the latest ones). Pass the first seq of a page as
+        # `before` to get the page above it.
+        if before is None:
+            before = 1 << 62
+        rows = self._conn.execute(
+            "SELECT seq, role, content FROM messages WHERE username = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+            (username, before, limit),
+        ).fetchall()
+        return [{"seq": seq, "role": role, "content": content} for seq, role, content in reversed(rows)]
+
+    def all_messages(self, username):
+        rows = self._conn.execute(
+            "SELECT seq, role, content FROM messages WHERE username = ? ORDER BY seq", (username,)
+        )
+        return [{"seq": seq, "role": role, "content": content} for seq, role, content in rows]
+
+    def count_messages(self, username):
+        return self._conn.execute("SELECT COUNT(*) FROM messages WHERE username = ?", (username,)).fetchone()[0]
+
+    def clear_messages(self, username):
+        with self._transaction():
+            self._conn.execute("DELETE FROM messages WHERE username = ?", (username,))
+
+    def forward(self, sender, recipient, user_prompt, assistant_response):
+        # Returns False if the recipient does not exist or opted out.
+        with self._transaction():
+            row = self._conn.execute(
+                "SELECT receive_forwarded_messages FROM users WHERE username = ?", (recipient,)
+            ).fetchone()
+            if not row or not row[0]:
+                return False
+            self._append(recipient, [
+                {"role": "user", "content": f"🔄 [Forwarded from {sender}]: {user_prompt}"},
+                {"role": "assistant", "content": f"🔄 [Forwarded from {sender}]: {assistant_response}"},
+            ])
+            return True
+
+    def migrate_from_json(self, json_path=USERS_JSON_PATH):
+        # One-shot import of the old users_data.json. Runs in one transaction
+        # and is recorded in meta, so restarts do not import it twice.
+        if not os.path.exists(json_path) or os.stat(json_path).st_size == 0:
+            return 0
+        with open(json_path, "r") as file:
+            try:
+                users = json.load(file)
+            except json.JSONDecodeError:
+                users = {}
+        with self._transaction():
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+                return 0
+            migrated = 0
+            for username, data in users.items():
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO users "
+                    "(username, password, api_key, receive_forwarded_messages, logged_in) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (username, data["password"], data["api_key"],
+                     int(data.get("receive_forwarded_messages", True)), int(data.get("logged_in", False))),
+                )
+                if cursor.rowcount:
+                    # Users registered in the store since keep their own history.
+                    self._append(username, data.get("messages", []))
+                    migrated += 1
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (os.path.abspath(json_path),)
+            )
+            return migrated
+
+    def close(self):
+        self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so the read of the
+        # next seq and the insert cannot interleave with another process.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _append(self, username, messages):
+        (last,) = self._conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE username = ?", (username,)
+        ).fetchone()
+        now = time.time()
+        rows = [
+            (username, last + offset + 1, message["role"], message["content"], now)
+            for offset, message in enumerate(messages)
+        ]
+        self._conn.executemany(
+            "INSERT INTO messages (username, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        return [row[1] for row in rows]
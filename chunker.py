@@ -0,0 +1,264 @@
+#chunker.py
+
+import hashlib
+import os
+import re
+from collections import Counter, namedtuple
+
+from langchain_core.documents import Document
+
+from context_builder import get_token_counter
+
+CHUNKER = os.getenv("CHUNKER", "page")  # "page" splits each PDF page on its own, "structured" the whole document
+TABLE_LINE_CHARS = 60   # PyPDF flattens table cells into runs of short lines
+MIN_TABLE_LINES = 3
+HEADING_MAX_CHARS = 100
+PAGE_KEYS = ("page", "page_label")  # per-page PyPDF metadata, replaced by each chunk's own pages
+
+ROMAN_HEADING = re.compile(r"^[IVXLC]+\s*[–—‐-]\s*\S")                 # "III – AVALIAÇÃO"
+NUMBERED_HEADING = re.compile(r"^(\d+(?:\.\d+)+)\.?\s+[A-ZÀ-Ý]")       # "2.1 Tratamento"
+LIST_ITEM = re.compile(r"^(?:[a-z]\)|[ivxlc]+\.|\d{1,2}[.)]|[•·▪◦*‐–-])\s")  # "a)", "iv.", "3.", "•"
+SENTENCE_END = re.compile(r"(?<=[.!?;])\s+(?=[A-ZÀ-Ý0-9(«\"])")
+
+Block = namedtuple("Block", "kind units page page_end level")
+
+
+def normalize_pages(texts):
+    # PDF page texts -> per-page lists of lines with whitespace (including
+    # non-breaking spaces) collapsed and running headers and footers removed:
+    # lines at the top or bottom of most pages that only differ in their
+    # numbers. Empty lines are kept, they separate paragraphs.
+    pages = [[" ".join(line.split()) for line in text.splitlines()] for text in texts]
+    if len(pages) < 2:
+        return pages
+    counts = Counter(mask for lines in pages for mask in {_mask(lines[i]) for i in _edge_indexes(lines)})
+    running = {mask for mask, count in counts.items() if count >= max(2, (len(pages) + 1) // 2)}
+    for lines in pages:
+        for i in sorted(_edge_indexes(lines), reverse=True):
+            if _mask(lines[i]) in running:
+                del lines[i]
+    return pages
+
+
+def parse_blocks(pages):
+    # Normalized page lines -> Blocks: headings, paragraphs (sentences as
+    # units), lists (items as units) and tables (rows as units). Page breaks
+    # do not end a block, only empty lines and changes of kind do.
+    lines = [(page, line) for page, page_lines in enumerate(pages) for line in page_lines]
+    blocks = []
+    current = None  # [kind, units, page, page_end]
+
+    def close():
+        nonlocal current
+        if current:
+            kind, units, page, page_end = current
+            if kind == "paragraph":
+                units = [sentence for sentence in SENTENCE_END.split(units[0]) if sentence]
+            blocks.append(Block(kind, units, page, page_end, 0))
+        current = None
+
+    i = 0
+    previous_blank = True
+    while i < len(lines):
+        page, line = lines[i]
+        if not line:
+            close()
+            previous_blank = True
+            i += 1
+            continue
+
+        level = _heading_level(line, previous_blank)
+        previous_blank = False
+        if level:
+            close()
+            blocks.append(Block("heading", [line], page, page, level))
+        elif LIST_ITEM.match(line):
+            if not current or current[0] != "list":
+                close()
+                current = ["list", [], page, page]
+            current[1].append(line)
+            current[3] = page
+        else:
+            end = i
+            while end < len(lines) and _is_table_row(lines[end][1]):
+                end += 1
+            if end - i >= MIN_TABLE_LINES:
+                close()
+                blocks.append(Block("table", [row for _page, row in lines[i:end]], page, lines[end - 1][0], 0))
+                i = end
+                continue
+            if current and current[0] in ("list", "paragraph"):
+                # Wrapped line of the current item or paragraph.
+                current[1][-1] = _join_lines(current[1][-1], line)
+                current[3] = page
+            else:
+                close()
+                current = ["paragraph", [line], page, page]
+        i += 1
+    close()
+    return blocks
+
+
+class StructuredChunker:
+    # Chunks a whole document instead of page by page, so passages, lists and
+    # tables running over a page break stay together. Every section starts a
+    # new chunk and its heading path goes into the chunk's metadata. Lists
+    # and tables move whole to the next chunk when they do not fit, and are
+    # only split between items or rows when one alone exceeds the chunk size;
+    # paragraphs are split between sentences, with up to `chunk_overlap`
+    # repeated. Sizes count characters, or tokens of `model` with
+    # unit="tokens". IDs are derived from the chunk's text, so a chunk keeps
+    # its ID when text is added or removed before it; its place in the
+    # document is the "chunk_index" metadata field instead.
+
+    def __init__(self, chunk_size, chunk_overlap=0, unit="chars", model="gpt-4o"):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length = len if unit == "chars" else get_token_counter(model)
+
+    def split_documents(self, documents, lines=None):
+        # PyPDF page Documents -> chunk Documents, one document per source.
+        # `lines` are normalize_pages' output when it is already known (e.g.
+        # from parse_cache); only valid with the pages of a single source.
+        by_source = {}
+        for document in documents:
+            by_source.setdefault(document.metadata.get("source"), []).append(document)
+        chunks = []
+        for pages in by_source.values():
+            metadata = {key: value for key, value in pages[0].metadata.items() if key not in PAGE_KEYS}
+            page_numbers = [page.metadata.get("page", index) for index, page in enumerate(pages)]
+            chunks.extend(self.split(lines or normalize_pages([page.page_content for page in pages]),
+                                     metadata, page_numbers))
+        return chunks
+
+    def split(self, pages, metadata=None, page_numbers=None):
+        metadata = metadata or {}
+        chunks = []
+        headings = []  # (level, text) of the enclosing sections
+        pieces = []    # (block, text, length) making up the chunk being built
+        seen = Counter()
+
+        def size():
+            return sum(length for _block, _text, length in pieces) + len(pieces) - 1
+
+        def flush(overlap_block=None):
+            # Emits the chunk; keeps up to chunk_overlap of its tail when the
+            # next chunk carries on with the same block. False when there was
+            # nothing but headings to emit.
+            nonlocal pieces
+            if all(block.kind == "heading" for block, _text, _length in pieces):
+                return False
+            text = _join_pieces(pieces)
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+            seen[digest] += 1
+            chunk_id = f"{metadata.get('source', '')}#{digest}"
+            if seen[digest] > 1:
+                chunk_id += f"-{seen[digest]}"
+            first, last = pieces[0][0], pieces[-1][0]
+            chunks.append(Document(page_content=text, metadata={
+                **metadata,
+                "page": page_numbers[first.page] if page_numbers else first.page,
+                "page_end": page_numbers[last.page_end] if page_numbers else last.page_end,
+                "headings": " > ".join(heading for _level, heading in headings),
+                "chunk_index": len(chunks),
+                "id": chunk_id,
+            }))
+            kept = []
+            if overlap_block is not None:
+                budget = self.chunk_overlap
+                for piece in reversed(pieces):
+                    if piece[0] is not overlap_block or piece[2] > budget:
+                        break
+                    kept.insert(0, piece)
+                    budget -= piece[2] + 1
+            pieces = kept
+            return True
+
+        for block in parse_blocks(pages):
+            if block.kind == "heading":
+                flush()
+                headings = [heading for heading in headings if heading[0] < block.level]
+                headings.append((block.level, block.units[0]))
+                pieces.append((block, block.units[0], self.length(block.units[0])))
+                continue
+
+            units = [(unit, self.length(unit)) for unit in block.units]
+            block_size = sum(length for _unit, length in units) + len(units) - 1
+            if block.kind != "paragraph" and pieces and size() + 1 + block_size > self.chunk_size \
+                    and block_size <= self.chunk_size:
+                flush()  # the list or table fits whole in a chunk of its own
+            for unit, length in units:
+                for text, text_length in self._fit(unit, length):
+                    if pieces and size() + 1 + text_length > self.chunk_size:
+                        if flush(overlap_block=block) and size() + 1 + text_length > self.chunk_size:
+                            pieces = []  # no room for the overlap
+                    pieces.append((block, text, text_length))
+        flush()
+        return chunks
+
+    def _fit(self, unit, length):
+        # A unit longer than a chunk is cut between words.
+        if length <= self.chunk_size:
+            return [(unit, length)]
+        parts, words = [], []
+        for word in unit.split(" "):
+            if words and self.length(" ".join(words + [word])) > self.chunk_size:
+                parts.append(" ".join(words))
+                words = []
+            words.append(word)
+        parts.append(" ".join(words))
+        return [(part, self.length(part)) for part in parts]
+
+
+def _join_pieces(pieces):
+    text = ""
+    previous = None
+    for block, piece, _length in pieces:
+        if previous is None:
+            text = piece
+        else:
+            text += " " + piece if block is previous and block.kind == "paragraph" else "\n" + piece
+        previous = block
+    return text
+
+
+def _join_lines(left, right):
+    # Words hyphenated across lines ("manifestar‐" / "se") are joined as is.
+    if left.endswith(("-", "‐")):
+        return left + right
+    return left + " " + right
+
+
+def _heading_level(line, previous_blank):
+    if len(line) > HEADING_MAX_CHARS or line[-1] in ".,;:":
+        return 0
+    numbered = NUMBERED_HEADING.match(line)
+    if numbered:
+        return numbered.group(1).count(".") + 1
+    if not _is_upper(line):
+        return 0
+    if ROMAN_HEADING.match(line):
+        return 1
+    # A line in capitals on its own, e.g. "BILHETES DE IDENTIDADE DOS INDICADORES".
+    if previous_blank and ":" not in line and sum(char.isalpha() for char in line) >= 4:
+        return 2
+    return 0
+
+
+def _is_upper(line):
+    return any(char.isalpha() for char in line) and not any(char.islower() for char in line)
+
+
+def _is_table_row(line):
+    return bool(line) and len(line) < TABLE_LINE_CHARS and not LIST_ITEM.match(line) \
+        and not _heading_level(line, False)
+
+
+def _mask(line):
+    return re.sub(r"\d+", "#", line)
+
+
+def _edge_indexes(lines):
+    # The first and last two non-empty lines of a page.
+    filled = [i for i, line in enumerate(lines) if line]
+    return set(filled[:2] + filled[-2:])
@@ -0,0 +1,185 @@
+#context_builder.py
+
+import os
+import re
+from functools import lru_cache
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+DUPLICATE_THRESHOLD = 0.9  # share of a chunk's word trigrams already in the context
+MIN_OVERLAP_CHARS = 16     # shorter matches between neighbours are coincidence
+MAX_OVERLAP_CHARS = 400    # well above split_documents' chunk_overlap
+SEPARATOR = "\n\n---\n\n"
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def approximate_tokens(text):
+    # ~4 characters per token, OpenAI's rule of thumb; used when the
+    # tokenizer files cannot be loaded (e.g. offline).
+    return (len(text) + 3) // 4
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(model="gpt-4o"):
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model)
+    except Exception as e:
+        print(f"⚠️ No tokenizer for {model} ({e.__class__.__name__}), approximating token counts")
+        return approximate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def parse_chunk_id(chunk_id):
+    # "data/x.pdf:6:2" -> ("data/x.pdf:6", 2); None for IDs without an index.
+    page_id, _, index = (chunk_id or "").rpartition(":")
+    if not page_id or not index.isdigit():
+        return None
+    return page_id, int(index)
+
+
+def chunk_position(metadata):
+    # (group, index) such that consecutive chunks of a group overlap: the
+    # source and chunk_index of whole-document chunks, or the page and index
+    # encoded in page chunks' IDs. None when the position is unknown.
+    if isinstance(metadata.get("chunk_index"), int) and metadata.get("source"):
+        return metadata["source"], metadata["chunk_index"]
+    return parse_chunk_id(metadata.get("id"))
+
+
+def merge_overlap(left, right):
+    # Joins two consecutive chunks, dropping the text the splitter repeated
+    # at the start of `right`. Returns (text, characters dropped).
+    window = max(0, len(left) - MAX_OVERLAP_CHARS)
+    probe = right[:MIN_OVERLAP_CHARS]
+    if len(probe) == MIN_OVERLAP_CHARS:
+        start = left.find(probe, window)
+        while start != -1:
+            # Earliest match first, so the longest overlap wins.
+            if right.startswith(left[start:]):
+                overlap = len(left) - start
+                return left + right[overlap:], overlap
+            start = left.find(probe, start + 1)
+    return left + "\n" + right, 0
+
+
+def shingles(text, n=3):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < n:
+        return {tuple(words)} if words else set()
+    return set(zip(*(words[i:] for i in range(n))))
+
+
+class ContextBuilder:
+    # Turns ranked search results into the prompt context. Consecutive chunks
+    # (see chunk_position) are stitched back together without their repeated
+    # overlap, chunks whose text is already in the context are dropped, and
+    # passages are added in rank order until the token budget is spent.
+    # Keeps running totals of the prompt tokens this saves.
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, count_tokens=None, model="gpt-4o",
+                 duplicate_threshold=DUPLICATE_THRESHOLD):
+        self.token_budget = token_budget
+        self.model = model
+        self.duplicate_threshold = duplicate_threshold
+        self._count_tokens = count_tokens
+        self.queries = 0
+        self.context_tokens = 0
+        self.tokens_saved = 0
+
+    def count_tokens(self, text):
+        if self._count_tokens is None:
+            # Resolved on first use: loading the tokenizer may hit the network.
+            self._count_tokens = get_token_counter(self.model)
+        return self._count_tokens(text)
+
+    def build(self, results):
+        # `results` are (Document, score) pairs, best first. Returns a dict with
+        # the context text, the chunk IDs it contains and token counts.
+        passages = []  # text, page_id, first/last index, sources, shingles, tokens
+        merged = duplicates = over_budget = 0
+        separator_tokens = self.count_tokens(SEPARATOR)
+        used = 0
+
+        for doc, _score in results:
+            text = doc.page_content.strip()
+            chunk_id = doc.metadata.get("id")
+            chunk_shingles = shingles(text)
+            if self._is_duplicate(chunk_shingles, passages):
+                duplicates += 1
+                continue
+
+            position = chunk_position(doc.metadata)
+            neighbour = self._neighbour(passages, position)
+            if neighbour is not None:
+                if position[1] == neighbour["last"] + 1:
+                    joined, _dropped = merge_overlap(neighbour["text"], text)
+                else:
+                    joined, _dropped = merge_overlap(text, neighbour["text"])
+                tokens = self.count_tokens(joined)
+                if used + tokens - neighbour["tokens"] > self.token_budget:
+                    over_budget += 1
+                    continue
+                used += tokens - neighbour["tokens"]
+                neighbour.update(text=joined, tokens=tokens, first=min(neighbour["first"], position[1]),
+                                 last=max(neighbour["last"], position[1]))
+                neighbour["sources"].append(chunk_id)
+                neighbour["shingles"] |= chunk_shingles
+                merged += 1
+                continue
+
+            tokens = self.count_tokens(text)
+            cost = tokens + (separator_tokens if passages else 0)
+            if used + cost > self.token_budget:
+                over_budget += 1
+                continue
+            used += cost
+            passages.append({
+                "text": text,
+                "page_id": position[0] if position else None,
+                "first": position[1] if position else None,
+                "last": position[1] if position else None,
+                "sources": [chunk_id],
+                "shingles": chunk_shingles,
+                "tokens": tokens,
+            })
+
+        context_text = SEPARATOR.join(passage["text"] for passage in passages)
+        naive_tokens = self.count_tokens(SEPARATOR.join(doc.page_content for doc, _score in results))
+        context_tokens = self.count_tokens(context_text)
+        self.queries += 1
+        self.context_tokens += context_tokens
+        self.tokens_saved += naive_tokens - context_tokens
+        return {
+            "text": context_text,
+            "sources": [source for passage in passages for source in passage["sources"]],
+            "tokens": context_tokens,
+            "tokens_saved": naive_tokens - context_tokens,
+            "merged": merged,
+            "duplicates": duplicates,
+            "over_budget": over_budget,
+        }
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "context_tokens": self.context_tokens,
+            "tokens_saved": self.tokens_saved,
+        }
+
+    def _is_duplicate(self, chunk_shingles, passages):
+        if not chunk_shingles:
+            return False
+        for passage in passages:
+            if len(chunk_shingles & passage["shingles"]) >= self.duplicate_threshold * len(chunk_shingles):
+                return True
+        return False
+
+    def _neighbour(self, passages, position):
+        # The passage this chunk directly precedes or follows in its page or document.
+        if position is None:
+            return None
+        page_id, index = position
+        for passage in passages:
+            if passage["page_id"] == page_id and index in (passage["first"] - 1, passage["last"] + 1):
+                return passage
+        return None
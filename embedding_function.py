@@ -1,8 +1,232 @@
-from langchain_openai import OpenAIEmbeddings
-
-def get_embedding_function():
-    
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-large"
-    )
-    return embeddings
\ No newline at end of file
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite3"
+EMBEDDING_CONTEXT_TOKENS = 8191  # the most tokens the embeddings endpoint takes per input
+
+
+def normalize_text(text: str):
+    # Texts that only differ in unicode form or whitespace share one vector.
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def embedding_key(model: str, text: str):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+def embed_documents_with_usage(embedding_function, texts):
+    # (vectors, tokens billed); backends that do not report usage count 0.
+    method = getattr(embedding_function, "embed_documents_with_usage", None)
+    if method is None:
+        return embedding_function.embed_documents(texts), 0
+    return method(texts)
+
+
+def embed_query_with_usage(embedding_function, text):
+    method = getattr(embedding_function, "embed_query_with_usage", None)
+    if method is None:
+        return embedding_function.embed_query(text), 0
+    return method(text)
+
+
+def split_to_fit(text, count_tokens, max_tokens):
+    # Halves a text between words until every piece fits the model's context.
+    if count_tokens(text) <= max_tokens or len(text) < 2:
+        return [text]
+    words = text.split(" ")
+    if len(words) > 1:
+        halves = [" ".join(words[:len(words) // 2]), " ".join(words[len(words) // 2:])]
+    else:
+        halves = [text[:len(text) // 2], text[len(text) // 2:]]
+    return [piece for half in halves for piece in split_to_fit(half, count_tokens, max_tokens)]
+
+
+class UsageTrackingOpenAIEmbeddings(Embeddings):
+    # Calls the embeddings endpoint with the openai SDK directly, as
+    # langchain_openai's OpenAIEmbeddings drops the token usage of each
+    # response. Like it, texts over the model's context are embedded in
+    # pieces and get the token-weighted average of the pieces' vectors.
+
+    def __init__(self, client, model=EMBEDDING_MODEL, batch_size=1000, max_tokens=EMBEDDING_CONTEXT_TOKENS,
+                 count_tokens=None):
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self._count_tokens = count_tokens
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_documents_with_usage(texts)[0]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents_with_usage([text])[0][0]
+
+    def embed_documents_with_usage(self, texts):
+        pieces, owners = [], []
+        for index, text in enumerate(texts):
+            for piece in split_to_fit(text, self.count_tokens, self.max_tokens):
+                pieces.append(piece)
+                owners.append(index)
+        vectors, tokens = [], 0
+        for start in range(0, len(pieces), self.batch_size):
+            response = self.client.embeddings.create(model=self.model, input=pieces[start:start + self.batch_size])
+            vectors += [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            tokens += response.usage.prompt_tokens
+        if len(pieces) == len(texts):
+            return vectors, tokens
+
+        grouped = [[] for _ in texts]
+        for owner, piece, vector in zip(owners, pieces, vectors):
+            grouped[owner].append((piece, vector))
+        combined = []
+        for group in grouped:
+            if len(group) == 1:
+                combined.append(group[0][1])
+                continue
+            average = np.average([vector for _piece, vector in group], axis=0,
+                                 weights=[self.count_tokens(piece) for piece, _vector in group])
+            combined.append((average / np.linalg.norm(average)).tolist())
+        return combined, tokens
+
+    def embed_query_with_usage(self, text):
+        vectors, tokens = self.embed_documents_with_usage([text])
+        return vectors[0], tokens
+
+    def count_tokens(self, text):
+        if self._count_tokens is None:
+            # Resolved on first use: loading the tokenizer may hit the network.
+            from context_builder import get_token_counter
+            self._count_tokens = get_token_counter(self.model)
+        return self._count_tokens(text)
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps any Embeddings backend with a persistent, content-addressed vector
+    # cache (SQLite on disk, bounded LRU in memory).
+
+    def __init__(self, underlying: Embeddings, model: str, cache_path=EMBEDDING_CACHE_PATH,
+                 max_memory_items=10000):
+        self.underlying = underlying
+        self.model = model
+        self.max_memory_items = max_memory_items
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_documents_with_usage(texts)[0]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_query_with_usage(text)[0]
+
+    def embed_documents_with_usage(self, texts):
+        # Cache hits cost nothing, so only the misses' tokens are reported.
+        return self._embed(texts, lambda missing: embed_documents_with_usage(self.underlying, missing))
+
+    def embed_query_with_usage(self, text):
+        def embed_missing(missing):
+            vector, tokens = embed_query_with_usage(self.underlying, missing[0])
+            return [vector], tokens
+
+        vectors, tokens = self._embed([text], embed_missing)
+        return vectors[0], tokens
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _embed(self, texts, embed_missing):
+        keys = [embedding_key(self.model, text) for text in texts]
+        found = self._lookup(keys)
+
+        # Embed each distinct missing text only once.
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        tokens = 0
+        if missing:
+            vectors, tokens = embed_missing(list(missing.values()))
+            # Round through float32 so fresh and cached vectors are identical.
+            new_items = {
+                key: np.asarray(vector, dtype=np.float32).tolist()
+                for key, vector in zip(missing.keys(), vectors)
+            }
+            self._store(new_items)
+            found.update(new_items)
+
+        return [list(found[key]) for key in keys], tokens
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+
+            pending = [key for key in set(keys) if key not in found]
+            # Stay under SQLite's bound-parameter limit.
+            for start in range(0, len(pending), 500):
+                batch = pending[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+        return found
+
+    def _store(self, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes())
+                 for key, vector in items.items()],
+            )
+            self._conn.commit()
+            for key, vector in items.items():
+                self._remember(key, vector)
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+
+def get_embedding_function(cache_path=EMBEDDING_CACHE_PATH, max_retries=None):
+    # The openai SDK is slow to load. Like langchain_openai, the client reads
+    # OPENAI_API_KEY from the environment. `max_retries` overrides the SDK's
+    # own retries, e.g. 0 where EmbeddingWriter already backs off and retries.
+    from openai import OpenAI
+
+    client = OpenAI() if max_retries is None else OpenAI(max_retries=max_retries)
+    embeddings = UsageTrackingOpenAIEmbeddings(client, model=EMBEDDING_MODEL)
+    return CachedEmbeddings(embeddings, model=EMBEDDING_MODEL, cache_path=cache_path)
@@ -0,0 +1,173 @@
+#embedding_writer.py
+
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from langchain_core.documents import Document
+
+from embedding_function import embed_documents_with_usage
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits, server errors.
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (TimeoutError, ConnectionError)
+# The openai SDK's transient errors. Looked up rather than imported, as the
+# SDK is slow to load: an openai error can only be raised once it is loaded.
+RETRYABLE_OPENAI_ERRORS = ("RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError")
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    openai = sys.modules.get("openai")
+    if openai and isinstance(error, tuple(getattr(openai, name) for name in RETRYABLE_OPENAI_ERRORS)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+class TokenBucket:
+    # Allows `rate` acquisitions per second on average, with bursts up to `capacity`.
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def call_with_backoff(fn, max_retries=6, base_delay=0.5, max_delay=30.0, before_attempt=None):
+    # Exponential backoff with full jitter on retryable errors only.
+    for attempt in range(max_retries + 1):
+        if before_attempt:
+            before_attempt()
+        try:
+            return fn()
+        except Exception as error:
+            if attempt == max_retries or not is_retryable(error):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            print(f"⚠️ Embedding request failed ({error.__class__.__name__}), retrying in {delay:.1f}s")
+            time.sleep(random.uniform(0, delay))
+
+
+class EmbeddingWriter:
+    # Embeds chunks in batches on a thread pool and writes each batch to the
+    # vector store as soon as its vectors arrive. Chunks from several files
+    # share batches; every file gets `on_commit` per written batch (used for
+    # checkpointing) and `on_done` once all of its chunks are stored.
+    # `embedding_tokens` adds up the tokens billed for the written batches.
+
+    def __init__(self, upsert, embedding_function, batch_size=64, max_in_flight=4,
+                 requests_per_second=None, max_retries=6, retry_base_delay=0.5, metrics=None):
+        self.upsert = upsert
+        self.embedding_function = embedding_function
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.metrics = metrics
+        self.batches_written = 0
+        self.embedding_tokens = 0
+        self._buffer = []
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def add(self, chunks: list[Document], on_commit=None, on_done=None):
+        group = {"remaining": len(chunks), "on_commit": on_commit, "on_done": on_done}
+        if not chunks:
+            if on_done:
+                on_done()
+            return
+
+        for chunk in chunks:
+            self._buffer.append((chunk, group))
+            if len(self._buffer) >= self.batch_size:
+                self._dispatch()
+
+    def flush(self):
+        if self._buffer:
+            self._dispatch()
+        while self._pending:
+            self._collect(return_when=FIRST_COMPLETED)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Drop unsent work; committed batches are already checkpointed.
+            self._executor.shutdown(cancel_futures=True)
+
+    def _dispatch(self):
+        batch, self._buffer = self._buffer, []
+        # Bound the number of embedding requests in flight.
+        while len(self._pending) >= self.max_in_flight:
+            self._collect(return_when=FIRST_COMPLETED)
+        future = self._executor.submit(self._embed, [chunk.page_content for chunk, _group in batch])
+        future.batch = batch
+        self._pending.add(future)
+
+    def _embed(self, texts):
+        start = time.perf_counter()
+        embeddings, tokens = call_with_backoff(
+            lambda: embed_documents_with_usage(self.embedding_function, texts),
+            max_retries=self.max_retries,
+            base_delay=self.retry_base_delay,
+            before_attempt=self.bucket.acquire if self.bucket else None,
+        )
+        if self.metrics is not None:
+            self.metrics.observe("ingest_embed", time.perf_counter() - start)
+        return embeddings, tokens
+
+    def _collect(self, return_when):
+        done, self._pending = wait(self._pending, return_when=return_when)
+        for future in done:
+            embeddings, tokens = future.result()
+            self.embedding_tokens += tokens
+            self._write(future.batch, embeddings)
+
+    def _write(self, batch, embeddings):
+        chunks = [chunk for chunk, _group in batch]
+        start = time.perf_counter()
+        self.upsert(
+            ids=[chunk.metadata["id"] for chunk in chunks],
+            embeddings=embeddings,
+            documents=[chunk.page_content for chunk in chunks],
+            metadatas=[chunk.metadata for chunk in chunks],
+        )
+        if self.metrics is not None:
+            self.metrics.observe("ingest_write", time.perf_counter() - start)
+        self.batches_written += 1
+
+        # Report the batch back per file, in the order the files were added.
+        by_group = {}
+        for chunk, group in batch:
+            by_group.setdefault(id(group), (group, []))[1].append(chunk)
+        for group, group_chunks in by_group.values():
+            if group["on_commit"]:
+                group["on_commit"](group_chunks)
+            group["remaining"] -= len(group_chunks)
+            if group["remaining"] == 0 and group["on_done"]:
+                group["on_done"]()
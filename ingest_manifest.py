@@ -0,0 +1,128 @@
+#ingest_manifest.py
+
+import hashlib
+import os
+import sqlite3
+import uuid
+
+MANIFEST_FILE = "ingest_manifest.sqlite3"
+CORPUS_VERSION_FILE = "corpus_version"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_sha256(text: str):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_corpus_version(chroma_path):
+    # Changes whenever populate_database adds, updates or deletes chunks, so
+    # caches built on top of the collection know when to drop their entries.
+    try:
+        with open(os.path.join(chroma_path, CORPUS_VERSION_FILE)) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def bump_corpus_version(chroma_path):
+    write_corpus_version(chroma_path, uuid.uuid4().hex)
+
+
+def write_corpus_version(chroma_path, version):
+    os.makedirs(chroma_path, exist_ok=True)
+    path = os.path.join(chroma_path, CORPUS_VERSION_FILE)
+    with open(path + ".tmp", "w") as file:
+        file.write(version)
+    os.replace(path + ".tmp", path)
+
+
+class IngestManifest:
+    # Records what populate_database has already stored: per-file stat and
+    # content hash, per-chunk content hashes and positions (the chunker's
+    # chunk_index, if any), and the settings the chunks were made with.
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                source TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                chunk_index INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS chunks_by_source ON chunks (source);
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        # Manifests from before chunk positions were recorded.
+        if "chunk_index" not in {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}:
+            self._conn.execute("ALTER TABLE chunks ADD COLUMN chunk_index INTEGER")
+            self._conn.commit()
+
+    def get_file(self, source):
+        return self._conn.execute(
+            "SELECT mtime, size, sha256 FROM files WHERE source = ?", (source,)
+        ).fetchone()
+
+    def sources(self):
+        return {row[0] for row in self._conn.execute("SELECT source FROM files")}
+
+    def chunk_hashes(self, source):
+        return dict(self._conn.execute(
+            "SELECT id, sha256 FROM chunks WHERE source = ?", (source,)
+        ))
+
+    def chunk_indexes(self, source):
+        return dict(self._conn.execute(
+            "SELECT id, chunk_index FROM chunks WHERE source = ?", (source,)
+        ))
+
+    def get_setting(self, name):
+        row = self._conn.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, name, value):
+        self._conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, value))
+
+    def record_file(self, source, mtime, size, sha256):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files (source, mtime, size, sha256) VALUES (?, ?, ?, ?)",
+            (source, mtime, size, sha256),
+        )
+
+    def record_chunks(self, source, hashes, indexes=None):
+        indexes = indexes or {}
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO chunks (id, source, sha256, chunk_index) VALUES (?, ?, ?, ?)",
+            [(chunk_id, source, sha256, indexes.get(chunk_id)) for chunk_id, sha256 in hashes.items()],
+        )
+
+    def delete_chunks(self, ids):
+        self._conn.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in ids])
+
+    def remove_file(self, source):
+        self._conn.execute("DELETE FROM files WHERE source = ?", (source,))
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,285 @@
+#lexical_index.py
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+import numpy as np
+from langchain_core.documents import Document
+
+LEXICAL_INDEX_FILE = "lexical_index.sqlite3"
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Common Portuguese function words, already accent-folded.
+STOPWORDS = frozenset("""
+a ao aos aquela aquelas aquele aqueles aquilo as ate com como da das de dela delas dele deles
+depois do dos e ela elas ele eles em entre era essa essas esse esses esta estas este estes eu foi
+ha isso isto ja lhe lhes mais mas me mesmo meu meus minha minhas muito na nao nas nem no nos
+nossa nossas nosso nossos num numa o os ou para pela pelas pelo pelos por qual quando que quem
+se sem ser seu seus so sua suas tambem te tem teu tua um uma umas uns voce voces
+""".split())
+
+
+def fold(text: str):
+    # Lowercase and strip accents: "Infeções" -> "infecoes".
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text: str):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(fold(text)):
+        if token in STOPWORDS:
+            continue
+        # Fold simple plurals ("gravidas" -> "gravida") but leave short
+        # acronyms and doses such as "dgs" or "3g" untouched.
+        if len(token) > 4 and token.endswith("s") and token.isalpha():
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class CompactPostings:
+    # Immutable, array-backed postings: the postings of term `t` live in
+    # docs[offsets[t]:offsets[t + 1]] with matching term frequencies. The BM25
+    # length normalisation is precomputed per posting, so scoring a term is a
+    # handful of vectorized operations over one contiguous slice.
+
+    def __init__(self, vocabulary, offsets, docs, tfs, doc_lengths):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs.astype(np.float32)
+        self.doc_count = len(doc_lengths)
+        average_length = float(doc_lengths.mean()) if self.doc_count else 0.0
+        lengths = doc_lengths[docs].astype(np.float32)
+        self.norms = K1 * (1 - B + B * lengths / max(average_length, 1.0))
+        document_frequency = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((self.doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+        self._local = threading.local()
+
+    @classmethod
+    def from_rows(cls, rows, doc_count, doc_lengths):
+        # `rows` are (term, doc, tf) sorted by term.
+        vocabulary = {}
+        offsets = [0]
+        docs = []
+        tfs = []
+        for term, doc, tf in rows:
+            if term not in vocabulary:
+                if vocabulary:
+                    offsets.append(len(docs))
+                vocabulary[term] = len(vocabulary)
+            docs.append(doc)
+            tfs.append(tf)
+        offsets.append(len(docs))
+        if not vocabulary:
+            offsets = [0]
+        return cls(
+            vocabulary,
+            np.asarray(offsets, dtype=np.int64),
+            np.asarray(docs, dtype=np.int32),
+            np.asarray(tfs, dtype=np.uint16),
+            np.asarray(doc_lengths, dtype=np.float32).reshape(doc_count),
+        )
+
+    def search(self, terms, k=5):
+        # Returns (doc indices, scores), best first. Work is proportional to
+        # the postings of the query terms, not to the number of documents.
+        term_ids = [self.vocabulary[term] for term in set(terms) if term in self.vocabulary]
+        if not term_ids:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+
+        if len(term_ids) == 1:
+            candidates, candidate_scores = self._score_term(term_ids[0])
+        else:
+            # Accumulate in a per-thread dense buffer and zero only what was touched.
+            scores = self._scratch()
+            touched = []
+            for term_id in term_ids:
+                docs, term_scores = self._score_term(term_id)
+                # Each doc appears once per term, so fancy-index += is safe.
+                scores[docs] += term_scores
+                touched.append(docs)
+            touched = np.concatenate(touched)
+            touched_scores = scores[touched]
+            # A doc appears at most once per term, so the best k * terms
+            # entries hold the best k distinct docs.
+            keep = min(len(touched), k * len(term_ids))
+            if keep < len(touched):
+                best = np.argpartition(-touched_scores, keep - 1)[:keep]
+                candidates = np.unique(touched[best])
+            else:
+                candidates = np.unique(touched)
+            candidate_scores = scores[candidates]
+            scores[touched] = 0
+
+        if len(candidates) > k:
+            top = np.argpartition(-candidate_scores, k - 1)[:k]
+            candidates, candidate_scores = candidates[top], candidate_scores[top]
+        order = np.argsort(-candidate_scores, kind="stable")
+        return candidates[order], candidate_scores[order]
+
+    def _score_term(self, term_id):
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        tfs = self.tfs[start:end]
+        return self.docs[start:end], self.idf[term_id] * tfs * (K1 + 1) / (tfs + self.norms[start:end])
+
+    def _scratch(self):
+        scores = getattr(self._local, "scores", None)
+        if scores is None:
+            scores = self._local.scores = np.zeros(self.doc_count, dtype=np.float32)
+        return scores
+
+
+class LexicalIndex:
+    # BM25 index over the chunks in Chroma. SQLite holds the postings so
+    # populate_database can update it incrementally; queries run against a
+    # CompactPostings snapshot that is rebuilt when the index version changes.
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                doc INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                length INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                doc INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_by_doc ON postings (doc);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+            """
+        )
+        self._lock = threading.Lock()
+        self._postings = None
+        self._rowids = None
+        self._loaded_version = None
+
+    def upsert(self, ids, texts, metadatas):
+        with self._lock:
+            self._delete(ids)
+            for chunk_id, text, metadata in zip(ids, texts, metadatas):
+                counts = Counter(tokenize(text))
+                cursor = self._conn.execute(
+                    "INSERT INTO docs (id, length, text, metadata) VALUES (?, ?, ?, ?)",
+                    (chunk_id, sum(counts.values()), text, json.dumps(metadata)),
+                )
+                self._conn.executemany(
+                    "INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                    [(term, cursor.lastrowid, min(tf, 65535)) for term, tf in counts.items()],
+                )
+            self._bump_version()
+
+    def delete(self, ids):
+        with self._lock:
+            self._delete(ids)
+            self._bump_version()
+
+    def update_metadata(self, ids, metadatas):
+        # The postings are unchanged, so the loaded snapshot stays valid;
+        # searches read metadata from the docs table.
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE docs SET metadata = ? WHERE id = ?",
+                [(json.dumps(metadata), chunk_id) for chunk_id, metadata in zip(ids, metadatas)],
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM docs")
+            self._bump_version()
+
+    def commit(self):
+        self._conn.commit()
+
+    def count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def search(self, query_text: str, k=5):
+        # Returns [(Document, bm25 score)], best first.
+        postings, rowids = self._snapshot()
+        doc_indices, scores = postings.search(tokenize(query_text), k=k)
+        if not len(doc_indices):
+            return []
+
+        wanted = [int(rowids[index]) for index in doc_indices]
+        placeholders = ",".join("?" * len(wanted))
+        # Under the writers' lock; a doc deleted since the snapshot was taken
+        # is simply missing from `rows` and skipped.
+        with self._lock:
+            rows = {
+                doc: (text, metadata)
+                for doc, text, metadata in self._conn.execute(
+                    f"SELECT doc, text, metadata FROM docs WHERE doc IN ({placeholders})", wanted
+                )
+            }
+        return [
+            (Document(page_content=rows[doc][0], metadata=json.loads(rows[doc][1])), float(score))
+            for doc, score in zip(wanted, scores) if doc in rows
+        ]
+
+    def _snapshot(self):
+        with self._lock:
+            version = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            if version != self._loaded_version:
+                self._postings, self._rowids = self._load()
+                self._loaded_version = version
+            return self._postings, self._rowids
+
+    def _load(self):
+        rowids = np.fromiter(
+            (doc for (doc,) in self._conn.execute("SELECT doc FROM docs ORDER BY doc")), dtype=np.int64
+        )
+        lengths = np.fromiter(
+            (length for (length,) in self._conn.execute("SELECT length FROM docs ORDER BY doc")),
+            dtype=np.float32,
+            count=len(rowids),
+        )
+        # Postings store SQLite doc keys; map them to dense positions.
+        positions = {int(doc): position for position, doc in enumerate(rowids)}
+        rows = (
+            (term, positions[doc], tf)
+            for term, doc, tf in self._conn.execute("SELECT term, doc, tf FROM postings ORDER BY term, doc")
+        )
+        return CompactPostings.from_rows(rows, len(rowids), lengths), rowids
+
+    def _delete(self, ids):
+        for chunk_id in ids:
+            row = self._conn.execute("SELECT doc FROM docs WHERE id = ?", (chunk_id,)).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM postings WHERE doc = ?", row)
+                self._conn.execute("DELETE FROM docs WHERE doc = ?", row)
+
+    def _bump_version(self):
+        self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+
+def reciprocal_rank_fusion(result_lists, k=60):
+    # Fuse ranked [(Document, score)] lists by 1 / (k + rank), keyed on chunk ID.
+    fused = {}
+    for results in result_lists:
+        for rank, (doc, _score) in enumerate(results):
+            key = doc.metadata.get("id", doc.page_content)
+            entry = fused.setdefault(key, [doc, 0.0])
+            entry[1] += 1.0 / (k + rank + 1)
+    return sorted(((doc, score) for doc, score in fused.values()), key=lambda item: item[1], reverse=True)
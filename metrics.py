@@ -0,0 +1,273 @@
+#metrics.py
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+METRICS_TRACE_PATH = os.getenv("METRICS_TRACE_PATH", "metrics_trace.jsonl")
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "usage.sqlite3")
+
+# USD per 1M tokens as (input, output), from OpenAI's price list. Dated
+# model IDs ("gpt-4o-2024-08-06") match their family by prefix.
+PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4-turbo": (10.00, 30.00),
+    # Embeddings only bill input.
+    "text-embedding-3-large": (0.13, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+# Upper bounds in seconds, from a cached embedding to a long completion.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def model_price(model, prices=PRICES):
+    # The longest family name `model` starts with; None if unknown.
+    matches = [name for name in prices if model == name or model.startswith(name + "-")]
+    return prices[max(matches, key=len)] if matches else None
+
+
+def usage_cost(model, prompt_tokens, completion_tokens, prices=PRICES):
+    price = model_price(model, prices)
+    if price is None:
+        return 0.0
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+def user_id(api_key):
+    # Usage is keyed per API key, without ever storing the key.
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16] if api_key else None
+
+
+class Metrics:
+    # Per-stage latency histograms, token and cost counters per model, and a
+    # per-user, per-day usage ledger in SQLite. Each traced request adds one
+    # line to a JSONL trace log. `prometheus()` renders the counters in the
+    # Prometheus text format.
+
+    def __init__(self, trace_path=None, usage_path=":memory:", prices=PRICES, clock=time.time):
+        self.trace_path = trace_path
+        self.prices = prices
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+        self._requests = {}    # (kind, status) -> count
+        self._tokens = {}      # (model, "input"/"output") -> count
+        self._cost = {}        # model -> USD
+        self._unpriced = set()
+        self._conn = sqlite3.connect(usage_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                user TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                cached INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                seconds REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user, model)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = [0] * (len(BUCKETS) + 2)
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def trace(self, kind, user=None):
+        return Trace(self, kind, user)
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        if model_price(model, self.prices) is None and model not in self._unpriced:
+            self._unpriced.add(model)
+            print(f"⚠️ No price for model {model}, counting its cost as 0")
+        return usage_cost(model, prompt_tokens, completion_tokens, self.prices)
+
+    def usage(self, user, days=30):
+        # One row per day and model, newest first.
+        since = time.strftime("%Y-%m-%d", time.gmtime(self.clock() - (days - 1) * 86400))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, model, requests, cached, prompt_tokens, completion_tokens, cost, seconds "
+                "FROM usage WHERE user = ? AND day >= ? ORDER BY day DESC, model",
+                (user, since),
+            ).fetchall()
+        columns = ("day", "model", "requests", "cached", "prompt_tokens", "completion_tokens", "cost", "seconds")
+        return [dict(zip(columns, row)) for row in rows]
+
+    def usage_summary(self, user, days=30):
+        # Totals for today and for the last `days` days.
+        today = time.strftime("%Y-%m-%d", time.gmtime(self.clock()))
+        summary = {period: {"requests": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+                   for period in ("today", "period")}
+        for row in self.usage(user, days):
+            for period in ("today", "period") if row["day"] == today else ("period",):
+                for field in summary[period]:
+                    summary[period][field] += row[field]
+        summary["days"] = days
+        return summary
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            lines += ["# HELP rag_stage_seconds Time spent per pipeline stage.",
+                      "# TYPE rag_stage_seconds histogram"]
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {histogram[-1]:.6f}')
+                lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+            lines += ["# HELP rag_requests_total Traced requests by kind and outcome.",
+                      "# TYPE rag_requests_total counter"]
+            for (kind, status), count in sorted(self._requests.items()):
+                lines.append(f'rag_requests_total{{kind="{kind}",status="{status}"}} {count}')
+            lines += ["# HELP rag_tokens_total Tokens sent to and received from each model.",
+                      "# TYPE rag_tokens_total counter"]
+            for (model, direction), count in sorted(self._tokens.items()):
+                lines.append(f'rag_tokens_total{{model="{model}",type="{direction}"}} {count}')
+            lines += ["# HELP rag_cost_usd_total Spend per model, from the price table.",
+                      "# TYPE rag_cost_usd_total counter"]
+            for model, cost in sorted(self._cost.items()):
+                lines.append(f'rag_cost_usd_total{{model="{model}"}} {cost:.6f}')
+        return "\n".join(lines) + "\n"
+
+    def stage_summary(self):
+        # {stage: (count, total seconds)}, for command-line reports.
+        with self._lock:
+            return {stage: (sum(histogram[:-1]), histogram[-1]) for stage, histogram in self._histograms.items()}
+
+    def close(self):
+        self._conn.close()
+
+    def _finish(self, record):
+        model = record.get("model") or ""
+        with self._lock:
+            self._requests[(record["kind"], record["status"])] = self._requests.get(
+                (record["kind"], record["status"]), 0) + 1
+            if record.get("prompt_tokens") or record.get("completion_tokens"):
+                for direction, field in (("input", "prompt_tokens"), ("output", "completion_tokens")):
+                    self._tokens[(model, direction)] = self._tokens.get((model, direction), 0) + record[field]
+                self._cost[model] = self._cost.get(model, 0.0) + record["cost"]
+            if record.get("embedding_tokens"):
+                key = (record["embedding_model"], "input")
+                self._tokens[key] = self._tokens.get(key, 0) + record["embedding_tokens"]
+                self._cost[key[0]] = self._cost.get(key[0], 0.0) + record["embedding_cost"]
+            if self.trace_path:
+                with open(self.trace_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if record["user"] is None:
+                return
+            day = time.strftime("%Y-%m-%d", time.gmtime(record["ts"]))
+            rows = [(day, record["user"], model, 1, int(record.get("cached", False)), record.get("prompt_tokens", 0),
+                     record.get("completion_tokens", 0), record.get("cost", 0.0), record["total_ms"] / 1000)]
+            if record.get("embedding_tokens"):
+                # Its own row, counting tokens and cost but not the request again.
+                rows.append((day, record["user"], record["embedding_model"], 0, 0, record["embedding_tokens"], 0,
+                             record["embedding_cost"], 0.0))
+            self._conn.executemany(
+                "INSERT INTO usage (day, user, model, requests, cached, prompt_tokens, completion_tokens, cost, seconds) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, user, model) DO UPDATE SET requests = requests + excluded.requests, "
+                "cached = cached + excluded.cached, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cost = cost + excluded.cost, seconds = seconds + excluded.seconds",
+                rows,
+            )
+
+
+class Trace:
+    # One request: its stage timings, token usage and outcome. finish()
+    # records it once; later calls are ignored.
+
+    def __init__(self, metrics, kind, user=None):
+        self.metrics = metrics
+        self.record = {"ts": metrics.clock(), "kind": kind, "user": user, "stages": {}}
+        self._start = time.perf_counter()
+        self._finished = False
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.metrics.observe(name, seconds)
+            self.record["stages"][name] = round(self.record["stages"].get(name, 0.0) + seconds * 1000, 3)
+
+    def usage(self, model, prompt_tokens, completion_tokens):
+        # Returns the cost of this call in USD.
+        cost = self.metrics.cost(model, prompt_tokens, completion_tokens)
+        self.record["model"] = model
+        self.record["prompt_tokens"] = self.record.get("prompt_tokens", 0) + prompt_tokens
+        self.record["completion_tokens"] = self.record.get("completion_tokens", 0) + completion_tokens
+        self.record["cost"] = self.record.get("cost", 0.0) + cost
+        return cost
+
+    def embedding_usage(self, model, tokens):
+        # Embedding tokens are kept apart from the completion's, which has its own model.
+        cost = self.metrics.cost(model, tokens, 0)
+        self.record["embedding_model"] = model
+        self.record["embedding_tokens"] = self.record.get("embedding_tokens", 0) + tokens
+        self.record["embedding_cost"] = self.record.get("embedding_cost", 0.0) + cost
+        return cost
+
+    def finish(self, status="ok", **fields):
+        if self._finished:
+            return
+        self._finished = True
+        self.record.update(fields)
+        self.record["status"] = status
+        self.record["total_ms"] = round((time.perf_counter() - self._start) * 1000, 3)
+        self.metrics._finish(self.record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        elif issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            self.finish("cancelled")
+        else:
+            self.finish("error")
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    # The process-wide instance, writing the trace log and usage ledger.
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(trace_path=METRICS_TRACE_PATH, usage_path=USAGE_DB_PATH)
+        return _metrics
@@ -0,0 +1,52 @@
+#parse_cache.py
+
+import json
+import os
+import sqlite3
+
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH", "parse_cache.sqlite3")
+PARSER_VERSION = 1  # bump when chunker.normalize_pages changes, so cached lines are rebuilt
+
+
+class ParseCache:
+    # Parsed PDF pages and their normalized lines, keyed by the file's
+    # content hash, so re-chunking with other settings never re-parses a PDF.
+    # Shared by the ingest worker processes, hence WAL and one short-lived
+    # connection per process.
+
+    def __init__(self, path=PARSE_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS parsed (
+                sha256 TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                pages TEXT NOT NULL,
+                lines TEXT NOT NULL,
+                PRIMARY KEY (sha256, version)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, sha256):
+        # ([{"text", "metadata"}, ...], [[line, ...] per page]) or None.
+        row = self._conn.execute(
+            "SELECT pages, lines FROM parsed WHERE sha256 = ? AND version = ?", (sha256, PARSER_VERSION)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, sha256, pages, lines):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO parsed (sha256, version, pages, lines) VALUES (?, ?, ?, ?)",
+            (sha256, PARSER_VERSION, json.dumps(pages, ensure_ascii=False, default=str),
+             json.dumps(lines, ensure_ascii=False)),
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -1,20 +1,36 @@
 #populate_database.py
 
 import argparse
-from langchain_community.document_loaders import DirectoryLoader
-from embedding_function import get_embedding_function
+import json
 import os
 import shutil
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from itertools import islice
+from pathlib import Path
 from langchain_core.documents import Document
-from langchain_chroma import Chroma
 from dotenv import load_dotenv
+from embedding_function import EMBEDDING_MODEL, get_embedding_function
+from chunker import CHUNKER, StructuredChunker, normalize_pages
+from context_builder import get_token_counter
+from embedding_writer import EmbeddingWriter
+from ingest_manifest import MANIFEST_FILE, IngestManifest, bump_corpus_version, chunk_sha256, file_sha256
+from metrics import Metrics, get_metrics
+from parse_cache import PARSE_CACHE_PATH, ParseCache
+from shards import SHARDING, ShardedLexicalIndex, ShardedStore, read_shard_names, shard_for, write_shard_names
+from vector_store import get_vector_store
 
 load_dotenv()
 
 CHROMA_PATH = "chroma"
 DATA_PATH = "data"
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 80
+CHUNK_UNIT = "chars"
+# The settings chunks were made with before they were recorded in the manifest.
+DEFAULT_CHUNKING = {"chunker": "page", "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP,
+                    "chunk_unit": CHUNK_UNIT}
 
 API_KEY = os.getenv("OPENAI_API_KEY")
 
@@ -23,16 +39,52 @@ def main():
     # Check if the database should be cleared (using the --clear flag).
     parser = argparse.ArgumentParser()
     parser.add_argument("--reset", action="store_true", help="Reset the database.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Parse and split PDFs in this many processes.")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="Chunks per embedding request and vector store write.")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+                        help="Maximum concurrent embedding requests.")
+    parser.add_argument("--requests-per-second", type=float, default=None,
+                        help="Rate limit for embedding requests.")
+    parser.add_argument("--rebuild-lexical", action="store_true",
+                        help="Rebuild the BM25 index from the chunks already in the vector store.")
+    parser.add_argument("--chunker", choices=["page", "structured"], default=CHUNKER,
+                        help="Split each page on its own, or whole documents along their structure.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--chunk-unit", choices=["chars", "tokens"], default=CHUNK_UNIT,
+                        help="What --chunk-size and --chunk-overlap count.")
+    parser.add_argument("--sharding", default=SHARDING,
+                        help='"folder" (a shard per folder under data/), "hash:N" (N shards) or "none".')
+    parser.add_argument("--rebuild-shard", action="append", default=[], metavar="SHARD",
+                        help="Empty this shard and ingest its files again; repeat for several.")
     args = parser.parse_args()
     if args.reset:
         print("✨ Clearing Database")
         clear_database()
-
-    # Create (or update) the data store.
-    documents = load_documents()
-    print (documents[5])
-    chunks = split_documents(documents)
-    add_to_chroma(chunks)
+    unknown = sorted(set(args.rebuild_shard) - set(read_shard_names(CHROMA_PATH)))
+    if unknown:
+        parser.error(f"unknown shard: {', '.join(unknown)}")
+    if args.rebuild_shard:
+        drop_shards(args.rebuild_shard)
+    if args.rebuild_lexical:
+        rebuild_lexical_index()
+
+    # Create (or update) the data store, only touching files that changed.
+    start = time.perf_counter()
+    summary = update_database(
+        workers=args.workers,
+        batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight,
+        requests_per_second=args.requests_per_second,
+        chunking={"chunker": args.chunker, "chunk_size": args.chunk_size,
+                  "chunk_overlap": args.chunk_overlap, "chunk_unit": args.chunk_unit},
+        sharding=args.sharding,
+        parse_cache_path=PARSE_CACHE_PATH,
+        metrics=get_metrics(),
+    )
+    print_summary(summary, time.perf_counter() - start)
 
 
 def load_documents():
@@ -41,53 +93,381 @@ def load_documents():
     # docs = loader.load()
 
     # Use DirectoryLoader to load all PDFs from the data directory
+    from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader
     loader = DirectoryLoader(DATA_PATH, glob="**/*.pdf", loader_cls=PyPDFLoader)
     docs = loader.load()
 
     return docs
 
 
-def split_documents(documents: list[Document]):
+def split_documents(documents: list[Document], chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                    length_function=len):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=800,
-        chunk_overlap=80,
-        length_function=len,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=length_function,
         is_separator_regex=False,
     )
 
     return text_splitter.split_documents(documents)
 
 
-def add_to_chroma(chunks: list[Document]):
-
-    embedding_function = get_embedding_function()
-    # Load the existing database.
-    db = Chroma(
-        collection_name="medicine-research",
-        embedding_function=embedding_function,
-        persist_directory= CHROMA_PATH,  # Where to save data locally, remove if not necessary
+def load_file(source):
+    # langchain_community and pypdf are slow to import and only needed when a
+    # PDF is actually parsed, not for unchanged files or cached parses.
+    from langchain_community.document_loaders import PyPDFLoader
+    return PyPDFLoader(source).load()
+
+
+def load_parsed(source, parse_cache_path=None):
+    # The file's pages and their normalized lines; with a parse cache, a PDF
+    # whose content was parsed before (under any name) is not read by PyPDF.
+    if not parse_cache_path:
+        return load_file(source), None
+    cache = ParseCache(parse_cache_path)
+    try:
+        digest = file_sha256(source)
+        cached = cache.get(digest)
+        if cached:
+            pages, lines = cached
+            return [Document(page_content=page["text"], metadata={**page["metadata"], "source": source})
+                    for page in pages], lines
+        documents = load_file(source)
+        lines = normalize_pages([document.page_content for document in documents])
+        cache.put(digest, [{"text": document.page_content, "metadata": document.metadata}
+                           for document in documents], lines)
+        return documents, lines
+    finally:
+        cache.close()
+
+
+def parse_file(source, chunker="page", chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, chunk_unit=CHUNK_UNIT,
+               parse_cache_path=None):
+    # Runs in a worker process when --workers > 1. IDs only depend on the
+    # file's own chunks, so they match a serial run.
+    documents, lines = load_parsed(source, parse_cache_path)
+    if chunker == "structured":
+        return StructuredChunker(chunk_size, chunk_overlap, unit=chunk_unit).split_documents(documents, lines)
+    length_function = len if chunk_unit == "chars" else get_token_counter()
+    return calculate_chunk_ids(split_documents(documents, chunk_size, chunk_overlap, length_function))
+
+
+def iter_parsed_files(sources, workers=1, parse=parse_file):
+    # Yield (source, chunks) as each file finishes parsing. At most two files
+    # per worker are in flight, so memory stays bounded on large corpora.
+    # `parse` must be picklable, e.g. a functools.partial of parse_file.
+    if workers <= 1:
+        for source in sources:
+            yield source, parse(source)
+        return
+
+    sources = iter(sources)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for source in islice(sources, workers * 2):
+            pending[executor.submit(parse, source)] = source
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source = pending.pop(future)
+                yield source, future.result()
+                for next_source in islice(sources, 1):
+                    pending[executor.submit(parse, next_source)] = next_source
+
+
+def scan_data_files(manifest: IngestManifest, rechunk=False):
+    # Compare the PDFs on disk with the manifest. Unchanged mtime and size
+    # means the file is not even read; otherwise its content hash decides.
+    # With `rechunk`, every file counts as changed.
+    changed = []
+    unchanged = []
+    on_disk = set()
+
+    for path in sorted(Path(DATA_PATH).glob("**/*.pdf")):
+        source = str(path)
+        on_disk.add(source)
+        stat = path.stat()
+        recorded = manifest.get_file(source)
+        if recorded and recorded[0] == stat.st_mtime and recorded[1] == stat.st_size:
+            if rechunk:
+                changed.append((source, stat.st_mtime, stat.st_size, recorded[2]))
+            else:
+                unchanged.append(source)
+            continue
+
+        digest = file_sha256(source)
+        if recorded and recorded[2] == digest and not rechunk:
+            # Touched but identical, just refresh the stat.
+            manifest.record_file(source, stat.st_mtime, stat.st_size, digest)
+            unchanged.append(source)
+        else:
+            changed.append((source, stat.st_mtime, stat.st_size, digest))
+
+    removed = sorted(manifest.sources() - on_disk)
+    return changed, unchanged, removed
+
+
+def update_database(workers=1, batch_size=64, max_in_flight=4, requests_per_second=None, chunking=None,
+                    sharding=SHARDING, parse_cache_path=None, metrics=None):
+    # `chunking` holds parse_file's chunker, chunk_size, chunk_overlap and
+    # chunk_unit; when it differs from the last run every file is re-chunked.
+    # Files whose shard changed with `sharding` move to their new shard.
+    metrics = metrics or Metrics()
+    chunking = {**DEFAULT_CHUNKING, **(chunking or {})}
+    with metrics.trace("ingest") as trace:
+        summary = _update_database(workers, batch_size, max_in_flight, requests_per_second, chunking, sharding,
+                                   parse_cache_path, metrics, trace)
+        trace.record.update(summary)
+    return summary
+
+
+def _update_database(workers, batch_size, max_in_flight, requests_per_second, chunking, sharding, parse_cache_path,
+                     metrics, trace):
+    manifest = IngestManifest(os.path.join(CHROMA_PATH, MANIFEST_FILE))
+    settings = json.dumps(chunking, sort_keys=True)
+    rechunk = (manifest.get_setting("chunking") or json.dumps(DEFAULT_CHUNKING, sort_keys=True)) != settings
+
+    # Stores from before sharding hold everything in one collection.
+    shard_of = partial(shard_for, sharding=sharding, data_path=DATA_PATH)
+    old_shard_of = partial(shard_for, sharding=manifest.get_setting("sharding") or "none", data_path=DATA_PATH)
+    stored_shards = set(read_shard_names(CHROMA_PATH, default=())) | set(map(old_shard_of, manifest.sources()))
+    moved_ids = forget_moved_files(manifest, old_shard_of, shard_of)
+    lexical_index = open_lexical_index(stored_shards, shard_of)
+
+    if rechunk and manifest.sources():
+        print(f"🔁 Chunking settings changed, re-chunking every file ({settings})")
+    changed, unchanged, removed = scan_data_files(manifest, rechunk)
+    summary = {
+        "files_changed": len(changed),
+        "files_unchanged": len(unchanged),
+        "files_removed": len(removed),
+        "added": 0,
+        "updated": 0,
+        "deleted": 0,
+        "moved": 0,
+        "skipped": 0,
+    }
+
+    # Only open the vector store when there is something to write. The
+    # corpus version changes before the first write too, so caches do not
+    # keep answering from a corpus an ingest that then fails has changed.
+    if changed or removed or moved_ids:
+        store = open_vector_store(stored_shards | {shard_of(source) for source, *_ in changed}, shard_of)
+        bump_corpus_version(CHROMA_PATH)
+    else:
+        store = None
+
+    if moved_ids:
+        store.delete(moved_ids)
+        lexical_index.delete(moved_ids)
+        lexical_index.commit()
+        summary["deleted"] += len(moved_ids)
+
+    for source in removed:
+        stale_ids = list(manifest.chunk_hashes(source))
+        if stale_ids:
+            store.delete(stale_ids)
+            lexical_index.delete(stale_ids)
+            lexical_index.commit()
+        manifest.delete_chunks(stale_ids)
+        manifest.remove_file(source)
+        manifest.commit()
+        summary["deleted"] += len(stale_ids)
+
+    if changed:
+        writer = EmbeddingWriter(
+            store.upsert,
+            store.embedding_function,
+            batch_size=min(batch_size, store.max_batch_size),
+            max_in_flight=max_in_flight,
+            requests_per_second=requests_per_second,
+            metrics=metrics,
+        )
+        file_stats = {source: (mtime, size, digest) for source, mtime, size, digest in changed}
+        with writer:
+            parse = partial(parse_file, **chunking, parse_cache_path=parse_cache_path)
+            for source, chunks in iter_parsed_files(list(file_stats), workers, parse):
+                add_to_chroma(store, writer, manifest, lexical_index, source, chunks, summary,
+                              on_done=partial(finish_file, manifest, source, *file_stats[source]))
+        if writer.embedding_tokens:
+            cost = trace.embedding_usage(getattr(store.embedding_function, "model", None) or EMBEDDING_MODEL,
+                                         writer.embedding_tokens)
+            print(f"🧮 Embedding tokens: {writer.embedding_tokens} (${cost:.4f})")
+
+    manifest.set_setting("chunking", settings)
+    manifest.set_setting("sharding", sharding)
+    manifest.commit()
+    write_shard_names(CHROMA_PATH, set(map(shard_of, manifest.sources())))
+    manifest.close()
+
+    if summary["added"] or summary["updated"] or summary["deleted"]:
+        bump_corpus_version(CHROMA_PATH)
+
+    if store is not None:
+        store.optimize()
+        cache_stats = store.embedding_function.stats()
+        print(f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        stages = metrics.stage_summary()
+        for stage, label in (("ingest_embed", "Embedding"), ("ingest_write", "Writing")):
+            if stage in stages:
+                count, seconds = stages[stage]
+                print(f"⏱️ {label}: {count} batches, {seconds:.2f}s ({seconds / count * 1000:.0f} ms per batch)")
+    return summary
+
+
+def open_vector_store(names, shard_of=None):
+    # Load the existing database; the backend comes from VECTOR_STORE_BACKEND.
+    # EmbeddingWriter retries failed batches itself, so the client does not.
+    embedding_function = get_embedding_function(max_retries=0)
+    return ShardedStore(
+        lambda name: get_vector_store(persist_directory=CHROMA_PATH, collection_name=name,
+                                      embedding_function=embedding_function),
+        sorted(names), shard_of, embedding_function,
     )
 
-    # Calculate Page IDs.
-    chunks_with_ids = calculate_chunk_ids(chunks)
 
-    # Add or Update the documents.
-    existing_items = db.get(include=[])  # IDs are always included by default
-    existing_ids = set(existing_items["ids"])
-    print(f"Number of existing documents in DB: {len(existing_ids)}")
-
-    # Only add documents that don't exist in the DB.
-    new_chunks = []
-    for chunk in chunks_with_ids:
-        if chunk.metadata["id"] not in existing_ids:
-            new_chunks.append(chunk)
-
-    if len(new_chunks):
-        print(f"👉 Adding new documents: {len(new_chunks)}")
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        db.add_documents(new_chunks, ids=new_chunk_ids)
+def open_lexical_index(names, shard_of=None):
+    return ShardedLexicalIndex(CHROMA_PATH, sorted(names), shard_of)
+
+
+def forget_moved_files(manifest: IngestManifest, old_shard_of, shard_of):
+    # Files that belong to another shard under the new sharding are dropped
+    # from the manifest, so they are ingested again into their new shard.
+    # Returns their chunk IDs, to delete from the old one.
+    moved = [source for source in sorted(manifest.sources()) if old_shard_of(source) != shard_of(source)]
+    if not moved:
+        return []
+    print(f"🔀 Sharding changed, moving {len(moved)} files to their new shards")
+    moved_ids = []
+    for source in moved:
+        stale_ids = list(manifest.chunk_hashes(source))
+        manifest.delete_chunks(stale_ids)
+        manifest.remove_file(source)
+        moved_ids += stale_ids
+    manifest.commit()
+    return moved_ids
+
+
+def drop_shards(names):
+    # Empties the shards and forgets their files, so the following update
+    # ingests them again (with vectors from the embedding cache). Files are
+    # matched by the sharding they were stored with, which --sharding may
+    # be about to change.
+    manifest = IngestManifest(os.path.join(CHROMA_PATH, MANIFEST_FILE))
+    shard_of = partial(shard_for, sharding=manifest.get_setting("sharding") or "none", data_path=DATA_PATH)
+    sources = [source for source in manifest.sources() if shard_of(source) in names]
+    for source in sources:
+        manifest.delete_chunks(list(manifest.chunk_hashes(source)))
+        manifest.remove_file(source)
+    manifest.commit()
+    manifest.close()
+
+    store = open_vector_store(names, shard_of)
+    lexical_index = open_lexical_index(names, shard_of)
+    bump_corpus_version(CHROMA_PATH)
+    for name in names:
+        store.drop_shard(name)
+        lexical_index.drop_shard(name)
+    print(f"🧹 Emptied {', '.join(names)}: {len(sources)} files to ingest again")
+
+
+def add_to_chroma(store, writer: EmbeddingWriter, manifest: IngestManifest, lexical_index: ShardedLexicalIndex,
+                  source, chunks: list[Document], summary, on_done=None):
+    # `chunks` are one file's chunks, already carrying IDs from calculate_chunk_ids.
+
+    # Diff the file's chunks against the hashes stored on the last run.
+    stored_hashes = manifest.chunk_hashes(source)
+    stored_indexes = manifest.chunk_indexes(source)
+    new_hashes = {}
+    new_indexes = {}
+    upserts = []
+    moved = []
+    for chunk in chunks:
+        chunk_id = chunk.metadata["id"]
+        chunk_hash = chunk_sha256(chunk.page_content)
+        new_hashes[chunk_id] = chunk_hash
+        new_indexes[chunk_id] = chunk.metadata.get("chunk_index")
+        if chunk_id not in stored_hashes:
+            summary["added"] += 1
+            upserts.append(chunk)
+        elif stored_hashes[chunk_id] != chunk_hash:
+            summary["updated"] += 1
+            upserts.append(chunk)
+        elif stored_indexes.get(chunk_id) != new_indexes[chunk_id]:
+            # Same text at another position (text was added or removed before
+            # it): only its metadata changes, its vector and postings do not.
+            summary["moved"] += 1
+            moved.append(chunk)
+        else:
+            summary["skipped"] += 1
+
+    if moved:
+        ids = [chunk.metadata["id"] for chunk in moved]
+        store.update_metadata(ids, [chunk.metadata for chunk in moved])
+        lexical_index.update_metadata(ids, [chunk.metadata for chunk in moved])
+        lexical_index.commit()
+        manifest.record_chunks(source, {chunk_id: new_hashes[chunk_id] for chunk_id in ids}, new_indexes)
+
+    stale_ids = [chunk_id for chunk_id in stored_hashes if chunk_id not in new_hashes]
+    if stale_ids:
+        store.delete(stale_ids)
+        lexical_index.delete(stale_ids)
+        lexical_index.commit()
+        manifest.delete_chunks(stale_ids)
+        summary["deleted"] += len(stale_ids)
+
+    manifest.commit()
+
+    # Checkpoint every written batch, so a crashed ingest resumes after the
+    # last committed batch instead of re-embedding the whole file.
+    # The BM25 index is kept in step with each written batch.
+    def checkpoint(committed):
+        lexical_index.upsert(
+            [chunk.metadata["id"] for chunk in committed],
+            [chunk.page_content for chunk in committed],
+            [chunk.metadata for chunk in committed],
+        )
+        lexical_index.commit()
+        manifest.record_chunks(source, {chunk.metadata["id"]: new_hashes[chunk.metadata["id"]]
+                                        for chunk in committed}, new_indexes)
+        manifest.commit()
+
+    writer.add(upserts, on_commit=checkpoint, on_done=on_done)
+
+
+def rebuild_lexical_index():
+    # Each shard's BM25 index is rebuilt from that shard's collection.
+    names = read_shard_names(CHROMA_PATH)
+    store = open_vector_store(names)
+    lexical_index = open_lexical_index(names)
+    lexical_index.clear()
+    for name in names:
+        for ids, documents, metadatas in store.shard(name).iter_documents():
+            lexical_index.index(name).upsert(ids, documents, metadatas)
+    lexical_index.commit()
+    print(f"🔤 Rebuilt lexical index with {lexical_index.count()} chunks")
+
+
+def finish_file(manifest: IngestManifest, source, mtime, size, digest):
+    manifest.record_file(source, mtime, size, digest)
+    manifest.commit()
+
+
+def print_summary(summary, elapsed):
+    print(
+        f"📄 Files: {summary['files_changed']} changed, "
+        f"{summary['files_unchanged']} unchanged, {summary['files_removed']} removed"
+    )
+    if summary["added"] or summary["updated"] or summary["deleted"] or summary["moved"]:
+        print(
+            f"👉 Chunks: {summary['added']} added, {summary['updated']} updated, "
+            f"{summary['deleted']} deleted, {summary['moved']} moved, {summary['skipped']} skipped"
+        )
     else:
         print("✅ No new documents to add")
+    print(f"Done in {elapsed:.2f}s")
 
 
 def calculate_chunk_ids(chunks):
@@ -0,0 +1,129 @@
+#query_client.py
+
+import json
+import os
+
+import httpx
+
+QUERY_SERVICE_URL = os.getenv("QUERY_SERVICE_URL", "http://127.0.0.1:8765")
+
+
+class QueryServiceError(Exception):
+    # The service could not be reached or turned the request away.
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class QueryServiceClient:
+    # Talks to query_service.py. One client keeps one connection pool, so the
+    # app holds a single instance per process.
+
+    def __init__(self, base_url=QUERY_SERVICE_URL, timeout=130.0, transport=None):
+        self.base_url = base_url
+        self._http = httpx.Client(base_url=base_url, timeout=timeout, transport=transport)
+
+    def retrieve(self, query_text: str, k=5, shards=None):
+        return self._post("/retrieve", _query(query_text, shards, k=k))["results"]
+
+    def answer(self, query_text: str, api_key: str, shards=None):
+        return self._post("/answer", _query(query_text, shards), api_key)
+
+    def answer_stream(self, query_text: str, api_key: str, shards=None):
+        # Returns (sources, deltas) like RagEngine.query_stream. Closing the
+        # deltas generator early closes the connection, which cancels the
+        # completion on the service.
+        request = self._http.build_request("POST", "/answer/stream", json=_query(query_text, shards),
+                                           headers=_auth(api_key))
+        try:
+            response = self._http.send(request, stream=True)
+        except httpx.TransportError as error:
+            raise QueryServiceError(f"Query service unreachable at {self.base_url}: {error}")
+        if response.is_error:
+            response.read()
+            response.close()
+            raise _service_error(response)
+        lines = response.iter_lines()
+        try:
+            first = json.loads(next(lines))
+        except httpx.TransportError as error:
+            response.close()
+            raise QueryServiceError(f"Answer interrupted: {error}")
+        except BaseException:
+            response.close()
+            raise
+        if "error" in first:
+            response.close()
+            raise QueryServiceError(first["error"])
+        return first["sources"], self._deltas(response, lines)
+
+    def shards(self):
+        return self._get("/shards")["shards"]
+
+    def health(self):
+        return self._get("/health")
+
+    def usage(self, api_key: str, days=30):
+        # {"summary": {"today": {...}, "period": {...}}, "days": [per day and model]}
+        return self._get("/usage", api_key, params={"days": days})
+
+    def close(self):
+        self._http.close()
+
+    def _deltas(self, response, lines):
+        try:
+            for line in lines:
+                if not line:
+                    continue
+                event = json.loads(line)
+                if "delta" in event:
+                    yield event["delta"]
+                elif "error" in event:
+                    raise QueryServiceError(event["error"])
+        except httpx.TransportError as error:
+            # E.g. the service went away mid-answer.
+            raise QueryServiceError(f"Answer interrupted: {error}")
+        finally:
+            response.close()
+
+    def _get(self, path, api_key=None, params=None):
+        try:
+            response = self._http.get(path, headers=_auth(api_key), params=params)
+        except httpx.TransportError as error:
+            raise QueryServiceError(f"Query service unreachable at {self.base_url}: {error}")
+        if response.is_error:
+            raise _service_error(response)
+        return response.json()
+
+    def _post(self, path, body, api_key=None):
+        try:
+            response = self._http.post(path, json=body, headers=_auth(api_key))
+        except httpx.TransportError as error:
+            raise QueryServiceError(f"Query service unreachable at {self.base_url}: {error}")
+        if response.is_error:
+            raise _service_error(response)
+        return response.json()
+
+
+def _query(query_text, shards, **fields):
+    # Without `shards` the service searches every shard.
+    body = {"query": query_text, **fields}
+    if shards:
+        body["shards"] = list(shards)
+    return body
+
+
+def _auth(api_key):
+    return {"Authorization": f"Bearer {api_key}"} if api_key else {}
+
+
+def _service_error(response):
+    try:
+        message = response.json()["error"]
+    except (ValueError, KeyError, TypeError):
+        message = response.text or response.reason_phrase
+    retry_after = response.headers.get("Retry-After")
+    return QueryServiceError(message, status=response.status_code,
+                             retry_after=float(retry_after) if retry_after else None)
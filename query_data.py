@@ -1,10 +1,20 @@
 import argparse
-from langchain_chroma import Chroma
-from langchain_core.prompts import ChatPromptTemplate
-from embedding_function import get_embedding_function
-from openai import OpenAI
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from answer_cache import AnswerCache
+from context_builder import ContextBuilder
+from embedding_function import EMBEDDING_MODEL, embed_documents_with_usage, embed_query_with_usage
+from ingest_manifest import read_corpus_version
+from metrics import Metrics, get_metrics, user_id
+from reranker import Reranker, get_scorer
+from lexical_index import reciprocal_rank_fusion
+from shards import ShardedLexicalIndex, ShardedStore, read_shard_names
+from vector_store import COLLECTION_NAME, get_vector_store
 
 CHROMA_PATH = "chroma"
+CHAT_MODEL = "gpt-4o"
 PROMPT_TEMPLATE = """
 You are an assistant designed to provide detailed answers based on medical research documents. 
 
@@ -24,66 +34,483 @@ Question: {question}
 
 Please ensure that your answer fully addresses the question using the appropriate guidelines above.
 """
+# Split once, so building a prompt is plain concatenation.
+_PROMPT_HEAD, _rest = PROMPT_TEMPLATE.split("{context}")
+_PROMPT_MIDDLE, _PROMPT_TAIL = _rest.split("{question}")
 
 def main():
     # Create CLI.
     parser = argparse.ArgumentParser()
     parser.add_argument("query_text", type=str, help="The query text.")
     parser.add_argument("api_key", type=str, help="User's OpenAI API key.")
+    parser.add_argument("--local", action="store_true", help="Answer in this process instead of via the query service.")
+    parser.add_argument("--shard", action="append", dest="shards", metavar="SHARD",
+                        help="Only search this shard; repeat for several (default: all).")
     args = parser.parse_args()
     query_text = args.query_text
     api_key = args.api_key
-    query_rag(query_text, api_key)
-
-def log_gpt4_usage(response):
-    total_tokens = response.usage.total_tokens
-    prompt_tokens = response.usage.prompt_tokens
-    completion_tokens = response.usage.completion_tokens
-    
-    # Example GPT-4 pricing: adjust based on your model and currency (€0.03 per 1k tokens)
-    cost_per_1k_tokens = 5.00 / 1000000  # Cost per token in euros
-    total_cost = total_tokens * cost_per_1k_tokens
-    
-    print(f"Total tokens used: {total_tokens} (Prompt: {prompt_tokens}, Completion: {completion_tokens})")
-    print(f"Cost for this query: €{total_cost:.4f}")
-    return total_cost
-
-def query_rag(query_text: str, api_key: str):
-    # Create OpenAI client with the user's API key
-    client = OpenAI(api_key=api_key)
-
-    embedding_function = get_embedding_function()
-
-    # Load the existing database.
-    db = Chroma(
-        collection_name="medicine-research",
-        embedding_function=embedding_function,
-        persist_directory=CHROMA_PATH,  # Where to save data locally, remove if not necessary
-    )
+    if args.local:
+        query_rag(query_text, api_key, args.shards)
+        return
+
+    from query_client import QueryServiceClient
+    result = QueryServiceClient().answer(query_text, api_key, args.shards)
+    if result["cached"]:
+        print("♻️ Answered from cache")
+    print(f"Response: {result['response']}\nSources: {result['sources']}")
+
+def openai_client(api_key):
+    # The openai SDK takes about a second to import, so it is only loaded
+    # once the first question needs a client.
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+def async_openai_client(api_key):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=api_key)
+
+def log_usage(trace, response):
+    # Records the completion's tokens on the trace, priced per model.
+    usage = response.usage
+    model = getattr(response, "model", None) or CHAT_MODEL
+    cost = trace.usage(model, usage.prompt_tokens, usage.completion_tokens)
+    print(f"Total tokens used: {usage.total_tokens} (Prompt: {usage.prompt_tokens}, "
+          f"Completion: {usage.completion_tokens})")
+    print(f"Cost for this query: ${cost:.4f} ({model})")
+    return cost
+
+class RagEngine:
+    # Opens the vector store once and keeps one OpenAI client per API key, so
+    # each question only pays for the search and the completion.
+    #
+    # The store is sharded (see shards.py): every search fans out to the
+    # shards populate_database wrote, or to the `shards` a call asks for.
+    # Answers restricted to some shards bypass the answer cache, which holds
+    # answers from the whole corpus. When populate_database changes the
+    # corpus version, the shard list is read again, so shards it added or
+    # removed are picked up without a restart.
+
+    def __init__(self, persist_directory=CHROMA_PATH, collection_name=COLLECTION_NAME,
+                 embedding_function=None, client_factory=openai_client, async_client_factory=async_openai_client,
+                 answer_cache=None, lexical_index=None, fetch_k=20, backend=None, context_builder=None,
+                 report_context=True, metrics=None, reranker=None, shard_names=None):
+        if embedding_function is None:
+            from embedding_function import get_embedding_function
+            embedding_function = get_embedding_function()
+        self.embedding_function = embedding_function
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self._corpus_version = read_corpus_version(persist_directory)
+        self.store = ShardedStore(
+            lambda name: get_vector_store(
+                backend=backend,
+                persist_directory=persist_directory,
+                collection_name=name,
+                embedding_function=self.embedding_function,
+            ),
+            shard_names or read_shard_names(persist_directory, default=[collection_name]),
+            embedding_function=self.embedding_function,
+        )
+        self.context_builder = context_builder or ContextBuilder(model=CHAT_MODEL)
+        self.report_context = report_context
+        # In-memory unless given one; create_engine passes the logged instance.
+        self.metrics = metrics or Metrics()
+        self.client_factory = client_factory
+        self.async_client_factory = async_client_factory
+        self.answer_cache = answer_cache
+        self.lexical_index = lexical_index
+        self.fetch_k = fetch_k
+        self.reranker = reranker
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, api_key: str):
+        with self._lock:
+            if api_key not in self._clients:
+                self._clients[api_key] = self.client_factory(api_key=api_key)
+            return self._clients[api_key]
+
+    def async_client(self, api_key: str):
+        with self._lock:
+            if api_key not in self._async_clients:
+                self._async_clients[api_key] = self.async_client_factory(api_key=api_key)
+            return self._async_clients[api_key]
+
+    def warm_up(self):
+        # Loads what the first question would otherwise wait for: the openai
+        # SDK, the tokenizer, and the collection and BM25 postings.
+        import openai  # noqa: F401
+        self.context_builder.count_tokens("warm-up")
+        self.store.count()
+        if self.lexical_index is not None:
+            self.lexical_index.search("warm-up", k=1)
+
+    @property
+    def embedding_model(self):
+        return getattr(self.embedding_function, "model", None) or EMBEDDING_MODEL
+
+    @property
+    def shard_names(self):
+        self.refresh_shards()
+        return self.store.names
+
+    def refresh_shards(self):
+        version = read_corpus_version(self.persist_directory)
+        if version == self._corpus_version:
+            return
+        self._corpus_version = version
+        names = read_shard_names(self.persist_directory, default=[self.collection_name])
+        self.store.refresh(names)
+        if self.lexical_index is not None:
+            self.lexical_index.refresh(names)
+
+    def retrieve(self, query_text: str, k=5, query_embedding=None, shards=None):
+        if query_embedding is None:
+            query_embedding = self.embedding_function.embed_query(query_text)
+        return self.retrieve_many([query_text], k, [query_embedding], shards)[0]
+
+    def retrieve_many(self, query_texts, k=5, query_embeddings=None, shards=None):
+        # Searches the DB for several questions with one batched embedding
+        # request and one multi-query vector search. Returns one result list
+        # per question, as retrieve would.
+        if not query_texts:
+            return []
+        self.refresh_shards()
+        shards = self._scope(shards)
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function.embed_documents(list(query_texts))
+        # Over-fetch for the reranker, which picks the few that go in the prompt.
+        candidates_k = k if self.reranker is None else max(k, self.reranker.fetch_k)
+        if self.lexical_index is None:
+            candidates = self.store.search(query_embeddings, k=candidates_k, shards=shards)
+        else:
+            # Hybrid: fuse dense and BM25 rankings so exact drug names, doses
+            # and acronyms are not lost to the embedding.
+            fetch_k = max(candidates_k, self.fetch_k)
+            lexical_options = {} if shards is None else {"shards": shards}
+            candidates = [
+                reciprocal_rank_fusion([dense, self.lexical_index.search(query_text, k=fetch_k, **lexical_options)])
+                [:candidates_k]
+                for query_text, dense in zip(query_texts,
+                                             self.store.search(query_embeddings, k=fetch_k, shards=shards))
+            ]
+        if self.reranker is None:
+            return candidates
+        results = []
+        for query_text, question_candidates in zip(query_texts, candidates):
+            with self.metrics.time("rerank"):
+                results.append(self.reranker.rerank(query_text, question_candidates, k))
+        return results
+
+    def build_context(self, results):
+        # Merged, deduplicated and within the token budget; see ContextBuilder.
+        context = self.context_builder.build(results)
+        if self.report_context:
+            print(f"✂️ Context: {context['tokens']} tokens, {context['tokens_saved']} saved "
+                  f"({context['merged']} merged, {context['duplicates']} duplicates, "
+                  f"{context['over_budget']} over budget)")
+        return context
+
+    def build_messages(self, query_text: str, results):
+        context = self.build_context(results)
+        prompt = _PROMPT_HEAD + context["text"] + _PROMPT_MIDDLE + query_text + _PROMPT_TAIL
+        return [{"role": "user", "content": prompt}]
+
+    def query(self, query_text: str, api_key: str, shards=None):
+        shards = self._scope(shards)
+        with self.metrics.trace("answer", user_id(api_key)) as trace:
+            query_embedding, cached = self._check_cache(query_text, trace, shards)
+            if cached:
+                trace.finish(cached=True)
+                return cached
+            with trace.stage("search"):
+                results = self.retrieve(query_text, query_embedding=query_embedding, shards=shards)
+            with trace.stage("prompt"):
+                messages = self.build_messages(query_text, results)
+
+            # Use GPT-4 model
+            with trace.stage("generate"):
+                response = self.client(api_key).chat.completions.create(model=CHAT_MODEL, messages=messages)
+            return self._result(query_text, query_embedding, response, results, trace, shards)
+
+    async def aquery(self, query_text: str, api_key: str, shards=None):
+        # Embedding and Chroma's search are synchronous, keep them off the event loop.
+        shards = self._scope(shards)
+        with self.metrics.trace("answer", user_id(api_key)) as trace:
+            query_embedding, cached = await asyncio.to_thread(self._check_cache, query_text, trace, shards)
+            if cached:
+                trace.finish(cached=True)
+                return cached
+            with trace.stage("search"):
+                results = await asyncio.to_thread(self.retrieve, query_text, query_embedding=query_embedding,
+                                                  shards=shards)
+            with trace.stage("prompt"):
+                messages = self.build_messages(query_text, results)
+
+            with trace.stage("generate"):
+                response = await self.async_client(api_key).chat.completions.create(model=CHAT_MODEL, messages=messages)
+            # _result writes to the answer cache, which is SQLite.
+            return await asyncio.to_thread(self._result, query_text, query_embedding, response, results, trace,
+                                           shards)
+
+    async def aquery_batch(self, query_texts, api_key: str, k=5, concurrency=8, shards=None):
+        # Answers many questions together: one embedding request and one
+        # vector search for all of them, then up to `concurrency` completions
+        # in flight. Yields (index, result) in completion order; a question
+        # that fails gets a result with "error" rather than ending the batch.
+        # Each result carries its stage timings, where embed and search are
+        # the batch's time shared out evenly, and its token usage.
+        query_texts = list(query_texts)
+        if not query_texts:
+            return
+        shards = self._scope(shards)
+        user = user_id(api_key)
+        start = time.perf_counter()
+        with self.metrics.time("batch_embed"):
+            query_embeddings, tokens = await asyncio.to_thread(embed_documents_with_usage, self.embedding_function,
+                                                               query_texts)
+        embed_ms = (time.perf_counter() - start) * 1000 / len(query_texts)
+        # The one request's tokens, shared out over the questions' traces.
+        share, remainder = divmod(tokens, len(query_texts))
+        embedding_tokens = [share + (index < remainder) for index in range(len(query_texts))]
+
+        cached = {}
+        if self.answer_cache is not None and shards is None:
+            for index, (query_text, query_embedding) in enumerate(zip(query_texts, query_embeddings)):
+                hit = await asyncio.to_thread(self.answer_cache.lookup, query_text, query_embedding)
+                if hit:
+                    cached[index] = hit
+        pending = [index for index in range(len(query_texts)) if index not in cached]
 
-    # Search the DB.
-    results = db.similarity_search_with_score(query_text, k=5)
+        start = time.perf_counter()
+        with self.metrics.time("batch_search"):
+            retrieved = await asyncio.to_thread(self.retrieve_many, [query_texts[index] for index in pending], k,
+                                                [query_embeddings[index] for index in pending], shards)
+        search_ms = (time.perf_counter() - start) * 1000 / max(len(pending), 1)
 
-    context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(context=context_text, question=query_text)
+        for index, hit in cached.items():
+            with self.metrics.trace("batch_answer", user) as trace:
+                trace.record["stages"]["embed"] = round(embed_ms, 3)
+                if embedding_tokens[index]:
+                    trace.embedding_usage(self.embedding_model, embedding_tokens[index])
+                trace.finish(cached=True)
+            yield index, {**hit, "cached": True, "timings": dict(trace.record["stages"])}
 
-    # Use GPT-4 model
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def answer(index, results):
+            query_text = query_texts[index]
+            trace = self.metrics.trace("batch_answer", user)
+            trace.record["stages"].update(embed=round(embed_ms, 3), search=round(search_ms, 3))
+            if embedding_tokens[index]:
+                trace.embedding_usage(self.embedding_model, embedding_tokens[index])
+            result = {"sources": [doc.metadata.get("id", None) for doc, _score in results], "cached": False}
+            try:
+                with trace:
+                    with trace.stage("queue"):
+                        await semaphore.acquire()
+                    try:
+                        with trace.stage("prompt"):
+                            messages = self.build_messages(query_text, results)
+                        with trace.stage("generate"):
+                            response = await self.async_client(api_key).chat.completions.create(
+                                model=CHAT_MODEL, messages=messages)
+                    finally:
+                        semaphore.release()
+                    usage = response.usage
+                    trace.usage(getattr(response, "model", None) or CHAT_MODEL,
+                                usage.prompt_tokens, usage.completion_tokens)
+                    result["response"] = response.choices[0].message.content
+                    await asyncio.to_thread(self._store_answer, query_text, query_embeddings[index],
+                                            result["response"], results, usage, shards)
+            except Exception as e:
+                result["error"] = f"{e.__class__.__name__}: {e}"
+            result["timings"] = dict(trace.record["stages"], total=trace.record["total_ms"])
+            result["usage"] = {key: trace.record[key] for key in ("model", "prompt_tokens", "completion_tokens", "cost",
+                                                                  "embedding_tokens", "embedding_cost")
+                               if key in trace.record}
+            return index, result
+
+        tasks = [asyncio.create_task(answer(index, results)) for index, results in zip(pending, retrieved)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def query_stream(self, query_text: str, api_key: str, shards=None):
+        # Retrieval runs eagerly so the caller can show sources before the
+        # first token; generation only starts once the deltas are iterated.
+        shards = self._scope(shards)
+        trace = self.metrics.trace("answer_stream", user_id(api_key))
+        with _finish_on_error(trace):
+            query_embedding, cached = self._check_cache(query_text, trace, shards)
+            if cached:
+                trace.finish(cached=True)
+                return cached["sources"], iter([cached["response"]])
+            with trace.stage("search"):
+                results = self.retrieve(query_text, query_embedding=query_embedding, shards=shards)
+            with trace.stage("prompt"):
+                messages = self.build_messages(query_text, results)
+        sources = [doc.metadata.get("id", None) for doc, _score in results]
+        return sources, self._stream_deltas(query_text, query_embedding, api_key, results, messages, trace, shards)
+
+    async def aquery_stream(self, query_text: str, api_key: str, shards=None):
+        shards = self._scope(shards)
+        trace = self.metrics.trace("answer_stream", user_id(api_key))
+        with _finish_on_error(trace):
+            query_embedding, cached = await asyncio.to_thread(self._check_cache, query_text, trace, shards)
+            if cached:
+                trace.finish(cached=True)
+                return cached["sources"], _aiter_once(cached["response"])
+            with trace.stage("search"):
+                results = await asyncio.to_thread(self.retrieve, query_text, query_embedding=query_embedding,
+                                                  shards=shards)
+            with trace.stage("prompt"):
+                messages = self.build_messages(query_text, results)
+        sources = [doc.metadata.get("id", None) for doc, _score in results]
+        return sources, self._astream_deltas(query_text, query_embedding, api_key, results, messages, trace, shards)
+
+    def _stream_deltas(self, query_text, query_embedding, api_key, results, messages, trace, shards=None):
+        # The trace ends with the stream, also when the reader stops early.
+        with trace, trace.stage("generate"):
+            stream = self.client(api_key).chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            pieces = []
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                if chunk.usage:
+                    # Only the final chunk carries usage.
+                    log_usage(trace, chunk)
+                    self._store_answer(query_text, query_embedding, "".join(pieces), results, chunk.usage, shards)
+
+    async def _astream_deltas(self, query_text, query_embedding, api_key, results, messages, trace, shards=None):
+        with trace, trace.stage("generate"):
+            stream = await self.async_client(api_key).chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            pieces = []
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                if chunk.usage:
+                    log_usage(trace, chunk)
+                    await asyncio.to_thread(self._store_answer, query_text, query_embedding, "".join(pieces), results,
+                                            chunk.usage, shards)
+
+    def _scope(self, shards):
+        # None for the whole corpus, else the distinct shards asked for.
+        if shards is None or set(shards) == set(self.store.names):
+            return None
+        unknown = sorted(set(shards) - set(self.store.names))
+        if unknown:
+            raise ValueError(f"Unknown shards: {', '.join(unknown)}")
+        return sorted(set(shards))
+
+    def _check_cache(self, query_text, trace, shards=None):
+        # The query embedding is computed once and reused for the search.
+        with trace.stage("embed"):
+            query_embedding, tokens = embed_query_with_usage(self.embedding_function, query_text)
+        if tokens:
+            trace.embedding_usage(self.embedding_model, tokens)
+        if self.answer_cache is None or shards is not None:
+            return query_embedding, None
+        cached = self.answer_cache.lookup(query_text, query_embedding)
+        if cached:
+            cached["cached"] = True
+        return query_embedding, cached
+
+    def _store_answer(self, query_text, query_embedding, response_text, results, usage, shards=None):
+        if self.answer_cache is None or shards is not None:
+            return
+        self.answer_cache.put(
+            query_text,
+            query_embedding,
+            response_text,
+            [doc.metadata.get("id", None) for doc, _score in results],
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+        )
+
+    def _result(self, query_text, query_embedding, response, results, trace, shards=None):
+        # Log token usage and cost
+        log_usage(trace, response)
+        response_text = response.choices[0].message.content
+        self._store_answer(query_text, query_embedding, response_text, results, response.usage, shards)
+        return {
+            "response": response_text,
+            "sources": [doc.metadata.get("id", None) for doc, _score in results],
+            "cached": False,
+        }
+
+
+async def _aiter_once(value):
+    yield value
+
+
+@contextmanager
+def _finish_on_error(trace):
+    # For the streaming paths, whose trace outlives the call when it succeeds.
+    try:
+        yield
+    except BaseException:
+        trace.finish("error")
+        raise
+
+
+def create_engine():
+    # The engine as the CLI and the app run it: answer cache, hybrid retrieval
+    # and reranking (RERANKER=none turns it off) on, over every shard.
+    scorer = get_scorer()
+    shard_names = read_shard_names(CHROMA_PATH)
+    return RagEngine(
+        reranker=Reranker(scorer) if scorer else None,
+        metrics=get_metrics(),
+        answer_cache=AnswerCache(chroma_path=CHROMA_PATH),
+        lexical_index=ShardedLexicalIndex(CHROMA_PATH, shard_names),
+        shard_names=shard_names,
     )
 
-    # Log GPT-4 token usage and calculate cost
-    log_gpt4_usage(response)
-    response_text = response.choices[0].message.content
 
-    sources = [doc.metadata.get("id", None) for doc, _score in results]
-    formatted_response = f"Response: {response_text}\nSources: {sources}"
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine()
+        return _engine
+
+
+def query_rag(query_text: str, api_key: str, shards=None):
+    engine = get_engine()
+    result = engine.query(query_text, api_key, shards)
+    if result["cached"]:
+        cache_stats = engine.answer_cache.stats()
+        saved = cache_stats["saved_prompt_tokens"] + cache_stats["saved_completion_tokens"]
+        print(f"♻️ Answered from cache (hit rate {cache_stats['hit_rate']:.0%}, {saved} tokens saved)")
+
+    formatted_response = f"Response: {result['response']}\nSources: {result['sources']}"
     print(formatted_response)
-    return response_text
+    return result["response"]
+
+def query_rag_stream(query_text: str, api_key: str, shards=None):
+    # Returns (sources, deltas); deltas is a generator of response text pieces.
+    return get_engine().query_stream(query_text, api_key, shards)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,313 @@
+#query_service.py
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+from metrics import user_id
+from warmup import WARMUP, selected, warm_up
+
+QUERY_SERVICE_HOST = os.getenv("QUERY_SERVICE_HOST", "127.0.0.1")
+QUERY_SERVICE_PORT = int(os.getenv("QUERY_SERVICE_PORT", "8765"))
+MAX_CONCURRENT = int(os.getenv("QUERY_SERVICE_MAX_CONCURRENT", "16"))
+PER_KEY_LIMIT = int(os.getenv("QUERY_SERVICE_PER_KEY_LIMIT", "2"))
+MAX_QUEUE = int(os.getenv("QUERY_SERVICE_MAX_QUEUE", "64"))
+REQUEST_TIMEOUT = float(os.getenv("QUERY_SERVICE_TIMEOUT", "120"))
+MAX_K = int(os.getenv("QUERY_SERVICE_MAX_K", "50"))
+MAX_USAGE_DAYS = 366
+
+
+class QueueFull(Exception):
+    pass
+
+
+class QueryService:
+    # Serves one RagEngine to every Streamlit session and CLI call over HTTP.
+    # At most `max_concurrent` requests run at once and at most
+    # `per_key_limit` per API key, so one user cannot take every slot; up to
+    # `max_queue` more wait, and beyond that requests are turned away with a
+    # 503 and Retry-After instead of piling up. Every request has a deadline
+    # that includes its time in the queue, and a client that disconnects
+    # cancels its request, which cancels the in-flight completion. A request
+    # the engine fails (e.g. an OpenAI error) gets a JSON 502, or a final
+    # {"error": ...} line once a stream has started.
+
+    def __init__(self, engine, max_concurrent=MAX_CONCURRENT, per_key_limit=PER_KEY_LIMIT,
+                 max_queue=MAX_QUEUE, timeout=REQUEST_TIMEOUT):
+        self.engine = engine
+        self.per_key_limit = per_key_limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.waiting = 0
+        self.active = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.completed = 0
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._key_slots = {}  # key hash -> [semaphore, requests holding or waiting on it]
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post("/retrieve", self.handle_retrieve),
+            web.post("/answer", self.handle_answer),
+            web.post("/answer/stream", self.handle_answer_stream),
+            web.get("/shards", self.handle_shards),
+            web.get("/health", self.handle_health),
+            web.get("/metrics", self.handle_metrics),
+            web.get("/usage", self.handle_usage),
+        ])
+        return app
+
+    @asynccontextmanager
+    async def slot(self, api_key=None):
+        # Waits for a slot of the caller's API key (if any), then a global one.
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull()
+        semaphores = [self._slots]
+        key = None
+        if api_key is not None:
+            # Entries live only while the key has requests, so idle keys take no memory.
+            key = hashlib.sha256(api_key.encode()).hexdigest()
+            entry = self._key_slots.setdefault(key, [asyncio.Semaphore(self.per_key_limit), 0])
+            entry[1] += 1
+            semaphores.insert(0, entry[0])
+        self.waiting += 1
+        acquired = []
+        queued = time.perf_counter()
+        try:
+            for semaphore in semaphores:
+                await semaphore.acquire()
+                acquired.append(semaphore)
+        except BaseException:
+            for semaphore in acquired:
+                semaphore.release()
+            self._leave(key)
+            raise
+        finally:
+            self.waiting -= 1
+            self.engine.metrics.observe("queue_wait", time.perf_counter() - queued)
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            for semaphore in semaphores:
+                semaphore.release()
+            self._leave(key)
+
+    def _leave(self, key):
+        if key is not None:
+            entry = self._key_slots[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_slots[key]
+
+    async def handle_retrieve(self, request):
+        body = await _json_body(request)
+        k = _bounded_int(body.get("k", 5), "k", 1, MAX_K)
+        shards = self._shards(body)
+        # Retrieval spends no API credit, so only the global limit applies.
+        async with self._guard(None):
+            results = await asyncio.to_thread(self.engine.retrieve, body["query"], k, shards=shards)
+        return web.json_response({"results": [
+            {"id": doc.metadata.get("id"), "score": score, "text": doc.page_content} for doc, score in results
+        ]})
+
+    async def handle_answer(self, request):
+        body = await _json_body(request)
+        shards = self._shards(body)
+        async with self._guard(_api_key(request)):
+            result = await self.engine.aquery(body["query"], _api_key(request), shards)
+        return web.json_response(result)
+
+    async def handle_answer_stream(self, request):
+        # NDJSON: {"sources": [...]} first, then {"delta": "..."} lines and a
+        # final {"done": true}.
+        body = await _json_body(request)
+        api_key = _api_key(request)
+        shards = self._shards(body)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        try:
+            async with self._guard(api_key):
+                sources, deltas = await self.engine.aquery_stream(body["query"], api_key, shards)
+                await response.prepare(request)
+                try:
+                    await response.write(_line({"sources": sources}))
+                    async for delta in deltas:
+                        await response.write(_line({"delta": delta}))
+                    await response.write(_line({"done": True}))
+                except ConnectionResetError:
+                    # The user went away: stop generating.
+                    raise asyncio.CancelledError()
+                finally:
+                    await deltas.aclose()
+        except web.HTTPException as error:
+            if not response.prepared:
+                raise
+            # Headers are gone; report a deadline hit or an engine error
+            # mid-answer in the stream, then end the body cleanly.
+            await response.write(_line({"error": json.loads(error.text)["error"]}))
+        await response.write_eof()
+        return response
+
+    async def handle_shards(self, request):
+        # What a query can be restricted to, with each shard's chunk count.
+        counts = await asyncio.to_thread(
+            lambda: {name: self.engine.store.count([name]) for name in self.engine.shard_names})
+        return web.json_response({"shards": [{"name": name, "chunks": count} for name, count in counts.items()]})
+
+    async def handle_health(self, request):
+        return web.json_response({
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "failed": self.failed,
+        })
+
+    async def handle_metrics(self, request):
+        # Prometheus text format: the engine's stage, token and cost metrics
+        # plus this service's queue.
+        lines = [self.engine.metrics.prometheus().rstrip("\n")]
+        for name, value in (("active", self.active), ("waiting", self.waiting)):
+            lines += [f"# TYPE query_service_{name} gauge", f"query_service_{name} {value}"]
+        for name in ("completed", "rejected", "timed_out", "cancelled", "failed"):
+            lines += [f"# TYPE query_service_{name}_total counter",
+                      f"query_service_{name}_total {getattr(self, name)}"]
+        return web.Response(text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8")
+
+    async def handle_usage(self, request):
+        # The caller's own usage only: the user is the hash of its API key.
+        days = _bounded_int(request.query.get("days", "30"), "days", 1, MAX_USAGE_DAYS)
+        user = user_id(_api_key(request))
+        summary, rows = await asyncio.to_thread(
+            lambda: (self.engine.metrics.usage_summary(user, days), self.engine.metrics.usage(user, days)))
+        return web.json_response({"summary": summary, "days": rows})
+
+    def _shards(self, body):
+        # An optional list of shard names to search instead of all of them.
+        shards = body.get("shards")
+        if shards is None:
+            return None
+        if not isinstance(shards, list) or not shards or not all(isinstance(name, str) for name in shards):
+            raise _error(web.HTTPBadRequest, "shards must be a non-empty list of shard names")
+        unknown = sorted(set(shards) - set(self.engine.shard_names))
+        if unknown:
+            raise _error(web.HTTPBadRequest, f"Unknown shards: {', '.join(unknown)}")
+        return shards
+
+    @asynccontextmanager
+    async def _guard(self, api_key):
+        # Queue slot plus deadline, with errors mapped to HTTP responses.
+        try:
+            async with asyncio.timeout(self.timeout):
+                async with self.slot(api_key):
+                    yield
+            self.completed += 1
+        except QueueFull:
+            raise _error(web.HTTPServiceUnavailable, "Too many queued requests", headers={"Retry-After": "1"})
+        except TimeoutError:
+            self.timed_out += 1
+            raise _error(web.HTTPGatewayTimeout, "Request timed out")
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except web.HTTPException:
+            raise
+        except Exception as error:
+            # The details stay in the service log; they may name the upstream request.
+            self.failed += 1
+            print(f"⚠️ Request failed: {error.__class__.__name__}: {error}")
+            raise _error(web.HTTPBadGateway, f"Could not answer ({error.__class__.__name__})")
+
+
+def _api_key(request):
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer ") or not header[7:].strip():
+        raise _error(web.HTTPUnauthorized, "Missing API key")
+    return header[7:].strip()
+
+
+async def _json_body(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise _error(web.HTTPBadRequest, "Body must be JSON")
+    if not isinstance(body, dict) or not isinstance(body.get("query"), str) or not body["query"].strip():
+        raise _error(web.HTTPBadRequest, "Missing query")
+    return body
+
+
+def _bounded_int(value, name, low, high):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise _error(web.HTTPBadRequest, f"{name} must be an integer")
+    if not low <= number <= high:
+        raise _error(web.HTTPBadRequest, f"{name} must be between {low} and {high}")
+    return number
+
+
+def _error(error_class, message, headers=None):
+    return error_class(text=json.dumps({"error": message}), content_type="application/json", headers=headers)
+
+
+def _line(payload):
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def serve(service, host=QUERY_SERVICE_HOST, port=QUERY_SERVICE_PORT):
+    # handler_cancellation: a client disconnect cancels its handler.
+    runner = web.AppRunner(service.app(), handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=QUERY_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=QUERY_SERVICE_PORT)
+    parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT)
+    parser.add_argument("--per-key-limit", type=int, default=PER_KEY_LIMIT)
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT)
+    parser.add_argument("--warmup", default=WARMUP,
+                        help='"engine" loads the SDK, tokenizer and indexes in the background at startup.')
+    args = parser.parse_args()
+
+    from query_data import create_engine
+
+    async def run():
+        engine = create_engine()
+        warm_up(selected({"engine": engine.warm_up}, args.warmup))
+        service = QueryService(engine, args.max_concurrent, args.per_key_limit, args.max_queue, args.timeout)
+        runner = await serve(service, args.host, args.port)
+        print(f"🚀 Query service listening on http://{args.host}:{args.port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#reranker.py
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from lexical_index import tokenize
+
+RERANKER = os.getenv("RERANKER", "lexical")  # "lexical", "cross-encoder" or "none"
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "50"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "150"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "1024"))
+MMR_LAMBDA = float(os.getenv("RERANK_MMR_LAMBDA", "0.8"))  # 1.0 ranks on relevance alone
+CROSS_ENCODER_PATH = os.getenv("CROSS_ENCODER_PATH", "models/cross-encoder")
+
+
+class LexicalScorer:
+    # Cheap fallback: how much of the question a passage covers, and how
+    # closely. Rewards the query's terms (rarer-looking, longer terms weigh
+    # more), its word pairs appearing side by side, and the matched terms
+    # sitting in a short window rather than scattered over the chunk.
+    prior_weight = 0.5  # weak on its own, so keep half of the first-stage order
+
+    def score(self, query, texts):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [0.0] * len(texts)
+        weights = {term: math.log1p(len(term)) for term in terms}
+        total = sum(weights.values())
+        pairs = set(zip(terms, terms[1:]))
+        scores = []
+        for text in texts:
+            tokens = tokenize(text)
+            present = set(tokens) & weights.keys()
+            coverage = sum(weights[term] for term in present) / total
+            adjacent = sum(1 for pair in zip(tokens, tokens[1:]) if pair in pairs)
+            proximity = _window_density(tokens, present) if len(present) > 1 else 0.0
+            scores.append(coverage + 0.3 * min(adjacent, len(pairs)) / max(len(pairs), 1) + 0.2 * proximity)
+        return scores
+
+
+class CrossEncoderScorer:
+    # A cross-encoder (e.g. cross-encoder/ms-marco-MiniLM-L-6-v2 exported to
+    # ONNX) run on the CPU with onnxruntime. `model_path` holds model.onnx and
+    # tokenizer.json; both libraries are only imported when it is used.
+    prior_weight = 0.1
+
+    def __init__(self, model_path=CROSS_ENCODER_PATH, max_length=256, threads=None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_path, "model.onnx"), options, providers=["CPUExecutionProvider"])
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def score(self, query, texts):
+        encodings = self.tokenizer.encode_batch([(query, text) for text in texts])
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        logits = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        return logits.reshape(len(texts), -1)[:, 0].tolist()
+
+
+def get_scorer(name=RERANKER, model_path=CROSS_ENCODER_PATH):
+    # None disables reranking. A missing cross-encoder falls back to the
+    # lexical scorer, so the app still starts without the model files.
+    if name == "none":
+        return None
+    if name == "cross-encoder":
+        try:
+            return CrossEncoderScorer(model_path)
+        except Exception as e:
+            print(f"⚠️ Cross-encoder unavailable ({e.__class__.__name__}: {e}), reranking lexically")
+    return LexicalScorer()
+
+
+class Reranker:
+    # Second retrieval stage: the first stage over-fetches `fetch_k`
+    # candidates, which are scored in batches, in first-stage order, until
+    # the latency budget runs out; candidates left unscored keep their order
+    # after the scored ones. The final top k is picked by MMR so near-identical
+    # passages do not crowd out the rest. Results are cached per question and
+    # candidate set.
+
+    def __init__(self, scorer, fetch_k=RERANK_FETCH_K, batch_size=RERANK_BATCH_SIZE, budget_ms=RERANK_BUDGET_MS,
+                 mmr_lambda=MMR_LAMBDA, cache_size=RERANK_CACHE_SIZE, clock=time.perf_counter):
+        self.scorer = scorer
+        self.fetch_k = fetch_k
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.mmr_lambda = mmr_lambda
+        self.cache_size = cache_size
+        self.clock = clock
+        self.calls = 0
+        self.cache_hits = 0
+        self.over_budget = 0
+        self.latencies_ms = deque(maxlen=1000)  # the most recent calls
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def rerank(self, query, candidates, k=5):
+        # `candidates` are (Document, score) pairs, best first. Returns the top
+        # k as (Document, rerank score).
+        if not candidates:
+            return []
+        key = (" ".join(query.split()).lower(), tuple(doc.metadata.get("id") or doc.page_content
+                                                     for doc, _score in candidates), k)
+        with self._lock:
+            self.calls += 1
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return [(candidates[index][0], score) for index, score in cached]
+
+        start = self.clock()
+        texts = [doc.page_content for doc, _score in candidates]
+        scores = []
+        for batch_start in range(0, len(texts), self.batch_size):
+            if scores and (self.clock() - start) * 1000 > self.budget_ms:
+                break
+            scores.extend(self.scorer.score(query, texts[batch_start:batch_start + self.batch_size]))
+        relevance = self._relevance(scores, len(candidates))
+        picked = self._mmr(relevance, texts, k)
+        elapsed_ms = (self.clock() - start) * 1000
+
+        result = [(index, float(relevance[index])) for index in picked]
+        with self._lock:
+            self.latencies_ms.append(elapsed_ms)
+            if len(scores) < len(candidates):
+                self.over_budget += 1
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return [(candidates[index][0], score) for index, score in result]
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies_ms)
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "over_budget": self.over_budget,
+            "p50_ms": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p95_ms": latencies[max(0, math.ceil(len(latencies) * 0.95) - 1)] if latencies else 0.0,
+        }
+
+    def _relevance(self, scores, count):
+        # Scores scaled to [0, 1] and blended with the first-stage rank;
+        # unscored candidates only have the rank, below every scored one.
+        prior = 1 - np.arange(count) / count
+        weight = getattr(self.scorer, "prior_weight", 0.0)
+        relevance = prior - 1.0
+        if scores:
+            scores = np.asarray(scores, dtype=np.float64)
+            spread = scores.max() - scores.min()
+            scaled = (scores - scores.min()) / spread if spread else np.ones(len(scores))
+            relevance[:len(scores)] = (1 - weight) * scaled + weight * prior[:len(scores)]
+        return relevance
+
+    def _mmr(self, relevance, texts, k):
+        order = list(np.argsort(-relevance, kind="stable"))
+        if self.mmr_lambda >= 1.0:
+            return order[:k]
+        # Diversity only among the best few, where it matters.
+        pool = order[:3 * k]
+        token_sets = {index: set(tokenize(texts[index])) for index in pool}
+        picked = []
+        while pool and len(picked) < k:
+            best, best_value = None, None
+            for index in pool:
+                similarity = max((_jaccard(token_sets[index], token_sets[other]) for other in picked), default=0.0)
+                value = self.mmr_lambda * relevance[index] - (1 - self.mmr_lambda) * similarity
+                if best_value is None or value > best_value:
+                    best, best_value = index, value
+            picked.append(best)
+            pool.remove(best)
+        return picked
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def _window_density(tokens, present):
+    # Matched terms / length of the shortest window containing all of them.
+    positions = [(position, token) for position, token in enumerate(tokens) if token in present]
+    counts = {}
+    best = len(tokens)
+    left = 0
+    for right, (position, token) in enumerate(positions):
+        counts[token] = counts.get(token, 0) + 1
+        while len(counts) == len(present):
+            best = min(best, position - positions[left][0] + 1)
+            left_token = positions[left][1]
+            counts[left_token] -= 1
+            if not counts[left_token]:
+                del counts[left_token]
+            left += 1
+    return len(present) / best if best else 0.0
@@ -0,0 +1,256 @@
+#shards.py
+#
+# The corpus is split into shards, each its own vector store collection and
+# BM25 index. With SHARDING=folder (the default) every specialty folder under
+# data/ is a shard and PDFs directly in data/ stay in the original
+# "medicine-research" collection; with SHARDING=hash:N files are spread over N
+# shards by a hash of their path; SHARDING=none keeps one collection.
+
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from lexical_index import LEXICAL_INDEX_FILE, LexicalIndex
+from vector_store import COLLECTION_NAME
+
+SHARDING = os.getenv("SHARDING", "folder")
+SHARDS_FILE = "shards.json"
+
+
+def parse_sharding(sharding):
+    # Returns ("none" | "folder", None) or ("hash", shard count).
+    if sharding in ("none", "folder"):
+        return sharding, None
+    if sharding.startswith("hash:") and sharding[5:].isdigit() and int(sharding[5:]) > 0:
+        return "hash", int(sharding[5:])
+    raise ValueError(f'Unknown sharding {sharding!r}: use "none", "folder" or "hash:N"')
+
+
+def shard_name(name):
+    # Collection names must be 3-63 of [a-z0-9._-], starting and ending alphanumeric.
+    name = unicodedata.normalize("NFKD", name.lower())
+    name = re.sub(r"[^a-z0-9._-]+", "-", "".join(char for char in name if not unicodedata.combining(char)))
+    name = name.strip("-._")[:63].strip("-._")
+    return name if len(name) >= 3 else f"shard-{name or 'x'}"
+
+
+def shard_for(source, sharding=SHARDING, data_path="data"):
+    mode, count = parse_sharding(sharding)
+    relative = os.path.relpath(source, data_path).replace(os.sep, "/")
+    if mode == "hash":
+        digest = hashlib.sha256(relative.encode("utf-8")).hexdigest()
+        return f"{COLLECTION_NAME}-{int(digest[:8], 16) % count}"
+    if mode == "folder" and "/" in relative:
+        return shard_name(relative.split("/", 1)[0])
+    return COLLECTION_NAME
+
+
+def read_shard_names(chroma_path, default=(COLLECTION_NAME,)):
+    # The shards populate_database last wrote; a store from before sharding
+    # has only the original collection.
+    try:
+        with open(os.path.join(chroma_path, SHARDS_FILE), encoding="utf-8") as file:
+            names = json.load(file)
+    except FileNotFoundError:
+        names = []
+    return names or list(default)
+
+
+def write_shard_names(chroma_path, names):
+    os.makedirs(chroma_path, exist_ok=True)
+    path = os.path.join(chroma_path, SHARDS_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(sorted(names), file)
+    os.replace(path + ".tmp", path)
+
+
+def lexical_index_path(chroma_path, name):
+    # The original collection keeps the BM25 file it had before sharding.
+    if name == COLLECTION_NAME:
+        return os.path.join(chroma_path, LEXICAL_INDEX_FILE)
+    return os.path.join(chroma_path, "lexical", f"{name}.sqlite3")
+
+
+def merge_results(result_lists, k):
+    # Best k (Document, score) pairs over several shards, higher score first.
+    return heapq.nlargest(k, chain.from_iterable(result_lists), key=lambda item: item[1])
+
+
+class ShardedStore:
+    # One vector store per shard behind the single-store interface. Writes go
+    # to the shard of each chunk's source (`shard_of`), deletes to every
+    # shard, and a search runs on the shards in parallel, keeping the best k
+    # of each and merging them by score. Shards share the embedding model and
+    # every backend scores higher-is-better, so scores compare across shards.
+
+    def __init__(self, open_shard, names, shard_of=None, embedding_function=None):
+        self.open_shard = open_shard
+        self.shard_of = shard_of or shard_for
+        self.embedding_function = embedding_function
+        self.stores = {name: open_shard(name) for name in names}
+        self._executor = None
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    @property
+    def names(self):
+        return sorted(self.stores)
+
+    @property
+    def max_batch_size(self):
+        return min((store.max_batch_size for store in self.stores.values()), default=5000)
+
+    def shard(self, name):
+        with self._lock:
+            if name not in self.stores:
+                self.stores[name] = self.open_shard(name)
+            return self.stores[name]
+
+    def refresh(self, names):
+        # Follows the shard list populate_database wrote: opens new shards and
+        # forgets the ones it no longer lists, leaving their files alone.
+        # Swapped whole, so searches in flight keep the shards they started with.
+        with self._lock:
+            self.stores = {name: self.stores.get(name) or self.open_shard(name) for name in names}
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        groups = {}
+        for row in zip(ids, embeddings, documents, metadatas):
+            groups.setdefault(self.shard_of(row[3]["source"]), []).append(row)
+        for name, rows in groups.items():
+            self.shard(name).upsert(*map(list, zip(*rows)))
+
+    def delete(self, ids):
+        # IDs do not say which shard holds them, and deleting an absent ID is a no-op.
+        for store in list(self.stores.values()):
+            store.delete(ids)
+
+    def update_metadata(self, ids, metadatas):
+        groups = {}
+        for row in zip(ids, metadatas):
+            groups.setdefault(self.shard_of(row[1]["source"]), []).append(row)
+        for name, rows in groups.items():
+            self.shard(name).update_metadata(*map(list, zip(*rows)))
+
+    def drop_shard(self, name):
+        with self._lock:
+            store = self.stores.pop(name, None)
+        if store is not None:
+            store.drop()
+
+    def count(self, shards=None):
+        return sum(store.count() for store in self._select(shards))
+
+    def search(self, query_embeddings, k=5, where=None, shards=None):
+        stores = self._select(shards)
+        per_shard = self._map(lambda store: store.search(query_embeddings, k=k, where=where), stores)
+        return [merge_results([results[query] for results in per_shard], k) for query in range(len(query_embeddings))]
+
+    def iter_documents(self, page_size=1000):
+        for store in list(self.stores.values()):
+            yield from store.iter_documents(page_size)
+
+    def optimize(self):
+        for store in list(self.stores.values()):
+            store.optimize()
+
+    def _select(self, shards):
+        if shards is None:
+            return list(self.stores.values())
+        unknown = sorted(set(shards) - set(self.stores))
+        if unknown:
+            raise ValueError(f"Unknown shards: {', '.join(unknown)}")
+        return [self.stores[name] for name in sorted(set(shards))]
+
+    def _map(self, function, stores):
+        if len(stores) <= 1:
+            return [function(store) for store in stores]
+        # One worker per shard, so the pool is replaced when refresh() or a
+        # write adds shards. Tasks are submitted under the lock: a replaced
+        # pool finishes what it was given before its threads exit.
+        with self._lock:
+            if self._workers < len(stores):
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._workers = len(self.stores)
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="shard")
+            results = self._executor.map(function, stores)
+        return list(results)
+
+
+class ShardedLexicalIndex:
+    # One BM25 index per shard, routed like ShardedStore. Each shard scores
+    # with its own document frequencies; searches are merged by score.
+
+    def __init__(self, chroma_path, names, shard_of=None):
+        self.chroma_path = chroma_path
+        self.shard_of = shard_of or shard_for
+        self.indexes = {}
+        for name in names:
+            self.index(name)
+
+    @property
+    def names(self):
+        return sorted(self.indexes)
+
+    def index(self, name):
+        if name not in self.indexes:
+            self.indexes[name] = LexicalIndex(lexical_index_path(self.chroma_path, name))
+        return self.indexes[name]
+
+    def refresh(self, names):
+        # As ShardedStore.refresh.
+        self.indexes = {name: self.indexes.get(name) or LexicalIndex(lexical_index_path(self.chroma_path, name))
+                        for name in names}
+
+    def upsert(self, ids, texts, metadatas):
+        groups = {}
+        for row in zip(ids, texts, metadatas):
+            groups.setdefault(self.shard_of(row[2]["source"]), []).append(row)
+        for name, rows in groups.items():
+            self.index(name).upsert(*map(list, zip(*rows)))
+
+    def delete(self, ids):
+        for index in self.indexes.values():
+            index.delete(ids)
+
+    def update_metadata(self, ids, metadatas):
+        groups = {}
+        for row in zip(ids, metadatas):
+            groups.setdefault(self.shard_of(row[1]["source"]), []).append(row)
+        for name, rows in groups.items():
+            self.index(name).update_metadata(*map(list, zip(*rows)))
+
+    def drop_shard(self, name):
+        if name in self.indexes:
+            self.indexes[name].clear()
+            self.indexes[name].commit()
+
+    def clear(self):
+        for index in self.indexes.values():
+            index.clear()
+
+    def commit(self):
+        for index in self.indexes.values():
+            index.commit()
+
+    def count(self, shards=None):
+        return sum(index.count() for index in self._select(shards))
+
+    def search(self, query_text, k=5, shards=None):
+        return merge_results([index.search(query_text, k=k) for index in self._select(shards)], k)
+
+    def _select(self, shards):
+        indexes = self.indexes
+        if shards is None:
+            return list(indexes.values())
+        unknown = sorted(set(shards) - set(indexes))
+        if unknown:
+            raise ValueError(f"Unknown shards: {', '.join(unknown)}")
+        return [indexes[name] for name in sorted(set(shards))]
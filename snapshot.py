@@ -0,0 +1,376 @@
+#snapshot.py
+#
+#   python snapshot.py export chroma.snap    # where populate_database.py ran
+#   python snapshot.py import chroma.snap    # on each replica, which then runs with VECTOR_STORE_BACKEND=snapshot
+#
+# A snapshot is the whole vector store in one file that replicas serve by
+# memory-mapping it: nothing is loaded when it is opened, and pages are read
+# as searches touch them. Layout:
+#
+#   MAGIC | header length (uint64, little-endian) | header JSON | sections
+#
+# The header holds the format version, the corpus version, the shards (each
+# a contiguous range of rows), the metadata fields, the offset, dtype and
+# shape of every section, and the SHA-256 of the section bytes. Sections
+# start on 64-byte boundaries: the unit-normalised float32 vectors; the
+# chunk text, the IDs and each metadata field as a UTF-8 column with uint64
+# row offsets (metadata values are JSON, empty where a chunk lacks the field);
+# and the rows in ID order, for looking chunks up by ID.
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+from ingest_manifest import read_corpus_version, write_corpus_version
+from shards import ShardedLexicalIndex, read_shard_names, write_shard_names
+from vector_store import _blocked_top_k, _unit_rows, get_vector_store
+
+CHROMA_PATH = "chroma"
+SNAPSHOT_FILE = "snapshot.ragsnap"
+SNAPSHOT_FORMAT = 1
+MAGIC = b"RAGSNAP\0"
+ALIGNMENT = 64
+
+
+def write_snapshot(path, shards, corpus_version=""):
+    # `shards` yields (name, pages), pages as a store's iter_rows yields them.
+    # Vectors and text are streamed to scratch files; IDs and metadata are
+    # held in memory until the end.
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(dir=directory) as scratch:
+        vectors_path = os.path.join(scratch, "vectors")
+        text_path = os.path.join(scratch, "text")
+        text_offsets = [0]
+        ids = []
+        metadatas = []
+        ranges = []
+        dimensions = 0
+        with open(vectors_path, "wb") as vectors_file, open(text_path, "wb") as text_file:
+            for name, pages in shards:
+                start = len(ids)
+                for page_ids, embeddings, documents, page_metadatas in pages:
+                    vectors = _unit_rows(np.asarray(embeddings, dtype=np.float32))
+                    dimensions = dimensions or vectors.shape[1]
+                    if vectors.shape[1] != dimensions:
+                        raise ValueError(f"Expected {dimensions}-dimensional vectors, got {vectors.shape[1]}")
+                    vectors_file.write(vectors.tobytes())
+                    for document in documents:
+                        encoded = (document or "").encode("utf-8")
+                        text_file.write(encoded)
+                        text_offsets.append(text_offsets[-1] + len(encoded))
+                    ids += page_ids
+                    metadatas += [metadata or {} for metadata in page_metadatas]
+                ranges.append({"name": name, "start": start, "rows": len(ids) - start})
+
+        keys = sorted({key for metadata in metadatas for key in metadata})
+        sections = [
+            ("vectors", vectors_path, "float32", [len(ids), dimensions]),
+            ("text.offsets", np.asarray(text_offsets, dtype=np.uint64), "uint64", [len(ids) + 1]),
+            ("text", text_path, "uint8", [text_offsets[-1]]),
+        ]
+        sections += _column("ids", [chunk_id.encode("utf-8") for chunk_id in ids])
+        for key in keys:
+            sections += _column(f"metadata.{key}", [
+                json.dumps(metadata[key], ensure_ascii=False).encode("utf-8") if key in metadata else b""
+                for metadata in metadatas
+            ])
+        order = np.asarray(sorted(range(len(ids)), key=ids.__getitem__), dtype=np.uint32)
+        sections.append(("ids.order", order, "uint32", [len(ids)]))
+
+        # Sections go to a scratch body first: the header carries their checksum.
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "created_at": time.time(),
+            "corpus_version": corpus_version,
+            "rows": len(ids),
+            "dimensions": dimensions,
+            "shards": ranges,
+            "metadata_keys": keys,
+            "sections": {},
+        }
+        digest = hashlib.sha256()
+        body_path = os.path.join(scratch, "body")
+        with open(body_path, "wb") as body:
+            for name, data, dtype, shape in sections:
+                body.write(b"\0" * (-body.tell() % ALIGNMENT))
+                offset = body.tell()
+                if isinstance(data, np.ndarray):
+                    body.write(data.tobytes())
+                else:
+                    with open(data, "rb") as file:
+                        shutil.copyfileobj(file, body, 1 << 20)
+                header["sections"][name] = {"offset": offset, "length": body.tell() - offset,
+                                            "dtype": dtype, "shape": shape}
+        with open(body_path, "rb") as body:
+            for block in iter(lambda: body.read(1 << 20), b""):
+                digest.update(block)
+        header["sha256"] = digest.hexdigest()
+
+        encoded = json.dumps(header).encode("utf-8")
+        prefix = MAGIC + struct.pack("<Q", len(encoded)) + encoded
+        with open(path + ".tmp", "wb") as file, open(body_path, "rb") as body:
+            file.write(prefix + b"\0" * (-len(prefix) % ALIGNMENT))
+            shutil.copyfileobj(body, file, 1 << 20)
+        os.replace(path + ".tmp", path)
+    return header
+
+
+def _column(name, values):
+    offsets = np.zeros(len(values) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(value) for value in values], dtype=np.uint64)
+    return [
+        (f"{name}.offsets", offsets, "uint64", [len(values) + 1]),
+        (name, np.frombuffer(b"".join(values), dtype=np.uint8), "uint8", [int(offsets[-1])]),
+    ]
+
+
+class Snapshot:
+    # A snapshot file opened read-only. Opening reads only the header; the
+    # sections are views on one memory map.
+
+    def __init__(self, path, verify=False):
+        self.path = path
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a snapshot")
+            (length,) = struct.unpack("<Q", file.read(8))
+            self.header = json.loads(file.read(length))
+        if self.header["format"] != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} has snapshot format {self.header['format']}, expected {SNAPSHOT_FORMAT}")
+        prefix = len(MAGIC) + 8 + length
+        self.data_offset = prefix + -prefix % ALIGNMENT
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        self._sections = {}
+        self.rows = self.header["rows"]
+        self.vectors = self.section("vectors")
+        if verify:
+            self.verify()
+
+    def section(self, name):
+        if name not in self._sections:
+            info = self.header["sections"][name]
+            start = self.data_offset + info["offset"]
+            self._sections[name] = self._map[start:start + info["length"]].view(info["dtype"]).reshape(info["shape"])
+        return self._sections[name]
+
+    def verify(self):
+        digest = hashlib.sha256()
+        for start in range(self.data_offset, len(self._map), 1 << 20):
+            digest.update(self._map[start:start + (1 << 20)])
+        if digest.hexdigest() != self.header["sha256"]:
+            raise ValueError(f"{self.path} is corrupt: checksum mismatch")
+
+    def value(self, column, row):
+        offsets = self.section(f"{column}.offsets")
+        return bytes(self.section(column)[int(offsets[row]):int(offsets[row + 1])]).decode("utf-8")
+
+    def metadata(self, row):
+        metadata = {}
+        for key in self.header["metadata_keys"]:
+            value = self.value(f"metadata.{key}", row)
+            if value:
+                metadata[key] = json.loads(value)
+        return metadata
+
+    def document(self, row):
+        return Document(page_content=self.value("text", row), metadata=self.metadata(row))
+
+    def row_of(self, chunk_id):
+        # Binary search over the rows in ID order; None when absent.
+        order = self.section("ids.order")
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.value("ids", int(order[middle])) < chunk_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(order) and self.value("ids", int(order[low])) == chunk_id:
+            return int(order[low])
+        return None
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def open_snapshot(path):
+    # Shared by every shard's store. Keyed on the file's identity, so a
+    # snapshot imported over it is opened afresh; the replaced one is
+    # released once no store uses it.
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_ino, stat.st_mtime_ns)
+    with _snapshots_lock:
+        if key not in _snapshots:
+            for stale in [other for other in _snapshots if other[0] == path]:
+                del _snapshots[stale]
+            _snapshots[key] = Snapshot(path)
+        return _snapshots[key]
+
+
+class SnapshotStore:
+    # One shard of a snapshot behind the vector store interface, read-only.
+    # A shard is a contiguous block of rows, so its search scans only them.
+    # Every read first checks the file's identity, so a store open in a
+    # running replica serves a newly imported snapshot, as its BM25 index does.
+
+    def __init__(self, path, collection_name, embedding_function=None):
+        self.path = path
+        self.collection_name = collection_name
+        self.embedding_function = embedding_function
+        self.max_batch_size = 5000
+        self._shard = None
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        raise RuntimeError("Snapshot stores are read-only; export a new snapshot instead")
+
+    def delete(self, ids):
+        raise RuntimeError("Snapshot stores are read-only; export a new snapshot instead")
+
+    def update_metadata(self, ids, metadatas):
+        raise RuntimeError("Snapshot stores are read-only; export a new snapshot instead")
+
+    def drop(self):
+        raise RuntimeError("Snapshot stores are read-only; export a new snapshot instead")
+
+    def count(self):
+        return self._refresh().rows
+
+    def search(self, query_embeddings, k=5, where=None):
+        queries = _unit_rows(np.asarray(query_embeddings, dtype=np.float32))
+        shard = self._refresh()
+        if not shard.rows:
+            return [[] for _ in queries]
+        vectors = shard.snapshot.vectors[shard.start:shard.start + shard.rows]
+        mask = np.ones(shard.rows, dtype=bool) if where is None else shard.filter_mask(where)
+        positions, scores = _blocked_top_k(vectors, queries, k, mask)
+        return [
+            [(shard.snapshot.document(shard.start + int(position)), float(score))
+             for position, score in zip(row_positions, row_scores)]
+            for row_positions, row_scores in zip(positions, scores)
+        ]
+
+    def iter_documents(self, page_size=1000):
+        for ids, _vectors, documents, metadatas in self.iter_rows(page_size):
+            yield ids, documents, metadatas
+
+    def iter_rows(self, page_size=1000):
+        shard = self._refresh()
+        snapshot, end = shard.snapshot, shard.start + shard.rows
+        for start in range(shard.start, end, page_size):
+            rows = range(start, min(start + page_size, end))
+            documents = [snapshot.document(row) for row in rows]
+            yield ([snapshot.value("ids", row) for row in rows],
+                   np.asarray(snapshot.vectors[rows.start:rows.stop]),
+                   [document.page_content for document in documents],
+                   [document.metadata for document in documents])
+
+    def optimize(self):
+        pass
+
+    def _refresh(self):
+        # The shard of the snapshot file currently at `path`.
+        snapshot = open_snapshot(self.path)
+        with self._lock:
+            if self._shard is None or self._shard.snapshot is not snapshot:
+                self._shard = _SnapshotShard(snapshot, self.collection_name)
+            return self._shard
+
+
+class _SnapshotShard:
+    # A shard's rows in one opened snapshot, with its filter masks.
+
+    def __init__(self, snapshot, name):
+        shard = next((shard for shard in snapshot.header["shards"] if shard["name"] == name),
+                     {"start": 0, "rows": 0})
+        self.snapshot = snapshot
+        self.start = shard["start"]
+        self.rows = shard["rows"]
+        self._filter_cache = {}
+
+    def filter_mask(self, where):
+        # Equality filters on metadata fields; each reads only its own column.
+        key = json.dumps(where, sort_keys=True)
+        if key not in self._filter_cache:
+            mask = np.ones(self.rows, dtype=bool)
+            for field, expected in where.items():
+                if field not in self.snapshot.header["metadata_keys"]:
+                    mask[:] = False
+                    break
+                for offset in np.flatnonzero(mask):
+                    value = self.snapshot.value(f"metadata.{field}", self.start + int(offset))
+                    mask[offset] = bool(value) and json.loads(value) == expected
+            self._filter_cache[key] = mask
+        return self._filter_cache[key]
+
+
+def export_snapshot(output, chroma_path=CHROMA_PATH, backend=None):
+    # Every shard of the store in `chroma_path`, in shard order.
+    names = read_shard_names(chroma_path)
+    stores = [(name, get_vector_store(backend, persist_directory=chroma_path, collection_name=name))
+              for name in names]
+    return write_snapshot(output, ((name, store.iter_rows()) for name, store in stores),
+                          read_corpus_version(chroma_path))
+
+
+def import_snapshot(path, chroma_path=CHROMA_PATH, lexical=True):
+    # Checks the snapshot, installs it in `chroma_path` with its shard list
+    # and corpus version, and (unless `lexical` is off) rebuilds the BM25
+    # indexes from its text, so the replica can serve hybrid search.
+    snapshot = Snapshot(path, verify=True)
+    os.makedirs(chroma_path, exist_ok=True)
+    target = os.path.join(chroma_path, SNAPSHOT_FILE)
+    if not (os.path.exists(target) and os.path.samefile(path, target)):
+        shutil.copyfile(path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+    names = [shard["name"] for shard in snapshot.header["shards"]]
+    if lexical:
+        lexical_index = ShardedLexicalIndex(chroma_path, names)
+        lexical_index.clear()
+        for name in names:
+            for ids, _vectors, documents, metadatas in SnapshotStore(target, name).iter_rows():
+                lexical_index.index(name).upsert(ids, documents, metadatas)
+        lexical_index.commit()
+    write_shard_names(chroma_path, names)
+    write_corpus_version(chroma_path, snapshot.header["corpus_version"])
+    return snapshot.header
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Write the vector store to a snapshot file.")
+    export.add_argument("output")
+    export.add_argument("--backend", help="Backend the store was built with (default: VECTOR_STORE_BACKEND).")
+    restore = commands.add_parser("import", help="Install a snapshot to serve with VECTOR_STORE_BACKEND=snapshot.")
+    restore.add_argument("snapshot")
+    restore.add_argument("--no-lexical", action="store_true", help="Do not rebuild the BM25 indexes.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "export":
+        header = export_snapshot(args.output, backend=args.backend)
+        size = os.path.getsize(args.output)
+        print(f"📸 Wrote {args.output}: {header['rows']} chunks in {len(header['shards'])} shards, "
+              f"{size / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s")
+    else:
+        header = import_snapshot(args.snapshot, lexical=not args.no_lexical)
+        print(f"📦 Imported {args.snapshot}: {header['rows']} chunks in {len(header['shards'])} shards "
+              f"in {time.perf_counter() - start:.1f}s; serve it with VECTOR_STORE_BACKEND=snapshot")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+from answer_cache import AnswerCache
+from ingest_manifest import bump_corpus_version
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(tmp_path, **kwargs):
+    return AnswerCache(path=str(tmp_path / "answers.sqlite3"), chroma_path=str(tmp_path / "chroma"), **kwargs)
+
+
+def test_exact_and_near_duplicate_hits(tmp_path):
+    cache = make_cache(tmp_path, threshold=0.95)
+    cache.put("Fosfomicina na grávida?", [1.0, 0.0, 0.0], "fosfomicina 3g", ["a:1:0"],
+              prompt_tokens=900, completion_tokens=100)
+
+    assert cache.lookup("fosfomicina  na grávida?", [0.0, 1.0, 0.0]) is None
+    assert cache.lookup("Fosfomicina na grávida?", [0.0, 1.0, 0.0])["response"] == "fosfomicina 3g"
+    assert cache.lookup("fosfomicina em grávidas", [0.99, 0.05, 0.0])["sources"] == ["a:1:0"]
+    assert cache.lookup("pielonefrite", [0.5, 0.5, 0.7]) is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["hit_rate"] == 0.5
+    assert stats["saved_prompt_tokens"] == 1800
+
+
+def test_ttl_and_lru_eviction(tmp_path):
+    clock = Clock()
+    cache = make_cache(tmp_path, ttl_seconds=60, max_entries=2, clock=clock)
+    cache.put("a", [1.0, 0.0, 0.0], "A", [])
+    clock.now += 1
+    cache.put("b", [0.0, 1.0, 0.0], "B", [])
+    clock.now += 1
+    assert cache.lookup("a", [1.0, 0.0, 0.0])["response"] == "A"
+
+    clock.now += 1
+    cache.put("c", [0.0, 0.0, 1.0], "C", [])
+    assert cache.lookup("b", [0.0, 1.0, 0.0]) is None
+    assert cache.stats()["entries"] == 2
+
+    clock.now += 120
+    assert cache.lookup("a", [1.0, 0.0, 0.0]) is None
+
+
+def test_survives_restart_and_drops_entries_when_corpus_changes(tmp_path):
+    bump_corpus_version(str(tmp_path / "chroma"))
+    make_cache(tmp_path).put("a", [1.0, 0.0], "A", ["x:0:0"])
+
+    cache = make_cache(tmp_path)
+    assert cache.lookup("a", [1.0, 0.0])["response"] == "A"
+
+    bump_corpus_version(str(tmp_path / "chroma"))
+    assert cache.lookup("a", [1.0, 0.0]) is None
+    assert make_cache(tmp_path).stats()["entries"] == 0
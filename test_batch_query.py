@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+import pytest
+from langchain_chroma import Chroma
+
+from answer_cache import AnswerCache
+from batch_query import read_questions, run_batch
+from benchmarks.stubs import AsyncStubChatClient, StubEmbeddings
+from lexical_index import LexicalIndex
+from query_data import COLLECTION_NAME, RagEngine
+from reranker import LexicalScorer, Reranker
+
+CHUNKS = {
+    "data/norma.pdf:3:0": "Bacteriúria assintomática na grávida: fosfomicina 3g em toma única.",
+    "data/norma.pdf:5:0": "Cistite recorrente: considerar profilaxia.",
+    "data/norma.pdf:6:0": "Pielonefrite aguda: ceftriaxona e urocultura.",
+}
+QUESTIONS = ["fosfomicina na grávida", "cistite recorrente", "pielonefrite aguda", "profilaxia", "urocultura"]
+
+
+class CountingEmbeddings(StubEmbeddings):
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(len(texts))
+        return super().embed_documents(texts)
+
+
+class FlakyChatClient(AsyncStubChatClient):
+    # Fails for questions mentioning `fail_on`; tracks completions in flight.
+    fail_on = None
+    in_flight = 0
+    max_in_flight = 0
+
+    async def _create(self, model, messages, stream=False, **kwargs):
+        cls = FlakyChatClient
+        cls.in_flight += 1
+        cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            if cls.fail_on and cls.fail_on in messages[0]["content"].rsplit("---", 1)[-1]:
+                raise ConnectionError("connection reset")
+            return await super()._create(model, messages, stream, **kwargs)
+        finally:
+            cls.in_flight -= 1
+
+
+@pytest.fixture
+def engine(tmp_path):
+    embeddings = CountingEmbeddings()
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=str(tmp_path))
+    db.add_texts(list(CHUNKS.values()), metadatas=[{"id": chunk_id} for chunk_id in CHUNKS], ids=list(CHUNKS))
+    lexical_index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    lexical_index.upsert(list(CHUNKS), list(CHUNKS.values()), [{"id": chunk_id} for chunk_id in CHUNKS])
+    lexical_index.commit()
+    embeddings.batches.clear()
+    FlakyChatClient.fail_on = None
+    FlakyChatClient.max_in_flight = 0
+    return RagEngine(persist_directory=str(tmp_path), embedding_function=embeddings,
+                     async_client_factory=lambda api_key: FlakyChatClient(api_key, latency=0.02),
+                     lexical_index=lexical_index, reranker=Reranker(LexicalScorer()), report_context=False)
+
+
+def test_retrieve_many_matches_retrieve(engine):
+    batched = engine.retrieve_many(QUESTIONS, k=2)
+    engine.reranker = Reranker(LexicalScorer())  # cold cache, so nothing is reused
+    assert engine.embedding_function.batches == [len(QUESTIONS)]
+    for question, results in zip(QUESTIONS, batched):
+        assert results == engine.retrieve(question, k=2)
+
+
+def test_batch_writes_answers_and_resumes(engine, tmp_path):
+    questions_path = tmp_path / "questions.csv"
+    questions_path.write_text("id,question\n" + "".join(f"q{i},{q}\n" for i, q in enumerate(QUESTIONS)),
+                              encoding="utf-8")
+    output = str(tmp_path / "answers.jsonl")
+    questions = read_questions(str(questions_path))
+
+    FlakyChatClient.fail_on = "pielonefrite"
+    summary = asyncio.run(run_batch(engine, questions, "sk-a", output, concurrency=2, batch_size=3))
+    assert (summary["answered"], summary["failed"]) == (4, 1)
+    assert engine.embedding_function.batches == [3, 2]
+    assert FlakyChatClient.max_in_flight == 2
+
+    with open(output, encoding="utf-8") as file:
+        records = {record["id"]: record for record in map(json.loads, file)}
+    assert records["q2"]["error"] == "ConnectionError: connection reset"
+    assert records["q0"]["sources"][0] == "data/norma.pdf:3:0" and records["q0"]["response"]
+    assert set(records["q0"]["timings"]) == {"embed", "search", "queue", "prompt", "generate", "total"}
+    assert records["q0"]["usage"]["prompt_tokens"] > 0 and records["q0"]["usage"]["model"] == "gpt-4o"
+
+    # Only the failed question is asked again, and its old line is replaced.
+    FlakyChatClient.fail_on = None
+    summary = asyncio.run(run_batch(engine, questions, "sk-a", output))
+    assert (summary["skipped"], summary["answered"], summary["failed"]) == (4, 1, 0)
+    with open(output, encoding="utf-8") as file:
+        records = [json.loads(line) for line in file]
+    assert sorted(record["id"] for record in records) == [f"q{i}" for i in range(5)]
+    assert not any("error" in record for record in records)
+
+
+def test_batch_serves_repeated_questions_from_the_answer_cache(engine, tmp_path):
+    engine.answer_cache = AnswerCache(path=str(tmp_path / "answers.sqlite3"), chroma_path=str(tmp_path))
+    questions = [{"id": str(i), "question": question} for i, question in enumerate(QUESTIONS[:2])]
+    asyncio.run(run_batch(engine, questions, "sk-a", str(tmp_path / "first.jsonl")))
+    summary = asyncio.run(run_batch(engine, questions, "sk-a", str(tmp_path / "second.jsonl")))
+    assert summary["cached"] == 2 and summary["prompt_tokens"] == 0
+
+
+def test_questions_need_unique_ids(tmp_path):
+    path = tmp_path / "questions.jsonl"
+    path.write_text('{"question": "a"}\n{"id": "1", "question": "b"}\n', encoding="utf-8")
+    with pytest.raises(ValueError, match="duplicate question id 1"):
+        read_questions(str(path))
+
+
+def test_zero_is_a_question_id(tmp_path):
+    path = tmp_path / "questions.jsonl"
+    path.write_text('{"id": 0, "question": "a"}\n{"question": "b"}\n', encoding="utf-8")
+    assert [question["id"] for question in read_questions(str(path))] == ["0", "2"]
+
+
+def test_lines_that_are_not_objects_are_reported(tmp_path):
+    path = tmp_path / "questions.jsonl"
+    path.write_text('{"question": "a"}\n\n"b"\n', encoding="utf-8")
+    with pytest.raises(ValueError, match=r"questions.jsonl:3: expected an object .* got str"):
+        read_questions(str(path))
+    path.write_text('{"question": "a"}\n{"question": \n', encoding="utf-8")
+    with pytest.raises(ValueError, match=r"questions.jsonl:2: invalid JSON"):
+        read_questions(str(path))
@@ -0,0 +1,43 @@
+from streamlit.testing.v1 import AppTest
+
+from chat_history import page_markdown
+from chat_store import ChatStore
+
+
+def history_app(path, page_size):
+    from chat_history import load_history, render_history
+    from chat_store import ChatStore
+    import streamlit as st
+
+    store = ChatStore(path)
+    if "messages" not in st.session_state:
+        load_history(store, "ana", page_size=page_size)
+    render_history(store, "ana", page_size=page_size)
+
+
+def make_history(tmp_path, count):
+    path = str(tmp_path / "chat.sqlite3")
+    store = ChatStore(path)
+    store.create_user("ana", "hash", "key")
+    store.append_messages("ana", [{"role": "user", "content": f"m{i}"} for i in range(1, count + 1)])
+    return path
+
+
+def test_renders_latest_page_and_loads_older_on_demand(tmp_path):
+    app = AppTest.from_function(history_app, args=(make_history(tmp_path, 25), 10)).run()
+    assert [message.markdown[0].value for message in app.chat_message] == [f"m{i}" for i in range(16, 26)]
+
+    app.button(key="load_older_messages").click().run()
+    assert len(app.chat_message) == 10
+    assert len(app.expander) == 1
+    assert "m6" in app.expander[0].markdown[0].value and "m15" in app.expander[0].markdown[0].value
+
+    app.button(key="load_older_messages").click().run()
+    assert [expander.label for expander in app.expander] == ["Messages 1–5", "Messages 6–15"]
+    assert not app.button
+
+
+def test_page_markdown_is_built_once():
+    page = ((1, "user", "olá"), (2, "assistant", "bom dia"))
+    assert page_markdown(page) is page_markdown(page)
+    assert "🧑 **You**\n\nolá" in page_markdown(page)
@@ -0,0 +1,94 @@
+import json
+import threading
+
+from chat_store import ChatStore
+
+
+def make_store(tmp_path):
+    return ChatStore(str(tmp_path / "chat.sqlite3"))
+
+
+def test_users_and_preferences(tmp_path):
+    store = make_store(tmp_path)
+    assert store.create_user("ana", "hash", "key")
+    assert not store.create_user("ana", "other", "other")
+    assert store.get_user("ana") == {
+        "password": "hash", "api_key": "key", "receive_forwarded_messages": True, "logged_in": False,
+    }
+    assert store.get_user("rui") is None
+
+    store.set_logged_in("ana", True)
+    store.set_receive_forwarded_messages("ana", False)
+    reopened = make_store(tmp_path)
+    assert reopened.logged_in_user() == "ana"
+    assert reopened.get_user("ana")["receive_forwarded_messages"] is False
+
+
+def test_paginated_history(tmp_path):
+    store = make_store(tmp_path)
+    store.create_user("ana", "hash", "key")
+    store.create_user("rui", "hash", "key")
+    for i in range(5):
+        store.append_messages("ana", [{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}])
+    store.append_messages("rui", [{"role": "user", "content": "other"}])
+
+    page = store.messages("ana", limit=4)
+    assert [message["content"] for message in page] == ["q3", "a3", "q4", "a4"]
+    older = store.messages("ana", limit=4, before=page[0]["seq"])
+    assert [message["content"] for message in older] == ["q1", "a1", "q2", "a2"]
+    assert len(store.all_messages("ana")) == store.count_messages("ana") == 10
+
+    store.clear_messages("ana")
+    assert store.messages("ana") == []
+    assert store.count_messages("rui") == 1
+
+
+def test_forward_respects_preference(tmp_path):
+    store = make_store(tmp_path)
+    store.create_user("ana", "hash", "key")
+    store.create_user("rui", "hash", "key", receive_forwarded_messages=False)
+
+    assert store.forward("rui", "ana", "pergunta", "resposta")
+    assert [message["content"] for message in store.all_messages("ana")] == [
+        "🔄 [Forwarded from rui]: pergunta", "🔄 [Forwarded from rui]: resposta",
+    ]
+    assert not store.forward("ana", "rui", "pergunta", "resposta")
+    assert not store.forward("ana", "nobody", "pergunta", "resposta")
+
+
+def test_migrates_json_once(tmp_path):
+    users = {
+        "ana": {"password": "h1", "api_key": "k1", "logged_in": True, "receive_forwarded_messages": False,
+                "messages": [{"role": "user", "content": "olá"}, {"role": "assistant", "content": "olá!"}]},
+        "rui": {"password": "h2", "api_key": "k2", "messages": []},
+    }
+    json_path = tmp_path / "users_data.json"
+    json_path.write_text(json.dumps(users))
+
+    store = make_store(tmp_path)
+    assert store.migrate_from_json(str(json_path)) == 2
+    assert store.migrate_from_json(str(json_path)) == 0
+    assert store.logged_in_user() == "ana"
+    assert store.get_user("ana")["receive_forwarded_messages"] is False
+    assert [message["content"] for message in store.all_messages("ana")] == ["olá", "olá!"]
+    assert store.usernames() == ["ana", "rui"]
+
+
+def test_concurrent_sessions_do_not_lose_messages(tmp_path):
+    make_store(tmp_path).create_user("ana", "hash", "key")
+
+    def session(worker):
+        # Separate connections, as separate server processes would have.
+        store = make_store(tmp_path)
+        for i in range(25):
+            store.append_messages("ana", [{"role": "user", "content": f"{worker}-{i}"}])
+
+    threads = [threading.Thread(target=session, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    messages = make_store(tmp_path).all_messages("ana")
+    assert len(messages) == 100
+    assert [message["seq"] for message in messages] == list(range(1, 101))
@@ -0,0 +1,76 @@
+from langchain_core.documents import Document
+
+from chunker import StructuredChunker, normalize_pages, parse_blocks
+
+SOURCE = "data/norma.pdf"
+PROSE = ("A cistite não complicada na mulher é definida como episódio agudo de infeção da bexiga. "
+         "O tratamento empírico deve considerar as resistências locais. ")
+TABLE = ["População Fármaco Dose Duração", "Cistite aguda não", "complicada da mulher",
+         "Fosfomicina 3000 mg /dia 1 dia A‐I", "Nitrofurantoína 100 mg 6/6 horas"]
+
+
+def pages(*texts):
+    # The running header every PDF page carries, as PyPDF extracts it.
+    return [Document(page_content=f"Norma\xa0nº\xa0015/2011\xa0\xa0 {page + 1}/{len(texts)}\n{text}",
+                     metadata={"source": SOURCE, "page": page, "page_label": str(page + 1)})
+            for page, text in enumerate(texts)]
+
+
+def test_running_headers_are_dropped_and_lines_cleaned():
+    lines = normalize_pages([document.page_content for document in pages("a\xa0 b", "\n", "c")])
+    assert lines == [["a b"], [""], ["c"]]
+
+
+def test_blocks_continue_over_page_breaks():
+    document = pages(
+        "I – NORMA\na) A urocultura está recomendada na grávida e no homem, e nas infeções com\n" + TABLE[0],
+        "\n".join(TABLE[1:]) + "\n\nnuma amostra de urina colhida em condições de assepsia, num doente\nassinto‐",
+        "mático.",
+    )
+    blocks = parse_blocks(normalize_pages([page.page_content for page in document]))
+    assert [block.kind for block in blocks] == ["heading", "list", "table", "paragraph"]
+    # The table starts on the first page and carries on after the header of the second.
+    assert blocks[2].units == TABLE and (blocks[2].page, blocks[2].page_end) == (0, 1)
+    # A hyphenated word wrapped onto the next page is joined back.
+    assert blocks[3].units == ["numa amostra de urina colhida em condições de assepsia, num doente assinto‐mático."]
+    assert (blocks[3].page, blocks[3].page_end) == (1, 2)
+
+
+def test_sections_lists_and_tables_are_kept_together():
+    items = "\n".join(f"{letter}) item {letter} da lista de critérios a cumprir;" for letter in "abcde")
+    document = pages(
+        f"I – NORMA\n{PROSE}\n\n{items}",
+        "II – ANEXO\n\n" + "\n".join(TABLE) + f"\n\n{PROSE * 3}",
+    )
+    chunks = StructuredChunker(chunk_size=300, chunk_overlap=100).split_documents(document)
+
+    assert all(len(chunk.page_content) <= 300 for chunk in chunks)
+    assert chunks[0].page_content.startswith("I – NORMA\nA cistite")
+    # The list did not fit after the paragraph, so it moved whole.
+    assert chunks[1].page_content == items and chunks[1].metadata["headings"] == "I – NORMA"
+    assert chunks[2].page_content.startswith("II – ANEXO\n" + "\n".join(TABLE) + "\nA cistite")
+    assert chunks[2].metadata["headings"] == "II – ANEXO" and chunks[2].metadata["page"] == 1
+    # Long paragraphs are split between sentences and repeat the last one.
+    assert chunks[3].page_content.endswith(chunks[4].page_content.split(". ")[0] + ".")
+    assert "page_label" not in chunks[0].metadata and chunks[0].metadata["source"] == SOURCE
+
+
+def test_token_sizing():
+    chunker = StructuredChunker(chunk_size=40, unit="tokens")
+    chunks = chunker.split_documents(pages(PROSE * 4))
+    assert len(chunks) > 2
+    assert all(chunker.length(chunk.page_content) <= 44 for chunk in chunks)
+
+
+def test_ids_follow_the_content_not_the_position():
+    before = StructuredChunker(chunk_size=200).split_documents(
+        pages(f"I – NORMA\n{PROSE}", f"II – CRITÉRIOS\n{PROSE}\n\nIII – AVALIAÇÃO\nContínua.")
+    )
+    after = StructuredChunker(chunk_size=200).split_documents(
+        pages(f"I – NORMA\nNovo parágrafo.\n\n{PROSE}", f"II – CRITÉRIOS\n{PROSE}\n\nIII – AVALIAÇÃO\nContínua.")
+    )
+    ids_before = [chunk.metadata["id"] for chunk in before]
+    ids_after = [chunk.metadata["id"] for chunk in after]
+    assert ids_before[0] != ids_after[0]
+    assert ids_before[1:] == ids_after[1:]
+    assert len(set(ids_after)) == len(ids_after) and ids_after[0].startswith(SOURCE + "#")
@@ -0,0 +1,83 @@
+from langchain_core.documents import Document
+
+from chunker import StructuredChunker
+from context_builder import SEPARATOR, ContextBuilder, approximate_tokens, merge_overlap, parse_chunk_id
+from populate_database import calculate_chunk_ids, split_documents
+
+PAGE = (
+    "A bacteriúria assintomática na grávida deve ser tratada. A terapêutica de primeira linha é a "
+    "fosfomicina 3g em toma única, ou em alternativa a amoxicilina com ácido clavulânico durante sete dias. "
+    "Deve ser feita urocultura de controlo uma a duas semanas após o fim do tratamento. "
+    "Na pielonefrite aguda deve iniciar-se antibioterapia empírica após colheita de urina para urocultura. "
+    "A cistite recorrente pode justificar profilaxia antibiótica contínua ou pós-coital."
+)
+
+
+def builder(**kwargs):
+    return ContextBuilder(count_tokens=approximate_tokens, **kwargs)
+
+
+def ranked(chunks, order):
+    return [(chunks[i], 1.0 - 0.1 * rank) for rank, i in enumerate(order)]
+
+
+def page_chunks():
+    documents = [Document(page_content=PAGE, metadata={"source": "data/norma.pdf", "page": 3})]
+    return calculate_chunk_ids(split_documents(documents, chunk_size=160, chunk_overlap=60))
+
+
+def test_parse_chunk_id():
+    assert parse_chunk_id("data/norma.pdf:3:2") == ("data/norma.pdf:3", 2)
+    assert parse_chunk_id("chunk-without-index") is None
+    assert parse_chunk_id(None) is None
+
+
+def test_neighbouring_chunks_are_stitched_back_together():
+    chunks = page_chunks()
+    assert len(chunks) >= 3
+    merged, overlap = merge_overlap(chunks[0].page_content, chunks[1].page_content)
+    assert overlap > 0 and merged in PAGE
+
+    # Retrieved out of order, the three chunks still come back as the page text.
+    context = builder().build(ranked(chunks, [1, 0, 2]))
+    assert context["merged"] == 2
+    assert context["text"] == merge_overlap(merged, chunks[2].page_content)[0]
+    assert SEPARATOR not in context["text"]
+    assert context["sources"] == [chunk.metadata["id"] for chunk in (chunks[1], chunks[0], chunks[2])]
+    assert context["tokens_saved"] > 0
+
+
+def test_near_duplicates_from_other_files_are_dropped():
+    copy = Document(page_content=PAGE.replace("3g", "3 g"), metadata={"id": "data/copia.pdf:0:0"})
+    original = Document(page_content=PAGE, metadata={"id": "data/norma.pdf:3:0"})
+    other = Document(page_content="Cistite na criança: colher urina por saco coletor.", metadata={"id": "data/ped.pdf:1:0"})
+    context = builder().build([(original, 0.9), (copy, 0.8), (other, 0.7)])
+    assert context["duplicates"] == 1
+    assert context["sources"] == ["data/norma.pdf:3:0", "data/ped.pdf:1:0"]
+    assert context["tokens_saved"] >= approximate_tokens(PAGE)
+
+
+def test_budget_is_filled_in_rank_order():
+    documents = [Document(page_content=f"{word} " * 40, metadata={"id": f"data/{word}.pdf:0:0"})
+                 for word in ("cistite", "pielonefrite", "uretrite", "prostatite")]
+    # Each passage is ~100 tokens: only the two best ranked fit in 220.
+    budgeted = builder(token_budget=220)
+    context = budgeted.build([(doc, 0) for doc in documents])
+    assert context["sources"] == ["data/cistite.pdf:0:0", "data/pielonefrite.pdf:0:0"]
+    assert context["over_budget"] == 2
+    assert context["tokens"] <= 220
+    assert budgeted.stats() == {"queries": 1, "context_tokens": context["tokens"],
+                                "tokens_saved": context["tokens_saved"]}
+
+
+def test_whole_document_chunks_are_stitched_back_together():
+    pages = [Document(page_content=PAGE, metadata={"source": "data/norma.pdf", "page": 3})]
+    chunks = StructuredChunker(chunk_size=250, chunk_overlap=140).split_documents(pages)
+    assert len(chunks) >= 3 and all("#" in chunk.metadata["id"] for chunk in chunks)
+    assert merge_overlap(chunks[0].page_content, chunks[1].page_content)[1] > 0
+
+    context = builder().build(ranked(chunks, [1, 0, 2]))
+    assert context["merged"] == 2 and context["tokens_saved"] > 0
+    assert SEPARATOR not in context["text"]
+    # Each overlapping sentence is in the prompt once.
+    assert context["text"].count("urocultura de controlo") == 1
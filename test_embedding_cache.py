@@ -0,0 +1,67 @@
+from langchain_core.embeddings import Embeddings
+
+from embedding_function import CachedEmbeddings
+
+
+class FakeEmbeddings(Embeddings):
+
+    def __init__(self):
+        self.calls = 0
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts.extend(texts)
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def test_repeated_texts_are_served_from_cache(tmp_path):
+    fake = FakeEmbeddings()
+    embeddings = CachedEmbeddings(fake, model="fake", cache_path=tmp_path / "cache.sqlite3")
+
+    first = embeddings.embed_documents(["bacteriúria", "cistite", "bacteriúria"])
+    second = embeddings.embed_documents(["cistite", "  bacteriúria "])
+
+    assert fake.texts == ["bacteriúria", "cistite"]
+    assert second == [first[1], first[0]]
+    assert embeddings.stats()["hits"] == 3
+    assert embeddings.stats()["misses"] == 2
+
+
+def test_cache_survives_restart_with_zero_backend_calls(tmp_path):
+    cache_path = tmp_path / "cache.sqlite3"
+    texts = [f"chunk {i}" for i in range(20)]
+
+    vectors = CachedEmbeddings(FakeEmbeddings(), model="fake", cache_path=cache_path).embed_documents(texts)
+
+    fake = FakeEmbeddings()
+    reopened = CachedEmbeddings(fake, model="fake", cache_path=cache_path, max_memory_items=5)
+    assert reopened.embed_documents(texts) == vectors
+    assert reopened.embed_query("chunk 3") == vectors[3]
+    assert fake.calls == 0
+    assert len(reopened._memory) == 5
+
+
+def test_cache_is_keyed_by_model(tmp_path):
+    cache_path = tmp_path / "cache.sqlite3"
+    CachedEmbeddings(FakeEmbeddings(), model="small", cache_path=cache_path).embed_query("DGS")
+
+    fake = FakeEmbeddings()
+    CachedEmbeddings(fake, model="large", cache_path=cache_path).embed_query("DGS")
+    assert fake.calls == 1
+
+
+def test_only_cache_misses_report_billed_tokens(tmp_path):
+    class MeteredEmbeddings(FakeEmbeddings):
+        def embed_documents_with_usage(self, texts):
+            return self.embed_documents(texts), sum(len(text.split()) for text in texts)
+
+    embeddings = CachedEmbeddings(MeteredEmbeddings(), model="fake", cache_path=tmp_path / "cache.sqlite3")
+    assert embeddings.embed_documents_with_usage(["cistite aguda", "pielonefrite"])[1] == 3
+    assert embeddings.embed_documents_with_usage(["cistite aguda", "urocultura"])[1] == 1
+    # A backend without usage reporting counts as zero.
+    plain = CachedEmbeddings(FakeEmbeddings(), model="fake", cache_path=tmp_path / "plain.sqlite3")
+    assert plain.embed_query_with_usage("cistite")[1] == 0
@@ -0,0 +1,82 @@
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from openai import OpenAI
+
+from benchmarks.fake_openai_server import FakeOpenAIServer, fake_embedding
+from embedding_function import UsageTrackingOpenAIEmbeddings
+from embedding_writer import EmbeddingWriter, TokenBucket
+
+
+def make_chunks(count, source="data/a.pdf"):
+    return [
+        Document(page_content=f"recomendação {i}", metadata={"id": f"{source}:0:{i}", "source": source})
+        for i in range(count)
+    ]
+
+
+def test_writer_survives_rate_limits_with_bounded_concurrency():
+    stored = {}
+
+    def upsert(ids, embeddings, documents, metadatas):
+        stored.update(zip(ids, embeddings))
+
+    with FakeOpenAIServer(latency=0.05, rate_limit_every=3) as server:
+        embeddings = UsageTrackingOpenAIEmbeddings(OpenAI(base_url=server.url, api_key="test", max_retries=0))
+        committed = []
+        done = []
+        with EmbeddingWriter(upsert, embeddings, batch_size=4, max_in_flight=3,
+                             retry_base_delay=0.01) as writer:
+            writer.add(make_chunks(25), on_commit=committed.extend, on_done=lambda: done.append("a"))
+
+    assert len(stored) == 25
+    assert len(committed) == 25
+    assert done == ["a"]
+    # The fake server bills a token per word; rate-limited attempts bill nothing.
+    assert writer.embedding_tokens == 25 * 2
+    assert server.rate_limited > 0
+    assert server.max_in_flight <= 3
+
+
+def test_batches_are_shared_across_files_and_files_finish_once():
+    batches = []
+    done = []
+
+    class Embeddings:
+        def embed_documents(self, texts):
+            return [[1.0] for _ in texts]
+
+    def upsert(ids, embeddings, documents, metadatas):
+        batches.append(ids)
+
+    with EmbeddingWriter(upsert, Embeddings(), batch_size=4, max_in_flight=2) as writer:
+        writer.add(make_chunks(3, "data/a.pdf"), on_done=lambda: done.append("a"))
+        writer.add([], on_done=lambda: done.append("empty"))
+        writer.add(make_chunks(3, "data/b.pdf"), on_done=lambda: done.append("b"))
+
+    assert [len(batch) for batch in batches] == [4, 2]
+    assert sorted(done) == ["a", "b", "empty"]
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.18
+
+
+def test_texts_over_the_context_are_embedded_in_pieces():
+    words = [f"palavra{i}" for i in range(12)]
+    with FakeOpenAIServer() as server:
+        embeddings = UsageTrackingOpenAIEmbeddings(OpenAI(base_url=server.url, api_key="test", max_retries=0),
+                                                   max_tokens=5, count_tokens=lambda text: len(text.split()))
+        vectors, tokens = embeddings.embed_documents_with_usage(["curta", " ".join(words)])
+
+    assert len(vectors) == 2 and tokens == 13
+    # Pieces of 3 words (12 halved twice), averaged by their token counts.
+    pieces = [fake_embedding(" ".join(words[start:start + 3])) for start in range(0, 12, 3)]
+    expected = np.mean(pieces, axis=0)
+    assert np.allclose(vectors[1], expected / np.linalg.norm(expected), atol=1e-6)
+    assert np.allclose(vectors[0], fake_embedding("curta"), atol=1e-6)
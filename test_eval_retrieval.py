@@ -0,0 +1,46 @@
+import json
+
+from benchmarks.eval_retrieval import (
+    compare_to_baseline,
+    evaluate,
+    load_dataset,
+    ndcg_at_k,
+    reciprocal_rank,
+    recall_at_k,
+    relevant_chunk_ids,
+)
+from populate_database import calculate_chunk_ids, split_documents
+
+BASELINE = "benchmarks/baselines/dgs_itu_v1.json"
+
+
+def test_ranking_metrics():
+    ranked = ["a", "b", "c", "d"]
+    assert recall_at_k(ranked, {"b", "z"}, k=2) == 0.5
+    assert reciprocal_rank(ranked, {"c"}) == 1 / 3
+    assert reciprocal_rank(ranked, {"z"}) == 0.0
+    assert ndcg_at_k(ranked, {"a"}, k=3) == 1.0
+    assert 0 < ndcg_at_k(ranked, {"b"}, k=3) < 1
+
+
+def test_every_question_has_evidence_in_the_corpus():
+    documents, questions = load_dataset("dgs_itu_v1")
+    chunks = calculate_chunk_ids(split_documents(documents))
+    for question in questions:
+        # expected_chunks records the labels under the default chunking.
+        assert relevant_chunk_ids(chunks, question) == set(question["expected_chunks"])
+
+
+def test_retrieval_matches_baseline():
+    with open(BASELINE, encoding="utf-8") as file:
+        baseline = json.load(file)
+    results = evaluate(backend=baseline["config"]["backend"], repeats=1)
+    assert compare_to_baseline(results, baseline) == []
+
+
+def test_regressions_are_reported():
+    with open(BASELINE, encoding="utf-8") as file:
+        baseline = json.load(file)
+    worse = json.loads(json.dumps(baseline))
+    worse["metrics"]["recall"] -= 0.1
+    assert compare_to_baseline(worse, baseline) == ["recall dropped 0.100 (0.900 -> 0.800)"]
@@ -0,0 +1,84 @@
+import math
+
+from langchain_core.documents import Document
+
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+
+CHUNKS = {
+    "norma.pdf:3:0": "Bacteriúria assintomática na grávida: fosfomicina 3g em toma única.",
+    "norma.pdf:3:1": "Alternativa: amoxicilina + ácido clavulânico 625 mg durante 5-7 dias.",
+    "norma.pdf:4:0": "A pielonefrite aguda exige urocultura antes de iniciar antibioterapia.",
+    "norma.pdf:5:0": "Norma da DGS sobre infeções do trato urinário.",
+}
+
+
+def make_index(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    index.upsert(list(CHUNKS), list(CHUNKS.values()), [{"id": chunk_id} for chunk_id in CHUNKS])
+    index.commit()
+    return index
+
+
+def test_tokenize_folds_accents_stopwords_and_plurals():
+    assert tokenize("Infeções do Trato Urinário nas GRÁVIDAS, fosfomicina 3g (DGS)") == [
+        "infecoe", "trato", "urinario", "gravida", "fosfomicina", "3g", "dgs",
+    ]
+
+
+def test_exact_terms_rank_first(tmp_path):
+    index = make_index(tmp_path)
+    assert index.search("fosfomicina 3g", k=2)[0][0].metadata["id"] == "norma.pdf:3:0"
+    assert index.search("dgs", k=2)[0][0].metadata["id"] == "norma.pdf:5:0"
+    assert index.search("infecao respiratoria") == []
+
+
+def test_bm25_scores_match_reference(tmp_path):
+    index = make_index(tmp_path)
+    docs = [tokenize(text) for text in CHUNKS.values()]
+    average = sum(map(len, docs)) / len(docs)
+
+    def reference(query, doc):
+        score = 0.0
+        for term in set(tokenize(query)):
+            df = sum(term in other for other in docs)
+            if not df:
+                continue
+            tf = doc.count(term)
+            idf = math.log1p((len(docs) - df + 0.5) / (df + 0.5))
+            score += idf * tf * 2.2 / (tf + 1.2 * (1 - 0.75 + 0.75 * len(doc) / average))
+        return score
+
+    for doc, score in index.search("urocultura na pielonefrite e na grávida", k=4):
+        expected = reference("urocultura na pielonefrite e na grávida", tokenize(doc.page_content))
+        assert math.isclose(score, expected, rel_tol=1e-5)
+
+
+def test_incremental_updates_are_visible(tmp_path):
+    index = make_index(tmp_path)
+    assert index.search("nitrofurantoína") == []
+
+    index.upsert(["norma.pdf:4:0"], ["Nitrofurantoína na cistite."], [{"id": "norma.pdf:4:0"}])
+    index.delete(["norma.pdf:5:0"])
+    index.commit()
+
+    assert [doc.page_content for doc, _ in index.search("nitrofurantoína")] == ["Nitrofurantoína na cistite."]
+    assert index.search("pielonefrite") == []
+    assert index.search("dgs") == []
+    assert index.count() == 3
+
+
+def test_delete_during_search_skips_removed_docs(tmp_path):
+    # A search that took its postings snapshot just before a delete committed.
+    index = make_index(tmp_path)
+    snapshot = index._snapshot()
+    index.delete(["norma.pdf:3:0"])
+    index.commit()
+    index._snapshot = lambda: snapshot
+
+    assert [doc.metadata["id"] for doc, _ in index.search("fosfomicina grávida dgs", k=4)] == ["norma.pdf:5:0"]
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    a, b, c = (Document(page_content=name, metadata={"id": name}) for name in "abc")
+    fused = reciprocal_rank_fusion([[(a, 0.1), (b, 0.2)], [(b, 9.0), (c, 3.0)]])
+    assert [doc.metadata["id"] for doc, _ in fused] == ["b", "a", "c"]
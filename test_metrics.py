@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from langchain_chroma import Chroma
+
+from answer_cache import AnswerCache
+from benchmarks.stubs import AsyncStubChatClient, StubChatClient, StubEmbeddings
+from metrics import Metrics, usage_cost, user_id
+from query_data import COLLECTION_NAME, RagEngine
+from query_service import QueryService
+from transcriber import SAMPLE_RATE, Transcriber
+
+CHUNKS = {
+    "data/norma.pdf:3:0": "Bacteriúria assintomática na grávida: fosfomicina 3g em toma única.",
+    "data/norma.pdf:5:0": "Cistite recorrente: considerar profilaxia.",
+}
+DAY = 1_760_000_000  # 2025-10-09 08:53 UTC
+
+
+@pytest.fixture
+def metrics(tmp_path):
+    return Metrics(trace_path=str(tmp_path / "trace.jsonl"), usage_path=str(tmp_path / "usage.sqlite3"),
+                   clock=lambda: DAY)
+
+
+@pytest.fixture
+def engine(tmp_path, metrics):
+    embeddings = StubEmbeddings()
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=str(tmp_path))
+    db.add_texts(list(CHUNKS.values()), metadatas=[{"id": chunk_id} for chunk_id in CHUNKS], ids=list(CHUNKS))
+    return RagEngine(persist_directory=str(tmp_path), embedding_function=embeddings, client_factory=StubChatClient,
+                     async_client_factory=AsyncStubChatClient, metrics=metrics, report_context=False)
+
+
+def traces(metrics):
+    with open(metrics.trace_path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_prices_separate_input_and_output():
+    assert usage_cost("gpt-4o", 1_000_000, 0) == pytest.approx(2.50)
+    assert usage_cost("gpt-4o", 0, 1_000_000) == pytest.approx(10.00)
+    # Dated snapshots use their family's price, and -mini is not gpt-4o.
+    assert usage_cost("gpt-4o-2024-08-06", 1000, 1000) == usage_cost("gpt-4o", 1000, 1000)
+    assert usage_cost("gpt-4o-mini", 1_000_000, 1_000_000) == pytest.approx(0.75)
+    assert usage_cost("unknown-model", 1000, 1000) == 0.0
+
+
+def test_query_is_traced_per_stage_and_aggregated_per_user(engine, metrics, tmp_path):
+    engine.answer_cache = AnswerCache(path=str(tmp_path / "answers.sqlite3"), chroma_path=str(tmp_path))
+    engine.query("fosfomicina na grávida", "sk-a")
+    engine.query("fosfomicina na grávida", "sk-a")  # from the answer cache
+    engine.query("cistite", "sk-b")
+
+    first, cached, other = traces(metrics)
+    assert set(first["stages"]) == {"embed", "search", "prompt", "generate"}
+    assert first["user"] == user_id("sk-a") and "sk-a" not in json.dumps(first)
+    assert first["cost"] == pytest.approx(usage_cost("gpt-4o", first["prompt_tokens"], first["completion_tokens"]))
+    assert cached["cached"] and set(cached["stages"]) == {"embed"}
+
+    summary = metrics.usage_summary(user_id("sk-a"))
+    assert summary["today"]["requests"] == 2 and summary["today"]["cached"] == 1
+    assert summary["today"]["prompt_tokens"] == first["prompt_tokens"]
+    assert summary["period"]["cost"] == pytest.approx(first["cost"])
+    assert metrics.usage_summary(user_id("sk-b"))["today"]["requests"] == 1
+
+    # The ledger outlives the process.
+    reopened = Metrics(usage_path=str(tmp_path / "usage.sqlite3"), clock=lambda: DAY + 86400)
+    assert reopened.usage_summary(user_id("sk-a"))["today"]["requests"] == 0
+    assert reopened.usage_summary(user_id("sk-a"))["period"]["requests"] == 2
+
+
+def test_stream_trace_ends_with_the_stream(engine, metrics):
+    sources, deltas = engine.query_stream("cistite", "sk-a")
+    "".join(deltas)
+    _sources, deltas = engine.query_stream("fosfomicina na grávida", "sk-a")
+    next(deltas)
+    deltas.close()  # The reader went away.
+
+    finished, abandoned = traces(metrics)
+    assert finished["status"] == "ok" and finished["completion_tokens"] > 0
+    assert "generate" in finished["stages"]
+    assert abandoned["status"] == "cancelled"
+
+
+def test_embedding_tokens_are_billed_under_their_own_model(engine, metrics, tmp_path):
+    class MeteredEmbeddings(StubEmbeddings):
+        model = "text-embedding-3-large"
+
+        def embed_query_with_usage(self, text):
+            return self.embed_query(text), len(text.split())
+
+    engine.embedding_function = MeteredEmbeddings()
+    engine.query("fosfomicina na grávida", "sk-a")
+
+    (trace,) = traces(metrics)
+    assert trace["embedding_model"] == "text-embedding-3-large" and trace["embedding_tokens"] == 3
+    assert trace["embedding_cost"] == pytest.approx(3 * 0.13 / 1_000_000)
+    rows = {row["model"]: row for row in metrics.usage(user_id("sk-a"))}
+    assert rows["text-embedding-3-large"]["prompt_tokens"] == 3 and rows["text-embedding-3-large"]["requests"] == 0
+    summary = metrics.usage_summary(user_id("sk-a"))["today"]
+    assert summary["requests"] == 1
+    assert summary["cost"] == pytest.approx(trace["cost"] + trace["embedding_cost"])
+    assert 'rag_tokens_total{model="text-embedding-3-large",type="input"} 3' in metrics.prometheus()
+
+
+def test_prometheus_text(engine, metrics):
+    asyncio.run(engine.aquery("cistite", "sk-a"))
+    text = metrics.prometheus()
+    assert 'rag_stage_seconds_bucket{stage="generate",le="+Inf"} 1' in text
+    assert 'rag_stage_seconds_count{stage="search"} 1' in text
+    assert 'rag_requests_total{kind="answer",status="ok"} 1' in text
+    assert 'rag_tokens_total{model="gpt-4o",type="input"}' in text
+    assert 'rag_cost_usd_total{model="gpt-4o"}' in text
+
+
+def test_service_exposes_metrics_and_own_usage(engine, metrics):
+    async def scenario(client):
+        headers = {"Authorization": "Bearer sk-a"}
+        await client.post("/answer", json={"query": "cistite"}, headers=headers)
+        exposition = await (await client.get("/metrics")).text()
+        usage = await (await client.get("/usage", headers=headers)).json()
+        other = await (await client.get("/usage", headers={"Authorization": "Bearer sk-b"})).json()
+        anonymous = await client.get("/usage")
+        return exposition, usage, other, anonymous.status
+
+    async def main():
+        async with TestClient(TestServer(QueryService(engine).app())) as client:
+            return await scenario(client)
+
+    exposition, usage, other, anonymous = asyncio.run(main())
+    assert "query_service_completed_total 1" in exposition
+    assert 'rag_stage_seconds_count{stage="queue_wait"} 1' in exposition
+    assert usage["summary"]["today"]["requests"] == 1
+    assert usage["days"][0]["model"] == "gpt-4o"
+    assert other["summary"]["today"]["requests"] == 0
+    assert anonymous == 401
+
+
+def test_transcription_is_traced(metrics):
+    class Model:
+        def transcribe(self, audio, **options):
+            return {"text": " olá "}
+
+    transcriber = Transcriber(model_loader=lambda name: Model(), metrics=metrics)
+    assert transcriber.transcribe([0.1] * SAMPLE_RATE * 2) == "olá"
+    (trace,) = traces(metrics)
+    assert trace["kind"] == "transcribe" and trace["audio_seconds"] == 2.0
+    assert metrics.stage_summary()["transcribe"][0] == 1
@@ -0,0 +1,193 @@
+import os
+
+import pytest
+from langchain_core.documents import Document
+
+import populate_database
+from ingest_manifest import read_corpus_version
+
+
+class FakeEmbeddings:
+
+    def embed_documents(self, texts):
+        return [[float(len(text))] for text in texts]
+
+    def stats(self):
+        return {"hits": 0, "misses": 0}
+
+
+class FakeStore:
+    # Stands in for a vector_store backend.
+
+    def __init__(self, fail_after_batches=None):
+        self.docs = {}
+        self.metadatas = {}
+        self.upserted = 0
+        self.embedding_function = FakeEmbeddings()
+        self.fail_after_batches = fail_after_batches
+        self.max_batch_size = 5461
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        if self.fail_after_batches == 0:
+            raise RuntimeError("simulated crash")
+        if self.fail_after_batches:
+            self.fail_after_batches -= 1
+        self.docs.update(zip(ids, documents))
+        self.metadatas.update(zip(ids, metadatas))
+        self.upserted += len(ids)
+
+    def delete(self, ids):
+        for doc_id in ids:
+            self.docs.pop(doc_id, None)
+
+    def update_metadata(self, ids, metadatas):
+        self.metadatas.update(zip(ids, metadatas))
+
+    def optimize(self):
+        pass
+
+
+def write_pdf(path, pages):
+    # Fake "PDFs": one page per line, parsed by the patched load_file below.
+    path.write_text("\n".join(pages), encoding="utf-8")
+
+
+def load_text_pages(source):
+    with open(source, encoding="utf-8") as file:
+        return [
+            Document(page_content=text, metadata={"source": source, "page": page})
+            for page, text in enumerate(file.read().split("\n"))
+        ]
+
+
+def run(monkeypatch, tmp_path, store, **kwargs):
+    monkeypatch.setattr(populate_database, "DATA_PATH", str(tmp_path / "data"))
+    monkeypatch.setattr(populate_database, "CHROMA_PATH", str(tmp_path / "chroma"))
+    monkeypatch.setattr(populate_database, "load_file", load_text_pages)
+    monkeypatch.setattr(populate_database, "open_vector_store", lambda *args: store)
+    return populate_database.update_database(**kwargs)
+
+
+def test_only_changed_chunks_are_written(monkeypatch, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    write_pdf(data / "a.pdf", ["cistite", "pielonefrite"])
+    write_pdf(data / "b.pdf", ["bacteriúria"])
+    store = FakeStore()
+
+    summary = run(monkeypatch, tmp_path, store)
+    assert summary["added"] == 3
+    assert len(store.docs) == 3
+
+    summary = run(monkeypatch, tmp_path, store)
+    assert summary["files_unchanged"] == 2
+    assert summary["added"] == summary["updated"] == summary["deleted"] == 0
+
+    write_pdf(data / "a.pdf", ["cistite", "pielonefrite aguda"])
+    os.utime(data / "a.pdf", (1, 1))
+    os.remove(data / "b.pdf")
+    summary = run(monkeypatch, tmp_path, store)
+    assert summary["updated"] == 1
+    assert summary["skipped"] == 1
+    assert summary["deleted"] == 1
+    assert store.docs == {
+        f"{data / 'a.pdf'}:0:0": "cistite",
+        f"{data / 'a.pdf'}:1:0": "pielonefrite aguda",
+    }
+
+
+def test_touched_file_with_same_content_is_not_reparsed(monkeypatch, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    write_pdf(data / "a.pdf", ["cistite"])
+    run(monkeypatch, tmp_path, FakeStore())
+
+    os.utime(data / "a.pdf", (1, 1))
+    # No vector store is opened at all when nothing changed.
+    summary = run(monkeypatch, tmp_path, None)
+    assert summary["files_changed"] == 0
+    assert summary["files_unchanged"] == 1
+
+
+def test_crashed_ingest_resumes_after_last_committed_batch(monkeypatch, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    write_pdf(data / "a.pdf", [f"página {page}" for page in range(10)])
+
+    store = FakeStore(fail_after_batches=2)
+    with pytest.raises(RuntimeError):
+        run(monkeypatch, tmp_path, store, batch_size=3, max_in_flight=1)
+    assert len(store.docs) == 6
+    # The batches it did write already invalidate the caches.
+    crashed_version = read_corpus_version(str(tmp_path / "chroma"))
+    assert crashed_version
+
+    store.fail_after_batches = None
+    summary = run(monkeypatch, tmp_path, store, batch_size=3, max_in_flight=1)
+    assert summary["skipped"] == 6
+    assert summary["added"] == 4
+    assert len(store.docs) == 10
+    assert read_corpus_version(str(tmp_path / "chroma")) != crashed_version
+
+
+def test_parallel_parsing_keeps_chunk_ids(monkeypatch, tmp_path):
+    monkeypatch.setattr(populate_database, "load_file", load_text_pages)
+    sources = []
+    for name in ["a", "b", "c"]:
+        write_pdf(tmp_path / f"{name}.pdf", ["cistite " * 200, "pielonefrite"])
+        sources.append(str(tmp_path / f"{name}.pdf"))
+
+    # IDs as the old whole-corpus pass computed them.
+    all_pages = [page for source in sources for page in load_text_pages(source)]
+    expected = [chunk.metadata["id"] for chunk in
+                populate_database.calculate_chunk_ids(populate_database.split_documents(all_pages))]
+
+    parsed = dict(populate_database.iter_parsed_files(sources, workers=2))
+    actual = [chunk.metadata["id"] for source in sources for chunk in parsed[source]]
+    assert actual == expected
+
+
+def test_new_chunk_settings_rechunk_from_the_parse_cache(monkeypatch, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    write_pdf(data / "a.pdf", ["I – NORMA", "Cistite não complicada. " * 10])
+    store = FakeStore()
+    cache_path = str(tmp_path / "parse_cache.sqlite3")
+    run(monkeypatch, tmp_path, store, parse_cache_path=cache_path)
+    assert sorted(store.docs) == [f"{data / 'a.pdf'}:0:0", f"{data / 'a.pdf'}:1:0"]
+
+    def unparsable(source):
+        raise AssertionError(f"{source} parsed again")
+
+    monkeypatch.setattr(populate_database, "load_file", unparsable)
+    structured = {"chunker": "structured", "chunk_size": 120, "chunk_overlap": 0}
+    summary = populate_database.update_database(chunking=structured, parse_cache_path=cache_path)
+    assert summary["files_changed"] == 1 and summary["deleted"] == 2
+    assert all("#" in chunk_id for chunk_id in store.docs) and len(store.docs) == 3
+    assert next(iter(store.docs.values())).startswith("I – NORMA\nCistite")
+
+    summary = populate_database.update_database(chunking=structured, parse_cache_path=cache_path)
+    assert summary["files_changed"] == 0
+
+
+def test_chunks_shifted_by_new_text_only_get_their_position_updated(monkeypatch, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    paragraphs = ["Cistite não complicada: fosfomicina.", "Pielonefrite aguda: ceftriaxona.",
+                  "Bacteriúria na grávida: tratar sempre.", "Cistite recorrente: profilaxia."]
+    write_pdf(data / "a.pdf", paragraphs)
+    store = FakeStore()
+    structured = {"chunker": "structured", "chunk_size": 60, "chunk_overlap": 0}
+    run(monkeypatch, tmp_path, store, chunking=structured)
+    assert store.upserted == 4
+
+    write_pdf(data / "a.pdf", ["Nota prévia acrescentada no início."] + paragraphs)
+    os.utime(data / "a.pdf", (1, 1))
+    summary = run(monkeypatch, tmp_path, store, chunking=structured)
+    assert (summary["added"], summary["updated"], summary["moved"]) == (1, 0, 4)
+    assert store.upserted == 5
+    positions = {store.docs[chunk_id]: metadata["chunk_index"] for chunk_id, metadata in store.metadatas.items()}
+    assert [positions[paragraph] for paragraph in paragraphs] == [1, 2, 3, 4]
+
+    summary = run(monkeypatch, tmp_path, store, chunking=structured)
+    assert summary["files_changed"] == 0
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from langchain_chroma import Chroma
+
+from answer_cache import AnswerCache
+from benchmarks.stubs import AsyncStubChatClient, StubChatClient, StubEmbeddings
+from lexical_index import LexicalIndex
+from query_data import COLLECTION_NAME, RagEngine
+
+CHUNKS = {
+    "data/norma.pdf:3:0": "Bacteriúria assintomática na grávida: fosfomicina 3g em toma única.",
+    "data/norma.pdf:4:0": "Pielonefrite aguda: iniciar antibioterapia empírica.",
+    "data/norma.pdf:5:0": "Cistite recorrente: considerar profilaxia.",
+}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    embeddings = StubEmbeddings()
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=str(tmp_path))
+    db.add_texts(list(CHUNKS.values()), metadatas=[{"id": chunk_id} for chunk_id in CHUNKS], ids=list(CHUNKS))
+    return RagEngine(
+        persist_directory=str(tmp_path),
+        embedding_function=embeddings,
+        client_factory=StubChatClient,
+        async_client_factory=AsyncStubChatClient,
+    )
+
+
+def test_query_returns_answer_and_sources(engine):
+    result = engine.query("fosfomicina na grávida", "sk-a")
+    assert result["sources"][0] == "data/norma.pdf:3:0"
+    assert "fosfomicina" in result["response"]
+
+
+def test_clients_are_pooled_per_api_key(engine):
+    engine.query("cistite", "sk-a")
+    engine.query("pielonefrite", "sk-a")
+    engine.query("cistite", "sk-b")
+    assert engine.client("sk-a").calls == 2
+    assert engine.client("sk-b").calls == 1
+
+
+def test_aquery_matches_query(engine):
+    result = asyncio.run(engine.aquery("fosfomicina na grávida", "sk-a"))
+    assert result == engine.query("fosfomicina na grávida", "sk-a")
+
+
+def test_stream_yields_sources_before_generation(engine):
+    sources, deltas = engine.query_stream("fosfomicina na grávida", "sk-a")
+    assert sources[0] == "data/norma.pdf:3:0"
+    assert engine.client("sk-a").calls == 0
+
+    streamed = "".join(deltas)
+    assert streamed.strip() == engine.query("fosfomicina na grávida", "sk-a")["response"]
+
+
+def test_async_stream(engine):
+    async def collect():
+        sources, deltas = await engine.aquery_stream("cistite", "sk-a")
+        return sources, "".join([delta async for delta in deltas])
+
+    sources, streamed = asyncio.run(collect())
+    assert sources[0] == "data/norma.pdf:5:0"
+    assert "Cistite" in streamed
+
+
+def test_repeated_question_is_answered_from_cache(engine, tmp_path):
+    engine.answer_cache = AnswerCache(path=str(tmp_path / "answers.sqlite3"), chroma_path=str(tmp_path))
+    first = engine.query("fosfomicina na grávida", "sk-a")
+    second = engine.query("fosfomicina na grávida", "sk-a")
+    sources, deltas = engine.query_stream("fosfomicina na grávida", "sk-a")
+
+    assert engine.client("sk-a").calls == 1
+    assert second["cached"] and not first["cached"]
+    assert second["response"] == first["response"] == "".join(deltas)
+    assert sources == first["sources"]
+
+
+def test_hybrid_retrieval_fuses_lexical_hits(engine, tmp_path):
+    engine.lexical_index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    engine.lexical_index.upsert(list(CHUNKS), list(CHUNKS.values()), [{"id": chunk_id} for chunk_id in CHUNKS])
+    engine.lexical_index.commit()
+
+    results = engine.retrieve("profilaxia", k=2)
+    assert len(results) == 2
+    assert results[0][0].metadata["id"] == "data/norma.pdf:5:0"
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from langchain_chroma import Chroma
+
+from benchmarks.stubs import AsyncStubChatClient, StubEmbeddings, stub_stream
+from query_client import QueryServiceClient, QueryServiceError
+from query_data import COLLECTION_NAME, RagEngine
+from query_service import QueryService, serve
+
+CHUNKS = {
+    "data/norma.pdf:3:0": "Bacteriúria assintomática na grávida: fosfomicina 3g em toma única.",
+    "data/norma.pdf:4:0": "Pielonefrite aguda: iniciar antibioterapia empírica.",
+    "data/norma.pdf:5:0": "Cistite recorrente: considerar profilaxia.",
+}
+
+
+class GatedChatClient(AsyncStubChatClient):
+    # Completions wait until the test opens the gate, so queue states can be
+    # inspected without relying on timing.
+
+    def __init__(self, api_key=None, gate=None, record=None):
+        super().__init__(api_key)
+        self.gate = gate
+        self.record = record
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._gated_create))
+
+    async def _gated_create(self, **kwargs):
+        self.record["started"].append(self.api_key)
+        try:
+            await self.gate.wait()
+        except asyncio.CancelledError:
+            self.record["cancelled"].append(self.api_key)
+            raise
+        return await self._create(**kwargs)
+
+
+class FailingChatClient(AsyncStubChatClient):
+    # Streams two words of the answer, then fails like a dropped upstream call.
+
+    async def _create(self, model, messages, stream=False, **kwargs):
+        if not stream:
+            raise RuntimeError("upstream reset")
+        return await super()._create(model, messages, stream, **kwargs)
+
+    async def _stream(self, messages, model):
+        for index, chunk in enumerate(stub_stream(messages, model)):
+            if index == 2:
+                raise RuntimeError("upstream reset")
+            yield chunk
+
+
+@pytest.fixture
+def engine(tmp_path):
+    embeddings = StubEmbeddings()
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=str(tmp_path))
+    db.add_texts(list(CHUNKS.values()), metadatas=[{"id": chunk_id} for chunk_id in CHUNKS], ids=list(CHUNKS))
+    return RagEngine(persist_directory=str(tmp_path), embedding_function=embeddings,
+                     async_client_factory=AsyncStubChatClient)
+
+
+def gate_engine(engine):
+    record = {"started": [], "cancelled": []}
+    gate = asyncio.Event()
+    engine.async_client_factory = lambda api_key: GatedChatClient(api_key, gate, record)
+    return gate, record
+
+
+def run(service, scenario):
+    async def main():
+        async with TestClient(TestServer(service.app())) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+
+async def until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+def bearer(api_key):
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+def test_retrieve_and_answer(engine):
+    async def scenario(client):
+        retrieved = await (await client.post("/retrieve", json={"query": "fosfomicina na grávida", "k": 2})).json()
+        answer = await client.post("/answer", json={"query": "fosfomicina na grávida"}, headers=bearer("sk-a"))
+        unauthorized = await client.post("/answer", json={"query": "fosfomicina na grávida"})
+        bad = await client.post("/answer", data="not json", headers=bearer("sk-a"))
+        return retrieved, answer.status, await answer.json(), unauthorized.status, bad.status
+
+    retrieved, status, answer, unauthorized, bad = run(QueryService(engine), scenario)
+    assert [result["id"] for result in retrieved["results"]][0] == "data/norma.pdf:3:0"
+    assert len(retrieved["results"]) == 2
+    assert status == 200 and answer["sources"][0] == "data/norma.pdf:3:0"
+    assert "fosfomicina" in answer["response"]
+    assert (unauthorized, bad) == (401, 400)
+
+
+def test_bad_parameters_are_rejected(engine):
+    async def scenario(client):
+        statuses = []
+        for k in ("many", None, 0, 10_000):
+            statuses.append((await client.post("/retrieve", json={"query": "cistite", "k": k})).status)
+        for days in ("x", "0"):
+            statuses.append((await client.get(f"/usage?days={days}", headers=bearer("sk-a"))).status)
+        return statuses
+
+    assert run(QueryService(engine), scenario) == [400] * 6
+
+
+def test_stream_sends_sources_then_deltas(engine):
+    async def scenario(client):
+        response = await client.post("/answer/stream", json={"query": "fosfomicina na grávida"}, headers=bearer("sk-a"))
+        return [line async for line in response.content]
+
+    events = [json.loads(line) for line in run(QueryService(engine), scenario)]
+    assert events[0]["sources"][0] == "data/norma.pdf:3:0"
+    assert events[-1] == {"done": True}
+    streamed = "".join(event["delta"] for event in events[1:-1])
+    assert streamed.strip() == asyncio.run(engine.aquery("fosfomicina na grávida", "sk-a"))["response"]
+
+
+def test_engine_errors_end_the_answer_cleanly(engine):
+    engine.async_client_factory = FailingChatClient
+    service = QueryService(engine)
+
+    async def scenario(client):
+        response = await client.post("/answer/stream", json={"query": "cistite"}, headers=bearer("sk-a"))
+        lines = [line async for line in response.content]
+        answer = await client.post("/answer", json={"query": "cistite"}, headers=bearer("sk-a"))
+        return lines, answer.status, await answer.json()
+
+    lines, status, answer = run(service, scenario)
+    events = [json.loads(line) for line in lines]
+    assert "sources" in events[0] and [list(event) for event in events[1:3]] == [["delta"], ["delta"]]
+    assert events[-1] == {"error": "Could not answer (RuntimeError)"}
+    assert (status, answer) == (502, {"error": "Could not answer (RuntimeError)"})
+    assert service.failed == 2
+
+
+def test_client_reports_a_dropped_stream():
+    class Dropped(httpx.SyncByteStream):
+        def __iter__(self):
+            yield b'{"sources": ["data/norma.pdf:3:0"]}\n{"delta": "Fosfomicina "}\n'
+            raise httpx.RemoteProtocolError("peer closed connection without sending complete message body")
+
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, stream=Dropped()))
+    client = QueryServiceClient("http://service", transport=transport)
+    sources, deltas = client.answer_stream("fosfomicina", "sk-a")
+    assert sources == ["data/norma.pdf:3:0"] and next(deltas) == "Fosfomicina "
+    with pytest.raises(QueryServiceError, match="Answer interrupted"):
+        next(deltas)
+
+
+def test_per_key_limit_leaves_room_for_other_users(engine):
+    gate, record = gate_engine(engine)
+    service = QueryService(engine, max_concurrent=4, per_key_limit=2)
+
+    async def scenario(client):
+        def ask(api_key):
+            return asyncio.create_task(client.post("/answer", json={"query": "cistite"}, headers=bearer(api_key)))
+
+        greedy = [ask("sk-a") for _ in range(4)]
+        await until(lambda: service.waiting == 2 and service.active == 2)
+        other = ask("sk-b")
+        # sk-b gets a slot even though sk-a still has requests queued.
+        await until(lambda: "sk-b" in record["started"])
+        assert record["started"].count("sk-a") == 2
+        gate.set()
+        return [response.status for response in await asyncio.gather(*greedy, other)]
+
+    assert run(service, scenario) == [200] * 5
+    assert service.completed == 5 and service.active == 0
+    # Keys with nothing in flight are forgotten.
+    assert service._key_slots == {}
+
+
+def test_full_queue_is_rejected_with_retry_after(engine):
+    gate, _record = gate_engine(engine)
+    service = QueryService(engine, max_concurrent=1, per_key_limit=1, max_queue=1)
+
+    async def scenario(client):
+        def ask(api_key):
+            return asyncio.create_task(client.post("/answer", json={"query": "cistite"}, headers=bearer(api_key)))
+
+        first = ask("sk-a")
+        await until(lambda: service.active == 1)
+        second = ask("sk-b")
+        await until(lambda: service.waiting == 1)
+        rejected = await client.post("/answer", json={"query": "cistite"}, headers=bearer("sk-c"))
+        gate.set()
+        await asyncio.gather(first, second)
+        return rejected.status, rejected.headers.get("Retry-After")
+
+    assert run(service, scenario) == (503, "1")
+    assert service.rejected == 1 and service.completed == 2
+
+
+def test_deadline_includes_the_wait(engine):
+    _gate, record = gate_engine(engine)
+    service = QueryService(engine, timeout=0.2)
+
+    async def scenario(client):
+        response = await client.post("/answer", json={"query": "cistite"}, headers=bearer("sk-a"))
+        return response.status
+
+    assert run(service, scenario) == 504
+    assert service.timed_out == 1 and record["cancelled"] == ["sk-a"]
+
+
+def test_disconnect_cancels_the_completion(engine):
+    _gate, record = gate_engine(engine)
+    service = QueryService(engine)
+
+    async def scenario(client):
+        request = asyncio.create_task(client.post("/answer", json={"query": "cistite"}, headers=bearer("sk-a")))
+        await until(lambda: record["started"])
+        request.cancel()  # The browser tab went away.
+        await until(lambda: record["cancelled"])
+
+    run(service, scenario)
+    assert service.cancelled == 1 and service.active == 0 and service.completed == 0
+
+
+def test_sync_client_against_running_service(engine):
+    ready = threading.Event()
+    holder = {}
+
+    def server():
+        async def main():
+            runner = await serve(QueryService(engine), "127.0.0.1", 0)
+            holder["port"] = runner.addresses[0][1]
+            holder["stop"] = asyncio.Event()
+            holder["loop"] = asyncio.get_running_loop()
+            ready.set()
+            await holder["stop"].wait()
+            await runner.cleanup()
+        asyncio.run(main())
+
+    thread = threading.Thread(target=server)
+    thread.start()
+    ready.wait(10)
+    try:
+        client = QueryServiceClient(f"http://127.0.0.1:{holder['port']}")
+        assert client.retrieve("cistite", k=1)[0]["id"] == "data/norma.pdf:5:0"
+        sources, deltas = client.answer_stream("fosfomicina na grávida", "sk-a")
+        assert sources[0] == "data/norma.pdf:3:0"
+        assert "".join(deltas).strip() == client.answer("fosfomicina na grávida", "sk-a")["response"]
+        with pytest.raises(QueryServiceError) as error:
+            client.answer("cistite", "")
+        assert error.value.status == 401
+        client.close()
+    finally:
+        holder["loop"].call_soon_threadsafe(holder["stop"].set)
+        thread.join(10)
+
+    with pytest.raises(QueryServiceError, match="unreachable"):
+        QueryServiceClient(f"http://127.0.0.1:{holder['port']}").answer("cistite", "sk-a")
@@ -0,0 +1,108 @@
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+from benchmarks.stubs import StubEmbeddings
+from query_data import COLLECTION_NAME, RagEngine
+from reranker import LexicalScorer, Reranker, get_scorer
+
+
+def candidates(texts):
+    return [(Document(page_content=text, metadata={"id": f"doc:{i}"}), 1.0 - i / 100) for i, text in enumerate(texts)]
+
+
+class LengthScorer:
+    # Longer passages score higher; records the batches it was given.
+    prior_weight = 0.0
+
+    def __init__(self, clock=None, seconds_per_batch=0.0):
+        self.batches = []
+        self.clock = clock
+        self.seconds_per_batch = seconds_per_batch
+
+    def score(self, query, texts):
+        self.batches.append(len(texts))
+        if self.clock:
+            self.clock.now += self.seconds_per_batch
+        return [float(len(text)) for text in texts]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_candidates_are_scored_in_batches_and_reordered():
+    scorer = LengthScorer()
+    reranker = Reranker(scorer, batch_size=4, mmr_lambda=1.0)
+    pool = candidates(["x" * (i % 7 + 1) for i in range(10)])
+    ranked = reranker.rerank("q", pool, k=3)
+    assert scorer.batches == [4, 4, 2]
+    assert [len(doc.page_content) for doc, _score in ranked] == [7, 6, 5]
+
+
+def test_latency_budget_stops_scoring_and_keeps_first_stage_order():
+    clock = FakeClock()
+    scorer = LengthScorer(clock, seconds_per_batch=0.1)
+    reranker = Reranker(scorer, batch_size=2, budget_ms=150, mmr_lambda=1.0, clock=clock)
+    pool = candidates(["a", "bb", "ccc", "dddd", "eeeee", "ffffff"])
+    ranked = reranker.rerank("q", pool, k=5)
+    # Two batches fit in 150 ms; the third is never scored.
+    assert scorer.batches == [2, 2]
+    assert [doc.metadata["id"] for doc, _score in ranked] == ["doc:3", "doc:2", "doc:1", "doc:0", "doc:4"]
+    assert reranker.stats()["over_budget"] == 1
+
+
+def test_results_are_cached_per_question_and_candidates():
+    scorer = LengthScorer()
+    reranker = Reranker(scorer)
+    pool = candidates(["um", "dois", "três"])
+    first = reranker.rerank("Cistite  recorrente", pool, k=2)
+    second = reranker.rerank("cistite recorrente", pool, k=2)
+    assert first == second and len(scorer.batches) == 1
+    reranker.rerank("cistite recorrente", pool[:2], k=2)
+    assert len(scorer.batches) == 2
+    assert reranker.stats()["cache_hits"] == 1
+
+
+def test_mmr_skips_near_duplicates():
+    text = "fosfomicina 3g em toma única na bacteriúria assintomática da grávida"
+    pool = candidates([text, text + " (repetido)", "urocultura de controlo após o tratamento da grávida"])
+    scorer = LexicalScorer()
+    with_mmr = Reranker(scorer, mmr_lambda=0.5).rerank("fosfomicina grávida", pool, k=2)
+    without = Reranker(scorer, mmr_lambda=1.0).rerank("fosfomicina grávida", pool, k=2)
+    assert [doc.metadata["id"] for doc, _score in without] == ["doc:0", "doc:1"]
+    assert [doc.metadata["id"] for doc, _score in with_mmr] == ["doc:0", "doc:2"]
+
+
+def test_lexical_scorer_prefers_close_matches():
+    scores = LexicalScorer().score("antibioterapia empírica na pielonefrite", [
+        "Pielonefrite aguda: iniciar antibioterapia empírica após urocultura.",
+        "A antibioterapia da cistite. Noutra secção, a pielonefrite.",
+        "Cistite recorrente: considerar profilaxia.",
+    ])
+    assert scores[0] > scores[1] > scores[2] == 0.0
+
+
+def test_missing_cross_encoder_falls_back_to_lexical(tmp_path):
+    assert isinstance(get_scorer("cross-encoder", str(tmp_path)), LexicalScorer)
+    assert get_scorer("none") is None
+
+
+def test_engine_over_fetches_and_returns_top_k(tmp_path):
+    embeddings = StubEmbeddings()
+    texts = [f"Secção {i} sobre cistite e profilaxia." for i in range(30)]
+    texts[17] = "Pielonefrite aguda na grávida: internamento e ceftriaxona."
+    db = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=str(tmp_path))
+    db.add_texts(texts, metadatas=[{"id": f"data/n.pdf:{i}:0"} for i in range(30)],
+                 ids=[f"data/n.pdf:{i}:0" for i in range(30)])
+    scorer = LengthScorer()
+    engine = RagEngine(persist_directory=str(tmp_path), embedding_function=embeddings,
+                       reranker=Reranker(scorer, fetch_k=20, batch_size=8))
+
+    results = engine.retrieve("pielonefrite na grávida", k=3)
+    assert len(results) == 3 and sum(scorer.batches) == 20
+    assert results[0][0].metadata["id"] == "data/n.pdf:17:0"
+    assert engine.metrics.stage_summary()["rerank"][0] == 1
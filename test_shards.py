@@ -0,0 +1,164 @@
+import asyncio
+import os
+import threading
+
+import numpy as np
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from langchain_core.documents import Document
+
+import populate_database
+import vector_store
+from benchmarks.stubs import AsyncStubChatClient, StubEmbeddings
+from embedding_function import CachedEmbeddings
+from query_data import RagEngine
+from query_service import QueryService
+from shards import ShardedLexicalIndex, ShardedStore, read_shard_names, shard_for
+from vector_store import COLLECTION_NAME, get_vector_store
+
+FILES = {
+    "norma.pdf": ["Bacteriúria assintomática na grávida: fosfomicina.", "Cistite recorrente: profilaxia."],
+    "cardiologia/hta.pdf": ["Hipertensão arterial: iniciar IECA.", "Fibrilhação auricular: anticoagulação."],
+    "Nefrologia Pediátrica/drc.pdf": ["Doença renal crónica: ajustar a dose de fosfomicina."],
+}
+
+
+def test_shard_assignment():
+    assert shard_for("data/norma.pdf", "folder") == COLLECTION_NAME
+    assert shard_for("data/Nefrologia Pediátrica/2024/drc.pdf", "folder") == "nefrologia-pediatrica"
+    assert shard_for("data/cardiologia/hta.pdf", "none") == COLLECTION_NAME
+    hashed = {shard_for(f"data/{name}.pdf", "hash:3") for name in range(50)}
+    assert hashed == {f"{COLLECTION_NAME}-{index}" for index in range(3)}
+    assert shard_for("data/x.pdf", "hash:3") == shard_for("data/x.pdf", "hash:3")
+    with pytest.raises(ValueError, match="Unknown sharding"):
+        shard_for("data/x.pdf", "hash:0")
+
+
+def test_fan_out_matches_one_collection(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(60, 32)).tolist()
+    texts = [f"chunk {index}" for index in range(60)]
+    ids = [f"c{index}" for index in range(60)]
+    metadatas = [{"id": chunk_id, "source": f"data/spec{index % 3}/x.pdf"} for index, chunk_id in enumerate(ids)]
+    single = get_vector_store("numpy", str(tmp_path / "single"))
+    single.upsert(ids, vectors, texts, metadatas)
+    sharded = ShardedStore(lambda name: get_vector_store("numpy", str(tmp_path / "sharded"), name), [])
+    sharded.upsert(ids, vectors, texts, metadatas)
+    assert sharded.names == ["spec0", "spec1", "spec2"] and sharded.count() == 60
+
+    queries = rng.normal(size=(2, 32)).tolist()
+    expected = [[(doc.metadata["id"], round(score, 5)) for doc, score in results]
+                for results in single.search(queries, k=5)]
+    assert [[(doc.metadata["id"], round(score, 5)) for doc, score in results]
+            for results in sharded.search(queries, k=5)] == expected
+
+    only = sharded.search(queries, k=5, shards=["spec1"])
+    assert all(doc.metadata["source"] == "data/spec1/x.pdf" for results in only for doc, _score in results)
+    with pytest.raises(ValueError, match="Unknown shards: s9"):
+        sharded.search(queries, shards=["s9"])
+
+
+def test_searches_run_on_every_shard_at_once_after_a_refresh():
+    # Each shard's search waits until every shard is searching, which a pool
+    # sized for the first two shards could never reach once there are four.
+    barriers = [threading.Barrier(2, timeout=5)]
+
+    class WaitingStore:
+        def search(self, query_embeddings, k=5, where=None):
+            barriers[-1].wait()
+            return [[] for _ in query_embeddings]
+
+    sharded = ShardedStore(lambda name: WaitingStore(), ["a", "b"])
+    assert sharded.search([[0.0]]) == [[]]
+    barriers.append(threading.Barrier(4, timeout=5))
+    sharded.refresh(["a", "b", "c", "d"])
+    assert sharded.search([[0.0]]) == [[]]
+
+
+@pytest.fixture
+def corpus(monkeypatch, tmp_path):
+    data = tmp_path / "data"
+    for name, pages in FILES.items():
+        (data / name).parent.mkdir(parents=True, exist_ok=True)
+        (data / name).write_text("\n".join(pages), encoding="utf-8")
+    embeddings = CachedEmbeddings(StubEmbeddings(), "stub", cache_path=str(tmp_path / "embeddings.sqlite3"))
+    monkeypatch.setattr(populate_database, "DATA_PATH", str(data))
+    monkeypatch.setattr(populate_database, "CHROMA_PATH", str(tmp_path / "chroma"))
+    monkeypatch.setattr(populate_database, "load_file", lambda source: [
+        Document(page_content=text, metadata={"source": source, "page": page})
+        for page, text in enumerate(open(source, encoding="utf-8").read().split("\n"))
+    ])
+    monkeypatch.setattr(populate_database, "get_embedding_function", lambda **kwargs: embeddings)
+    monkeypatch.setattr(vector_store, "VECTOR_STORE_BACKEND", "numpy")
+    return tmp_path / "chroma", embeddings
+
+
+def open_engine(chroma_path, embeddings):
+    shard_names = read_shard_names(str(chroma_path))
+    return RagEngine(persist_directory=str(chroma_path), embedding_function=embeddings, backend="numpy",
+                     async_client_factory=AsyncStubChatClient, report_context=False, shard_names=shard_names,
+                     lexical_index=ShardedLexicalIndex(str(chroma_path), shard_names))
+
+
+def test_ingest_into_shards_and_query_a_subset(corpus):
+    chroma_path, embeddings = corpus
+    summary = populate_database.update_database()
+    assert summary["added"] == 5
+    assert read_shard_names(str(chroma_path)) == ["cardiologia", COLLECTION_NAME, "nefrologia-pediatrica"]
+
+    engine = open_engine(chroma_path, embeddings)
+    everywhere = {doc.metadata["source"] for doc, _score in engine.retrieve("fosfomicina", k=5)}
+    assert any("Nefrologia" in source for source in everywhere) and any("norma" in source for source in everywhere)
+    restricted = engine.retrieve("fosfomicina", k=5, shards=["nefrologia-pediatrica"])
+    assert [doc.metadata["id"] for doc, _score in restricted] == [
+        os.path.join(populate_database.DATA_PATH, "Nefrologia Pediátrica/drc.pdf") + ":0:0"]
+
+    async def scenario(client):
+        shards = await (await client.get("/shards")).json()
+        bad = await client.post("/retrieve", json={"query": "fosfomicina", "shards": ["oncologia"]})
+        return shards, bad.status, (await bad.json())["error"]
+
+    async def main():
+        async with TestClient(TestServer(QueryService(engine).app())) as client:
+            return await scenario(client)
+
+    shards, status, error = asyncio.run(main())
+    assert {shard["name"]: shard["chunks"] for shard in shards["shards"]} == {
+        "cardiologia": 2, COLLECTION_NAME: 2, "nefrologia-pediatrica": 1}
+    assert (status, error) == (400, "Unknown shards: oncologia")
+
+
+def test_rebuild_one_shard_and_change_sharding(corpus):
+    chroma_path, embeddings = corpus
+    populate_database.update_database()
+
+    populate_database.drop_shards(["cardiologia"])
+    summary = populate_database.update_database()
+    assert (summary["files_changed"], summary["files_unchanged"], summary["added"]) == (1, 2, 2)
+    assert embeddings.stats()["misses"] == 5  # re-ingested from the embedding cache
+
+    # Everything moves back into the one collection; the old shards are emptied.
+    running = open_engine(chroma_path, embeddings)
+    summary = populate_database.update_database(sharding="none")
+    assert (summary["deleted"], summary["added"]) == (3, 3)
+    assert read_shard_names(str(chroma_path)) == [COLLECTION_NAME]
+    engine = open_engine(chroma_path, embeddings)
+    assert engine.store.count() == 5 and engine.lexical_index.count() == 5
+    # An engine opened before the update follows the new shard list.
+    assert running.shard_names == [COLLECTION_NAME]
+    assert running.lexical_index.names == [COLLECTION_NAME]
+    assert len(running.retrieve("fosfomicina", k=5)) == 5
+    leftover = ShardedStore(lambda name: get_vector_store("numpy", str(chroma_path), name), ["cardiologia"])
+    assert leftover.count() == 0
+
+
+def test_rebuild_shard_uses_the_stored_sharding(corpus):
+    chroma_path, embeddings = corpus
+    populate_database.update_database(sharding="hash:2")
+    name = shard_for(os.path.join(populate_database.DATA_PATH, "norma.pdf"), "hash:2", populate_database.DATA_PATH)
+
+    # The process default is "folder", under which no file is in this shard.
+    populate_database.drop_shards([name])
+    summary = populate_database.update_database(sharding="hash:2")
+    assert summary["files_changed"] >= 1 and summary["added"] >= 2
+    assert open_engine(chroma_path, embeddings).store.count() == 5
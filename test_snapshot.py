@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+from benchmarks.stubs import StubEmbeddings
+from query_data import RagEngine
+from shards import ShardedLexicalIndex, ShardedStore, read_shard_names, write_shard_names
+from snapshot import SNAPSHOT_FILE, Snapshot, export_snapshot, import_snapshot
+from ingest_manifest import bump_corpus_version, read_corpus_version
+from vector_store import get_vector_store
+
+CHUNKS = {
+    "cardiologia": {
+        "data/cardiologia/hta.pdf:0:0": "Hipertensão arterial: iniciar IECA.",
+        "data/cardiologia/hta.pdf:1:0": "Fibrilhação auricular: anticoagulação oral.",
+    },
+    "medicine-research": {
+        "data/norma.pdf:3:0": "Bacteriúria assintomática na grávida: fosfomicina 3g em toma única.",
+        "data/norma.pdf:5:0": "Cistite recorrente: considerar profilaxia.",
+        "data/norma.pdf:6:0": "Pielonefrite aguda: ceftriaxona e urocultura.",
+    },
+}
+
+
+@pytest.fixture
+def source(tmp_path):
+    # A two-shard numpy store with BM25 indexes, as populate_database leaves it.
+    path = str(tmp_path / "source")
+    embeddings = StubEmbeddings()
+    lexical_index = ShardedLexicalIndex(path, list(CHUNKS))
+    for name, chunks in CHUNKS.items():
+        metadatas = [{"id": chunk_id, "source": chunk_id.split(":")[0], "page": int(chunk_id.split(":")[1])}
+                     for chunk_id in chunks]
+        get_vector_store("numpy", path, name).upsert(
+            list(chunks), embeddings.embed_documents(list(chunks.values())), list(chunks.values()), metadatas)
+        lexical_index.index(name).upsert(list(chunks), list(chunks.values()), metadatas)
+    lexical_index.commit()
+    write_shard_names(path, list(CHUNKS))
+    bump_corpus_version(path)
+    return path, embeddings
+
+
+def engine(path, embeddings, backend):
+    names = read_shard_names(path)
+    return RagEngine(persist_directory=path, embedding_function=embeddings, backend=backend,
+                     lexical_index=ShardedLexicalIndex(path, names), shard_names=names, report_context=False)
+
+
+def test_replica_serves_the_same_results_from_the_snapshot(source, tmp_path):
+    path, embeddings = source
+    snapshot_path = str(tmp_path / "corpus.snap")
+    header = export_snapshot(snapshot_path, path, backend="numpy")
+    assert header["rows"] == 5 and [shard["name"] for shard in header["shards"]] == list(CHUNKS)
+
+    replica = str(tmp_path / "replica")
+    import_snapshot(snapshot_path, replica)
+    assert read_shard_names(replica) == list(CHUNKS)
+    assert read_corpus_version(replica) == read_corpus_version(path)
+
+    original, served = engine(path, embeddings, "numpy"), engine(replica, embeddings, "snapshot")
+    for question in ("fosfomicina na grávida", "anticoagulação", "cistite recorrente profilaxia"):
+        expected = [(doc.page_content, doc.metadata) for doc, _score in original.retrieve(question, k=3)]
+        assert [(doc.page_content, doc.metadata) for doc, _score in served.retrieve(question, k=3)] == expected
+    restricted = served.retrieve("fosfomicina", k=3, shards=["cardiologia"])
+    assert {doc.metadata["source"] for doc, _score in restricted} == {"data/cardiologia/hta.pdf"}
+
+    store = served.store.shard("medicine-research")
+    assert store.count() == 3
+    hits = store.search(embeddings.embed_documents(["pielonefrite"]), k=5, where={"page": 6})[0]
+    assert [doc.metadata["id"] for doc, _score in hits] == ["data/norma.pdf:6:0"]
+    with pytest.raises(RuntimeError, match="read-only"):
+        store.delete(["data/norma.pdf:6:0"])
+
+
+def test_snapshot_layout_and_checksum(source, tmp_path):
+    path, _embeddings = source
+    snapshot_path = str(tmp_path / "corpus.snap")
+    export_snapshot(snapshot_path, path, backend="numpy")
+
+    snapshot = Snapshot(snapshot_path, verify=True)
+    assert snapshot.vectors.shape == (5, 256) and isinstance(snapshot.vectors.base, np.memmap)
+    assert np.allclose(np.linalg.norm(snapshot.vectors, axis=1), 1.0)
+    row = snapshot.row_of("data/norma.pdf:5:0")
+    assert snapshot.document(row).page_content == "Cistite recorrente: considerar profilaxia."
+    assert snapshot.row_of("data/missing.pdf:0:0") is None
+    for section in snapshot.header["sections"].values():
+        assert (snapshot.data_offset + section["offset"]) % 64 == 0
+
+    # Re-exporting from the snapshot backend gives an identical corpus.
+    copy = str(tmp_path / "copy")
+    import_snapshot(snapshot_path, copy, lexical=False)
+    export_snapshot(str(tmp_path / "again.snap"), copy, backend="snapshot")
+    assert Snapshot(str(tmp_path / "again.snap")).header["sha256"] == snapshot.header["sha256"]
+
+    with open(snapshot_path, "r+b") as file:
+        file.seek(-3, 2)
+        file.write(b"XYZ")
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        import_snapshot(snapshot_path, str(tmp_path / "bad"))
+    assert not (tmp_path / "bad" / SNAPSHOT_FILE).exists()
+
+
+def test_empty_store_round_trips(tmp_path):
+    path = str(tmp_path / "empty")
+    get_vector_store("numpy", path, "medicine-research")
+    export_snapshot(str(tmp_path / "empty.snap"), path, backend="numpy")
+    import_snapshot(str(tmp_path / "empty.snap"), str(tmp_path / "replica"))
+    store = ShardedStore(lambda name: get_vector_store("snapshot", str(tmp_path / "replica"), name),
+                         read_shard_names(str(tmp_path / "replica")))
+    assert store.count() == 0 and store.search([[1.0, 0.0]], k=3) == [[]]
+
+
+def test_running_replica_serves_a_newly_imported_snapshot(source, tmp_path):
+    path, embeddings = source
+    replica = str(tmp_path / "replica")
+    export_snapshot(str(tmp_path / "first.snap"), path, backend="numpy")
+    import_snapshot(str(tmp_path / "first.snap"), replica)
+    running = engine(replica, embeddings, "snapshot")
+    assert running.store.count() == 5
+
+    # The source drops one chunk and rewrites another, then a new snapshot goes out.
+    store = get_vector_store("numpy", path, "medicine-research")
+    store.delete(["data/norma.pdf:6:0"])
+    text = "Cistite recorrente: profilaxia com nitrofurantoína."
+    metadata = {"id": "data/norma.pdf:5:0", "source": "data/norma.pdf", "page": 5}
+    store.upsert([metadata["id"]], embeddings.embed_documents([text]), [text], [metadata])
+    bump_corpus_version(path)
+    export_snapshot(str(tmp_path / "second.snap"), path, backend="numpy")
+    import_snapshot(str(tmp_path / "second.snap"), replica)
+
+    fresh = engine(replica, embeddings, "snapshot")
+    assert running.store.count() == 4
+    for question in ("nitrofurantoína", "pielonefrite ceftriaxona", "anticoagulação"):
+        expected = [(doc.page_content, doc.metadata) for doc, _score in fresh.retrieve(question, k=4)]
+        assert [(doc.page_content, doc.metadata) for doc, _score in running.retrieve(question, k=4)] == expected
+    assert all(doc.page_content for doc, _score in running.retrieve("pielonefrite", k=4))
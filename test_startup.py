@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+
+from benchmarks.bench_startup import LAZY, measure_once
+from warmup import selected, warm_up
+
+
+@pytest.mark.parametrize("entry", ["app", "query_data", "populate_database", "voice_recorder"])
+def test_entry_points_load_heavy_packages_lazily(entry):
+    _seconds, _packages, loaded = measure_once(entry)
+    assert not {name.split(".")[0] for name in loaded} & LAZY
+
+
+def test_warm_up_runs_the_selected_tasks_in_the_background(capsys):
+    ran = []
+    started = threading.Event()
+
+    def slow():
+        started.wait(5)
+        ran.append("engine")
+
+    def broken():
+        raise RuntimeError("no model")
+
+    tasks = selected({"engine": slow, "voice": broken, "other": lambda: ran.append("other")}, "engine, voice")
+    assert list(tasks) == ["engine", "voice"]
+    thread = warm_up(tasks)
+    assert ran == []  # startup does not wait for it
+    started.set()
+    thread.join(5)
+    assert ran == ["engine"]
+    assert "Warm-up of voice failed (RuntimeError: no model)" in capsys.readouterr().out
+    assert warm_up(selected({"voice": broken}, "")) is None
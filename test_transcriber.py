@@ -0,0 +1,83 @@
+import threading
+
+import numpy as np
+from scipy.io import wavfile
+
+from transcriber import SAMPLE_RATE, Transcriber, load_wav
+
+FIXTURE_16K = "benchmarks/datasets/voice/dictation_16k.wav"
+FIXTURE_44K = "benchmarks/datasets/voice/dictation_44k.wav"
+
+
+class FakeWhisper:
+    # Stands in for a whisper model: "transcribes" audio as its duration.
+
+    def __init__(self, delay=None):
+        self.calls = []
+        self.delay = delay
+
+    def transcribe(self, audio, **options):
+        assert audio.dtype == np.float32 and audio.ndim == 1
+        if self.delay:
+            self.delay.wait()
+        self.calls.append(len(audio))
+        return {"text": f" {len(audio) / SAMPLE_RATE:.1f}s"}
+
+
+def make_transcriber(model):
+    loads = []
+
+    def loader(name):
+        loads.append(name)
+        return model
+
+    return Transcriber(model_name="tiny", model_loader=loader), loads
+
+
+def test_model_loads_once_and_accepts_arrays_and_wavs():
+    transcriber, loads = make_transcriber(FakeWhisper())
+    assert loads == []
+
+    assert transcriber.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32)) == "1.0s"
+    assert transcriber.transcribe(load_wav(FIXTURE_16K)) == "4.0s"
+    assert transcriber.transcribe(FIXTURE_44K) == "4.0s"
+    # 44.1 kHz int16 input is converted and resampled in memory.
+    rate, samples = wavfile.read(FIXTURE_44K)
+    assert transcriber.transcribe(samples, rate=rate) == "4.0s"
+    assert loads == ["tiny"]
+
+
+def test_wav_fixtures_agree_after_resampling():
+    native = load_wav(FIXTURE_16K)
+    resampled = load_wav(FIXTURE_44K)
+    assert len(native) == len(resampled) == 4 * SAMPLE_RATE
+    assert np.abs(native - resampled).max() < 0.01
+
+
+def test_streaming_transcribes_segments_while_recording():
+    release = threading.Event()
+    model = FakeWhisper(delay=release)
+    transcriber, _loads = make_transcriber(model)
+    audio = load_wav(FIXTURE_16K)
+
+    stream = transcriber.start_stream(min_segment_seconds=1.0)
+    chunk = SAMPLE_RATE // 5
+    for start in range(0, len(audio), chunk):
+        stream.feed(audio[start:start + chunk])
+        if start + chunk == int(1.6 * SAMPLE_RATE):
+            stream.pause()  # End of the first utterance.
+    assert stream.text() == ""  # The first segment is still being decoded.
+    release.set()
+
+    assert stream.finish() == "1.6s 2.4s"
+    assert model.calls == [int(1.6 * SAMPLE_RATE), int(2.4 * SAMPLE_RATE)]
+
+
+def test_long_dictation_is_cut_before_whispers_window():
+    model = FakeWhisper()
+    transcriber, _loads = make_transcriber(model)
+    stream = transcriber.start_stream(max_segment_seconds=2)
+    for _ in range(25):
+        stream.feed(np.zeros(SAMPLE_RATE // 5, dtype=np.float32))
+    stream.pause()  # The last second is cut at the pause.
+    assert stream.finish() == "2.0s 2.0s 1.0s"
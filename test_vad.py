@@ -0,0 +1,122 @@
+import json
+
+import numpy as np
+from scipy.io import wavfile
+
+from benchmarks.stubs import FakeInputStream
+from transcriber import SAMPLE_RATE, Transcriber, load_wav
+from vad import StreamResampler, VoiceActivityDetector, frame_features, trim_silence
+from voice_recorder import record_and_transcribe, record_audio
+
+FIXTURE_16K = "benchmarks/datasets/voice/dictation_16k.wav"
+FIXTURE_44K = "benchmarks/datasets/voice/dictation_44k.wav"
+with open("benchmarks/datasets/voice/dictation.json") as file:
+    SPEECH = json.load(file)["speech"]
+
+
+def fixture_stream(**kwargs):
+    def factory(samplerate, channels, dtype):
+        factory.stream = FakeInputStream(FIXTURE_44K, samplerate=samplerate, channels=channels, **kwargs)
+        return factory.stream
+    return factory
+
+
+def test_frame_features_separate_silence_tones_and_noise():
+    t = np.arange(480) / SAMPLE_RATE
+    frames = np.stack([
+        np.zeros(480),
+        0.3 * np.sin(2 * np.pi * 150 * t),
+        0.05 * np.random.default_rng(0).standard_normal(480),
+    ]).astype(np.float32)
+    energy_db, zcr = frame_features(frames)
+    assert energy_db[0] < -90 < -30 < energy_db[2] < energy_db[1]
+    assert zcr[1] < 0.05 < 0.3 < zcr[2]
+
+
+def test_streaming_resampler_matches_one_shot_and_keeps_pitch():
+    rate, samples = wavfile.read(FIXTURE_44K)
+    audio = samples.astype(np.float32) / 32768
+    whole = StreamResampler(rate).process(audio)
+    resampler = StreamResampler(rate)
+    streamed = np.concatenate([resampler.process(audio[i:i + 1764]) for i in range(0, len(audio), 1764)])
+    assert len(streamed) == len(whole) == 4 * SAMPLE_RATE
+    assert np.allclose(streamed, whole, atol=1e-5)
+
+    tone = np.sin(2 * np.pi * 1000 * np.arange(rate) / rate).astype(np.float32)
+    spectrum = np.abs(np.fft.rfft(StreamResampler(rate).process(tone)))
+    assert np.argmax(spectrum) == 1000
+    # A 12 kHz tone is above the new Nyquist and must not alias to 4 kHz.
+    alias = np.sin(2 * np.pi * 12000 * np.arange(rate) / rate).astype(np.float32)
+    assert np.abs(StreamResampler(rate).process(alias)[SAMPLE_RATE // 10:]).max() < 0.01
+
+
+def test_segments_follow_speech_with_pre_roll_and_tail():
+    audio = load_wav(FIXTURE_16K)
+    events = []
+    vad = VoiceActivityDetector(on_audio=lambda piece: events.append(len(piece)),
+                                on_pause=lambda: events.append("pause"))
+    for start in range(0, len(audio), 1600):
+        vad.process(audio[start:start + 1600])
+    vad.finish()
+
+    segments, current = [], 0
+    for event in events:
+        if event == "pause":
+            segments.append(current / SAMPLE_RATE)
+            current = 0
+        else:
+            current += event
+    (first_start, first_end), (_second_start, second_end) = SPEECH
+    # The first segment runs from its 0.3 s pre-roll to its 0.15 s tail; the
+    # second starts where that tail ended and has a tail of its own.
+    assert abs(segments[0] - (first_end - first_start + 0.3 + 0.15)) < 0.1
+    assert abs(segments[1] - (second_end - first_end)) < 0.1
+
+
+def test_trim_silence_drops_leading_and_trailing_silence():
+    trimmed = trim_silence(load_wav(FIXTURE_44K, rate=44100), rate=44100)
+    speech = sum(end - start for start, end in SPEECH)
+    # Pre-roll, the 0.4 s inner pause and the tail are kept.
+    assert speech + 0.4 < len(trimmed) / SAMPLE_RATE < speech + 1.0
+
+
+def test_record_audio_stops_after_silence_and_trims():
+    factory = fixture_stream()
+    utterance = record_audio(fs=44100, silence_duration=1, stream_factory=factory)
+    speech_end = SPEECH[-1][1]
+    assert speech_end + 1 <= factory.stream.frames_read / 44100 < speech_end + 1.2
+    assert 2.9 < len(utterance) / SAMPLE_RATE < 3.3
+
+
+def test_record_audio_gives_up_without_speech(tmp_path):
+    wavfile.write(tmp_path / "silence.wav", 44100, np.zeros(44100, dtype=np.int16))
+
+    def factory(samplerate, channels, dtype):
+        factory.stream = FakeInputStream(str(tmp_path / "silence.wav"), samplerate=samplerate, channels=channels)
+        return factory.stream
+
+    utterance = record_audio(fs=44100, stream_factory=factory, no_speech_seconds=2)
+    assert len(utterance) == 0
+    assert abs(factory.stream.frames_read / 44100 - 2) < 0.15
+
+
+def test_ring_buffer_stays_bounded_for_long_dictations():
+    factory = fixture_stream(loops=30)
+    received = []
+    # The loop seam has 1.4 s of silence, so wait longer before stopping.
+    record_audio(fs=48000, silence_duration=2, on_audio=lambda piece: received.append(len(piece)),
+                 stream_factory=factory)
+    # Two minutes of dictation, but the detector holds under two seconds.
+    assert sum(received) / SAMPLE_RATE > 80
+    vad = VoiceActivityDetector()
+    assert vad._ring.nbytes < 2 * SAMPLE_RATE * 4
+
+
+def test_record_and_transcribe_from_fixture():
+    class Model:
+        def transcribe(self, audio, **options):
+            return {"text": f"{len(audio) / SAMPLE_RATE:.1f}s"}
+
+    transcriber = Transcriber(model_loader=lambda name: Model())
+    text = record_and_transcribe(fs=44100, transcriber=transcriber, stream_factory=fixture_stream())
+    assert text == "1.5s 1.6s"
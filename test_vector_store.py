@@ -0,0 +1,188 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from vector_store import NumpyStore, get_vector_store
+
+
+def random_vectors(count, dimensions=32, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dimensions)).astype(np.float32)
+
+
+def fill(store, vectors, prefix="c"):
+    ids = [f"{prefix}{i}" for i in range(len(vectors))]
+    store.upsert(ids, vectors.tolist(), [f"text {i}" for i in ids],
+                 [{"id": i, "source": f"s{n % 3}"} for n, i in enumerate(ids)])
+    return ids
+
+
+def exact_top_k(vectors, query, k):
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(np.argsort(-(unit @ (query / np.linalg.norm(query))))[:k])
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_numpy_store_matches_exact_search(tmp_path, quantize):
+    vectors = random_vectors(300)
+    store = NumpyStore(str(tmp_path), "test", quantize=quantize)
+    fill(store, vectors)
+
+    queries = random_vectors(5, seed=1)
+    batched = store.search(queries.tolist(), k=5)
+    for query, results in zip(queries, batched):
+        expected = [f"c{i}" for i in exact_top_k(vectors, query, 5)]
+        assert [doc.metadata["id"] for doc, _ in results] == expected
+        single = store.search([query.tolist()], k=5)[0]
+        assert [doc for doc, _ in results] == [doc for doc, _ in single]
+        assert [score for _, score in results] == pytest.approx([score for _, score in single], abs=1e-5)
+
+
+def test_upsert_delete_filter_and_reopen(tmp_path):
+    vectors = random_vectors(50)
+    store = NumpyStore(str(tmp_path), "test")
+    fill(store, vectors)
+
+    target = vectors[7] * -1
+    store.upsert(["c7"], [target.tolist()], ["replaced"], [{"id": "c7", "source": "s1"}])
+    store.delete(["c8"])
+    assert store.count() == 49
+
+    best, score = store.search([target.tolist()], k=1)[0][0]
+    assert best.page_content == "replaced"
+    assert score == pytest.approx(1.0, abs=1e-5)
+    assert all(doc.metadata["source"] == "s2" for doc, _ in store.search([target.tolist()], k=10, where={"source": "s2"})[0])
+    assert "c8" not in [doc.metadata["id"] for doc, _ in store.search([vectors[8].tolist()], k=50)[0]]
+
+    store.optimize(max_dead_fraction=0.0)
+    reopened = NumpyStore(str(tmp_path), "test")
+    assert reopened.count() == 49
+    assert reopened.search([target.tolist()], k=1)[0][0][0].page_content == "replaced"
+    assert sum(len(ids) for ids, _, _ in reopened.iter_documents(page_size=10)) == 49
+
+
+def test_backends_agree(tmp_path):
+    # Chroma ranks by L2, which matches cosine ranking on unit vectors.
+    vectors = random_vectors(100)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    numpy_store = get_vector_store("numpy", persist_directory=str(tmp_path / "n"))
+    chroma_store = get_vector_store("chroma", persist_directory=str(tmp_path / "c"))
+    for store in (numpy_store, chroma_store):
+        fill(store, vectors)
+
+    query = random_vectors(1, seed=3).tolist()
+    assert ([doc.metadata["id"] for doc, _ in numpy_store.search(query, k=3)[0]] ==
+            [doc.metadata["id"] for doc, _ in chroma_store.search(query, k=3)[0]])
+
+
+def test_reduced_dimensions_rescore_at_full_precision(tmp_path):
+    vectors = random_vectors(300, dimensions=64)
+    fill(NumpyStore(str(tmp_path), "test"), vectors[:200])
+
+    # Turning it on for an existing store builds the truncated copy when a search needs it.
+    directory = tmp_path / "numpy" / "test"
+    store = NumpyStore(str(tmp_path), "test", search_dimensions=16, rescore_factor=60)
+    assert store._reduced is None and not (directory / "vectors.d16.f32").exists()
+    store.search([vectors[0].tolist()], k=1)
+    assert store._reduced.shape == (200, 16)
+    ids = fill(store, vectors[200:], prefix="d")
+    assert (directory / "vectors.d16.f32").stat().st_size == 300 * 16 * 4
+
+    # Opening with another setting leaves this copy alone, and it stays in step.
+    other = NumpyStore(str(tmp_path), "test", search_dimensions=8)
+    other.search([vectors[0].tolist()], k=1)
+    assert (directory / "vectors.d16.f32").stat().st_size == 300 * 16 * 4
+    store.delete(ids[:10])
+    store.optimize(max_dead_fraction=0.0)
+    assert sorted(path.name for path in directory.glob("vectors.d*")) == ["vectors.d16.f32"]
+
+    alive = np.concatenate([vectors[:200], vectors[210:]])
+    names = [f"c{i}" for i in range(200)] + ids[10:]
+    query = random_vectors(1, dimensions=64, seed=1)[0]
+    results = store.search([query.tolist()], k=5)[0]
+    # Every row is a candidate here, so the rescored top-k is the exact one.
+    assert [doc.metadata["id"] for doc, _ in results] == [names[i] for i in exact_top_k(alive, query, 5)]
+    unit = alive / np.linalg.norm(alive, axis=1, keepdims=True)
+    expected = np.sort(unit @ (query / np.linalg.norm(query)))[::-1][:5]
+    assert [score for _, score in results] == pytest.approx(expected.tolist(), abs=1e-5)
+
+    with pytest.raises(ValueError):
+        NumpyStore(str(tmp_path), "other", quantize=True, search_dimensions=16)
+
+
+def test_reduced_copy_follows_upserts_made_with_the_setting_off(tmp_path):
+    vectors = random_vectors(120, dimensions=64)
+    directory = tmp_path / "numpy" / "test"
+    fill(NumpyStore(str(tmp_path), "test", search_dimensions=16), vectors[:60])
+    assert (directory / "vectors.d16.f32").stat().st_size == 60 * 16 * 4
+
+    # A writer without the setting still appends to the complete copy, so it is not rebuilt.
+    fill(NumpyStore(str(tmp_path), "test"), vectors[60:], prefix="d")
+    assert (directory / "vectors.d16.f32").stat().st_size == 120 * 16 * 4
+    reopened = NumpyStore(str(tmp_path), "test", search_dimensions=16, rescore_factor=120)
+    assert reopened._reduced.shape == (120, 16)
+    assert reopened.search([vectors[90].tolist()], k=1)[0][0][0].metadata["id"] == "d30"
+
+
+class FailingCommit:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        raise sqlite3.OperationalError("disk I/O error")
+
+
+def test_upsert_recovers_from_writes_that_never_committed(tmp_path):
+    vectors = random_vectors(6)
+    store = NumpyStore(str(tmp_path), "test")
+    fill(store, vectors[:3])
+
+    # A crash between appending the vectors and committing their rows...
+    with open(tmp_path / "numpy" / "test" / "vectors.f32", "ab") as file:
+        file.write(vectors[3].tobytes())
+    # ...and a commit that raises.
+    store._conn = FailingCommit(store._conn)
+    with pytest.raises(sqlite3.OperationalError):
+        store.upsert(["x"], [vectors[3].tolist()], ["x"], [{"id": "x"}])
+    store._conn = store._conn._conn
+    assert store.count() == 3
+
+    reopened = NumpyStore(str(tmp_path), "test")
+    reopened.upsert(["d", "e", "d"], vectors[3:6].tolist(), ["old d", "e", "new d"],
+                    [{"id": "d"}, {"id": "e"}, {"id": "d"}])
+    assert reopened.count() == 5
+    for name, vector in (("c1", vectors[1]), ("e", vectors[4]), ("d", vectors[5])):
+        best, score = reopened.search([vector.tolist()], k=1)[0][0]
+        assert best.metadata["id"] == name and score == pytest.approx(1.0, abs=1e-5)
+    assert reopened.search([vectors[5].tolist()], k=1)[0][0][0].page_content == "new d"
+
+
+def test_open_store_sees_writes_from_another_connection(tmp_path):
+    vectors = random_vectors(20)
+    reader = NumpyStore(str(tmp_path), "test")
+    writer = NumpyStore(str(tmp_path), "test")
+    ids = fill(writer, vectors[:10])
+    assert reader.count() == 10
+
+    writer.delete(ids[:5])
+    fill(writer, vectors[10:], prefix="d")
+    writer.optimize(max_dead_fraction=0.0)
+    assert reader.count() == 15
+    best, score = reader.search([vectors[12].tolist()], k=1)[0][0]
+    assert best.metadata["id"] == "d2" and score == pytest.approx(1.0, abs=1e-5)
+
+
+def test_update_metadata_keeps_the_vectors(tmp_path):
+    vectors = random_vectors(10)
+    store = NumpyStore(str(tmp_path), "test")
+    ids = fill(store, vectors)
+    reader = NumpyStore(str(tmp_path), "test")
+    assert len(reader.search([vectors[3].tolist()], k=10, where={"source": "s0"})[0]) == 4
+
+    store.update_metadata(["c3"], [{"id": "c3", "source": "s0", "chunk_index": 7}])
+    top, score = reader.search([vectors[3].tolist()], k=1, where={"source": "s0"})[0][0]
+    assert top.metadata == {"id": "c3", "source": "s0", "chunk_index": 7} and score == pytest.approx(1.0)
+    assert reader.count() == len(ids) and store._rows == len(ids)
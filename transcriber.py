@@ -0,0 +1,158 @@
+#transcriber.py
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+
+import numpy as np
+
+from metrics import get_metrics
+
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+SAMPLE_RATE = 16000  # Whisper's input rate
+# Whisper decodes 30 s windows; longer dictations are cut before that.
+MAX_SEGMENT_SECONDS = 25
+MIN_SEGMENT_SECONDS = 1.0
+
+
+def load_whisper_model(name):
+    # openai-whisper pulls in torch, so only import it when a model is needed.
+    import whisper
+    return whisper.load_model(name)
+
+
+def to_mono_float32(audio):
+    audio = np.asarray(audio)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if audio.dtype == np.uint8:
+        return (audio.astype(np.float32) - 128) / 128
+    if audio.dtype.kind == "i":
+        return audio.astype(np.float32) / -np.iinfo(audio.dtype).min
+    return audio.astype(np.float32, copy=False)
+
+
+def resample(audio, rate, target_rate=SAMPLE_RATE):
+    if rate == target_rate:
+        return audio
+    from scipy.signal import resample_poly
+    divisor = gcd(int(rate), int(target_rate))
+    return resample_poly(audio, target_rate // divisor, rate // divisor).astype(np.float32)
+
+
+def load_wav(path, rate=SAMPLE_RATE):
+    from scipy.io import wavfile
+    file_rate, audio = wavfile.read(path)
+    return resample(to_mono_float32(audio), file_rate, rate)
+
+
+class Transcriber:
+    # Loads the Whisper model once and keeps it for the life of the process.
+    # Takes audio as 16 kHz float arrays (or a WAV path), so recordings never
+    # go through a temporary file.
+
+    def __init__(self, model_name=WHISPER_MODEL, model_loader=load_whisper_model, language=None, metrics=None):
+        self.model_name = model_name
+        self.model_loader = model_loader
+        self.language = language
+        self.metrics = metrics
+        self._model = None
+        self._load_lock = threading.Lock()
+        # One model instance is not safe to run from several threads at once.
+        self._transcribe_lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._load_lock:
+            if self._model is None:
+                self._model = self.model_loader(self.model_name)
+            return self._model
+
+    def transcribe(self, audio, rate=SAMPLE_RATE):
+        if isinstance(audio, str):
+            audio = load_wav(audio)
+        else:
+            audio = resample(to_mono_float32(audio), rate)
+        if not len(audio):
+            return ""
+        options = {"fp16": False}
+        if self.language:
+            options["language"] = self.language
+        model = self.model
+        if self.metrics is None:
+            with self._transcribe_lock:
+                return model.transcribe(audio, **options)["text"].strip()
+        with self.metrics.trace("transcribe") as trace, self._transcribe_lock:
+            with trace.stage("transcribe"):
+                result = model.transcribe(audio, **options)
+            trace.record.update(model=self.model_name, audio_seconds=round(len(audio) / SAMPLE_RATE, 3))
+        return result["text"].strip()
+
+    def start_stream(self, max_segment_seconds=MAX_SEGMENT_SECONDS, min_segment_seconds=MIN_SEGMENT_SECONDS):
+        return StreamingTranscription(self, max_segment_seconds, min_segment_seconds)
+
+
+class StreamingTranscription:
+    # Transcribes a recording in segments while it is still being captured.
+    # The recorder feeds 16 kHz audio as it arrives and calls pause() at gaps
+    # in speech; each finished segment is transcribed on a background thread,
+    # so when the speaker stops only the last segment is left to decode.
+
+    def __init__(self, transcriber, max_segment_seconds=MAX_SEGMENT_SECONDS,
+                 min_segment_seconds=MIN_SEGMENT_SECONDS):
+        self.transcriber = transcriber
+        self.max_segment_samples = int(max_segment_seconds * SAMPLE_RATE)
+        self.min_segment_samples = int(min_segment_seconds * SAMPLE_RATE)
+        self._pending = []
+        self._pending_samples = 0
+        self._segments = []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def feed(self, samples):
+        # Copied: recorders may reuse their buffers.
+        samples = np.array(samples, dtype=np.float32).reshape(-1)
+        self._pending.append(samples)
+        self._pending_samples += len(samples)
+        if self._pending_samples >= self.max_segment_samples:
+            self._commit()
+
+    def pause(self):
+        # A gap in speech is a clean place to cut; very short segments wait
+        # for more audio, since Whisper does poorly on fragments.
+        if self._pending_samples >= self.min_segment_samples:
+            self._commit()
+
+    def text(self):
+        # What has been transcribed so far, without waiting.
+        return _join([segment.result() for segment in self._segments if segment.done()])
+
+    def finish(self):
+        if self._pending_samples:
+            self._commit()
+        try:
+            return _join([segment.result() for segment in self._segments])
+        finally:
+            self._executor.shutdown()
+
+    def _commit(self):
+        audio = np.concatenate(self._pending)
+        self._pending = []
+        self._pending_samples = 0
+        self._segments.append(self._executor.submit(self.transcriber.transcribe, audio))
+
+
+def _join(texts):
+    return " ".join(text for text in texts if text)
+
+
+_transcriber = None
+_transcriber_lock = threading.Lock()
+
+
+def get_transcriber():
+    global _transcriber
+    with _transcriber_lock:
+        if _transcriber is None:
+            _transcriber = Transcriber(metrics=get_metrics())
+        return _transcriber
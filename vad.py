@@ -0,0 +1,211 @@
+#vad.py
+
+import math
+
+import numpy as np
+
+from transcriber import SAMPLE_RATE
+
+FRAME_MS = 30
+PRE_ROLL_MS = 300   # audio kept before the first speech frame, so onsets are not clipped
+HANGOVER_MS = 300   # gaps shorter than this stay inside the segment
+TAIL_MS = 150       # audio kept after the last speech frame
+MIN_SPEECH_MS = 90  # clicks shorter than this do not count as having spoken
+MARGIN_DB = 12      # speech must be this far above the noise floor...
+MIN_SPEECH_DB = -50 # ...and above this absolute level
+ZCR_THRESHOLD = 0.3 # unvoiced consonants: weak but with many zero crossings
+
+
+def frame_features(frames):
+    # frames: (n, frame_length). Returns per-frame energy in dB and the
+    # fraction of adjacent samples that change sign.
+    energy_db = 10 * np.log10(np.einsum("ij,ij->i", frames, frames) / frames.shape[1] + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frames.shape[1] - 1)
+    return energy_db, zcr
+
+
+class StreamResampler:
+    # Converts a stream to Whisper's rate chunk by chunk. Downsampling runs a
+    # stateful low-pass first so nothing above the new Nyquist folds back,
+    # then interpolates linearly; the filter state and fractional position
+    # carry over, so chunked output matches resampling the whole signal.
+
+    def __init__(self, rate, target_rate=SAMPLE_RATE):
+        self.rate = rate
+        self.target_rate = target_rate
+        self.step = rate / target_rate
+        self._next = 0.0  # next output position, in input samples from the chunk start
+        self._last = 0.0
+        self._sos = None
+        if rate > target_rate:
+            from scipy.signal import butter
+            self._sos = butter(8, 0.45 * target_rate, fs=rate, output="sos")
+            self._zi = np.zeros((self._sos.shape[0], 2))
+
+    def process(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if self.rate == self.target_rate or not len(chunk):
+            return chunk
+        if self._sos is not None:
+            from scipy.signal import sosfilt
+            chunk, self._zi = sosfilt(self._sos, chunk, zi=self._zi)
+
+        last_index = len(chunk) - 1
+        if self._next > last_index:
+            count = 0
+        else:
+            count = int((last_index - self._next) // self.step) + 1
+        positions = self._next + self.step * np.arange(count)
+        # Index 0 is the previous chunk's last sample, for positions in [-1, 0).
+        padded = np.concatenate(([self._last], chunk))
+        left = np.floor(positions).astype(np.int64) + 1
+        fraction = positions + 1 - left
+        right = np.minimum(left + 1, len(padded) - 1)
+        output = padded[left] * (1 - fraction) + padded[right] * fraction
+
+        self._next += count * self.step - len(chunk)
+        self._last = chunk[-1]
+        return output.astype(np.float32)
+
+
+class VoiceActivityDetector:
+    # Endpoints a 16 kHz stream. Audio goes into a preallocated ring buffer;
+    # each complete frame is classified from its energy (against an adaptive
+    # noise floor) and zero-crossing rate, computed for all new frames at once.
+    # Speech is passed to `on_audio` with a pre-roll before each onset and a
+    # short tail after it; leading silence and the silence after the tail are
+    # dropped. `on_pause` fires when a gap outlasts the hangover, and `done` is
+    # set once `silence_duration` of silence follows speech. Memory does not
+    # grow with the length of the recording.
+
+    def __init__(self, on_audio=None, on_pause=None, rate=SAMPLE_RATE, silence_duration=1.0,
+                 frame_ms=FRAME_MS, pre_roll_ms=PRE_ROLL_MS, hangover_ms=HANGOVER_MS, tail_ms=TAIL_MS,
+                 min_speech_ms=MIN_SPEECH_MS, margin_db=MARGIN_DB, min_speech_db=MIN_SPEECH_DB,
+                 zcr_threshold=ZCR_THRESHOLD, max_chunk_seconds=1.0):
+        self.on_audio = on_audio
+        self.on_pause = on_pause
+        self.frame_length = int(rate * frame_ms / 1000)
+        self.pre_roll_frames = math.ceil(pre_roll_ms / frame_ms)
+        self.hangover_frames = math.ceil(hangover_ms / frame_ms)
+        self.tail_frames = min(math.ceil(tail_ms / frame_ms), self.hangover_frames)
+        self.min_speech_frames = math.ceil(min_speech_ms / frame_ms)
+        self.end_frames = math.ceil(silence_duration * 1000 / frame_ms)
+        self.margin_db = margin_db
+        self.min_speech_db = min_speech_db
+        self.zcr_threshold = zcr_threshold
+        self.noise_db = min_speech_db - margin_db
+
+        # Room for the pre-roll, a held gap, one incoming chunk and a partial
+        # frame, in whole frames so a frame never wraps around the end.
+        self.max_chunk = int(rate * max_chunk_seconds)
+        capacity_frames = self.pre_roll_frames + self.hangover_frames + math.ceil(self.max_chunk / self.frame_length) + 1
+        self._ring = np.zeros(capacity_frames * self.frame_length, dtype=np.float32)
+        self._written = 0     # samples written, as absolute stream positions
+        self._classified = 0  # samples classified, always whole frames
+        self._emitted = 0     # samples passed on or dropped
+        self._in_speech = False
+        self._silent_frames = 0
+        self.speech_frames = 0
+        self.done = False
+
+    def process(self, samples):
+        # Returns True once the utterance has ended.
+        samples = np.asarray(samples, dtype=np.float32)
+        for start in range(0, len(samples), self.max_chunk):
+            if self.done:
+                break
+            self._write(samples[start:start + self.max_chunk])
+            self._classify()
+        return self.done
+
+    def finish(self):
+        # The stream ended mid-speech: pass on what was held back.
+        if self._in_speech:
+            self._emit(min(self._emitted + self.tail_frames * self.frame_length, self._classified))
+            self._in_speech = False
+            if self.on_pause:
+                self.on_pause()
+
+    def _write(self, samples):
+        capacity = len(self._ring)
+        position = self._written % capacity
+        first = min(len(samples), capacity - position)
+        self._ring[position:position + first] = samples[:first]
+        self._ring[:len(samples) - first] = samples[first:]
+        self._written += len(samples)
+
+    def _frames(self, start, count):
+        # (count, frame_length) views of the ring; two when they wrap.
+        capacity_frames = len(self._ring) // self.frame_length
+        first_frame = (start // self.frame_length) % capacity_frames
+        head = min(count, capacity_frames - first_frame)
+        frames = self._ring.reshape(capacity_frames, self.frame_length)
+        return [frames[first_frame:first_frame + head], frames[:count - head]]
+
+    def _classify(self):
+        count = (self._written - self._classified) // self.frame_length
+        if not count:
+            return
+        features = [frame_features(part) for part in self._frames(self._classified, count) if len(part)]
+        energy_db = np.concatenate([energy for energy, _zcr in features])
+        zcr = np.concatenate([rate for _energy, rate in features])
+
+        for energy, crossings in zip(energy_db.tolist(), zcr.tolist()):
+            frame_start = self._classified
+            frame_end = frame_start + self.frame_length
+            self._classified = frame_end
+
+            threshold = max(self.noise_db + self.margin_db, self.min_speech_db)
+            speech = energy > threshold or (crossings > self.zcr_threshold and energy > threshold - self.margin_db / 2)
+            if speech:
+                if not self._in_speech:
+                    # Onset: start the segment a pre-roll earlier, without
+                    # repeating audio already passed on.
+                    self._emitted = max(self._emitted, frame_start - self.pre_roll_frames * self.frame_length)
+                    self._in_speech = True
+                self._silent_frames = 0
+                self.speech_frames += 1
+                self._emit(frame_end)
+                continue
+
+            # Track the noise floor: follow drops at once, rises slowly.
+            self.noise_db = energy if energy < self.noise_db else self.noise_db + 0.05 * (energy - self.noise_db)
+            self._silent_frames += 1
+            if self._in_speech and self._silent_frames > self.hangover_frames:
+                self._emit(self._emitted + self.tail_frames * self.frame_length)
+                self._in_speech = False
+                if self.on_pause:
+                    self.on_pause()
+            if self.speech_frames >= self.min_speech_frames and self._silent_frames >= self.end_frames:
+                self.done = True
+                return
+            if not self._in_speech:
+                # Silence beyond the pre-roll is never needed again.
+                self._emitted = max(self._emitted, self._classified - self.pre_roll_frames * self.frame_length)
+
+    def _emit(self, until):
+        until = min(until, self._written)
+        if until <= self._emitted:
+            return
+        if self.on_audio:
+            capacity = len(self._ring)
+            start = self._emitted % capacity
+            length = until - self._emitted
+            first = min(length, capacity - start)
+            self.on_audio(self._ring[start:start + first])
+            if length > first:
+                self.on_audio(self._ring[:length - first])
+        self._emitted = until
+
+
+def trim_silence(audio, rate=SAMPLE_RATE, **options):
+    # Offline use: the speech in `audio` with leading and trailing silence removed.
+    pieces = []
+    audio = StreamResampler(rate).process(audio)
+    # Never end early: silence in the middle is handled by the hangover.
+    vad = VoiceActivityDetector(on_audio=lambda piece: pieces.append(piece.copy()),
+                                silence_duration=len(audio) / SAMPLE_RATE + 1, **options)
+    vad.process(audio)
+    vad.finish()
+    return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
@@ -0,0 +1,515 @@
+#vector_store.py
+
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+COLLECTION_NAME = "medicine-research"
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "chroma")
+# For the numpy backend: search the first SEARCH_DIMENSIONS dimensions of each
+# vector, then rescore RESCORE_FACTOR * k candidates at full precision (0 = off).
+SEARCH_DIMENSIONS = int(os.getenv("SEARCH_DIMENSIONS", "0"))
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))
+
+# Rows scored per matrix product; bounds temporary memory on big stores.
+SEARCH_BLOCK_ROWS = 65536
+REDUCED_FILE = re.compile(r"vectors\.d(\d+)\.f32")
+
+
+class ChromaStore:
+    # The original backend: a persistent Chroma collection. Scores are
+    # negated distances so that, as with every backend, higher is better.
+
+    def __init__(self, persist_directory, collection_name, embedding_function):
+        # chromadb takes over a second to import; only pay for it when used.
+        import chromadb
+
+        self.embedding_function = embedding_function
+        self.client = chromadb.PersistentClient(path=persist_directory)
+        # Vectors always come from `embedding_function`, as with langchain's
+        # Chroma wrapper, which opens collections the same way.
+        self.collection = self.client.get_or_create_collection(name=collection_name, embedding_function=None)
+        self.max_batch_size = self.client.get_max_batch_size()
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def update_metadata(self, ids, metadatas):
+        self.collection.update(ids=ids, metadatas=metadatas)
+
+    def count(self):
+        return self.collection.count()
+
+    def search(self, query_embeddings, k=5, where=None):
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            [
+                (Document(page_content=document, metadata=metadata or {}), -distance)
+                for document, metadata, distance in zip(documents, metadatas, distances)
+            ]
+            for documents, metadatas, distances in zip(
+                results["documents"], results["metadatas"], results["distances"]
+            )
+        ]
+
+    def iter_documents(self, page_size=1000):
+        offset = 0
+        while True:
+            page = self.collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            yield page["ids"], page["documents"], page["metadatas"]
+            offset += len(page["ids"])
+
+    def iter_rows(self, page_size=1000):
+        # As iter_documents, with each page's embeddings first.
+        offset = 0
+        while True:
+            page = self.collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size,
+                                       offset=offset)
+            if not page["ids"]:
+                return
+            yield page["ids"], page["embeddings"], page["documents"], page["metadatas"]
+            offset += len(page["ids"])
+
+    def optimize(self):
+        pass
+
+    def drop(self):
+        self.client.delete_collection(self.collection.name)
+
+
+class NumpyStore:
+    # In-process brute-force index. Unit-normalised float32 vectors live in
+    # an append-only file that is memory-mapped for search; ids, text and
+    # metadata live in a SQLite sidecar keyed by row position. Upserts append
+    # and tombstone the old row, and optimize() compacts the files. SQLite is
+    # the source of truth: vector bytes past its row count are leftovers of
+    # an upsert that never committed and are cut off by the next one. Every
+    # write bumps a generation counter, so a store open in another process
+    # (the query service while populate_database runs) remaps before searching.
+    #
+    # With quantize=True a per-row scaled int8 copy is searched first and the
+    # best candidates are rescored against the float32 vectors. With
+    # search_dimensions=d the first pass runs on each vector's first d
+    # dimensions, renormalised (the text-embedding-3 models are trained so
+    # that their leading dimensions stand on their own). That copy is built
+    # from the full vectors the first time a search needs it. Upserts, with
+    # any setting, append to every complete copy on disk; optimize() keeps
+    # the current one and removes the others, as it renumbers the rows.
+
+    def __init__(self, persist_directory, collection_name, embedding_function=None, quantize=False,
+                 rescore_factor=4, search_dimensions=None):
+        if quantize and search_dimensions:
+            raise ValueError("Choose either int8 quantization or reduced search dimensions")
+        self.embedding_function = embedding_function
+        self.directory = os.path.join(persist_directory, "numpy", collection_name)
+        self.quantize = quantize
+        self.rescore_factor = rescore_factor
+        self.search_dimensions = search_dimensions
+        self.max_batch_size = 5000
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.directory, "metadata.sqlite3"), check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rows (
+                position INTEGER PRIMARY KEY,
+                id TEXT NOT NULL,
+                document TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                alive INTEGER NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS live_ids ON rows (id) WHERE alive = 1;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._filter_cache = {}
+        self._remap()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        vectors = _unit_rows(np.asarray(embeddings, dtype=np.float32))
+        if len(set(ids)) < len(ids):
+            # Last one wins, as with Chroma; two live rows for an id would break the unique index.
+            keep = sorted({chunk_id: offset for offset, chunk_id in enumerate(ids)}.values())
+            ids, documents, metadatas = ([values[offset] for offset in keep] for values in (ids, documents, metadatas))
+            vectors = vectors[keep]
+        with self._lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('dimensions', ?)", (self.dimensions,))
+            if vectors.shape[1] != self.dimensions:
+                raise ValueError(f"Expected {self.dimensions}-dimensional vectors, got {vectors.shape[1]}")
+
+            start = self._conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+            try:
+                self._tombstone(ids)
+                self._append(start, vectors)
+                self._conn.executemany(
+                    "INSERT INTO rows (position, id, document, metadata, alive) VALUES (?, ?, ?, ?, 1)",
+                    [
+                        (start + offset, chunk_id, document or "", json.dumps(metadata or {}))
+                        for offset, (chunk_id, document, metadata) in enumerate(zip(ids, documents, metadatas))
+                    ],
+                )
+                self._bump_generation()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                self._cut_files(start)
+                self._load_dimensions()
+                raise
+            self._remap()
+
+    def delete(self, ids):
+        with self._lock:
+            self._tombstone(ids)
+            self._bump_generation()
+            self._conn.commit()
+            self._remap()
+
+    def update_metadata(self, ids, metadatas):
+        # In place: the vectors and row positions stay as they are.
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE rows SET metadata = ? WHERE id = ? AND alive = 1",
+                [(json.dumps(metadata or {}), chunk_id) for chunk_id, metadata in zip(ids, metadatas)],
+            )
+            self._bump_generation()
+            self._conn.commit()
+            self._remap()
+
+    def count(self):
+        self._refresh()
+        return int(self._alive.sum())
+
+    def search(self, query_embeddings, k=5, where=None):
+        # Batched: one result list per query vector.
+        queries = _unit_rows(np.asarray(query_embeddings, dtype=np.float32))
+        self._refresh()
+        vectors, codes, scales, reduced, alive = self._vectors, self._codes, self._scales, self._reduced, self._alive
+        if not len(alive) or not alive.any():
+            return [[] for _ in queries]
+
+        if reduced is None and self._reduced_dimensions():
+            reduced = self._build_reduced()
+        mask = alive if where is None else alive & self._filter_mask(where, len(alive))
+        if self.quantize and codes is not None:
+            fetch = min(int(mask.sum()), k * self.rescore_factor)
+            candidates, _ = _blocked_top_k(codes, queries, fetch, mask, scales=scales)
+            positions, scores = _rescore(vectors, queries, candidates, k)
+        elif reduced is not None:
+            fetch = min(int(mask.sum()), k * self.rescore_factor)
+            candidates, _ = _blocked_top_k(reduced, _truncate(queries, reduced.shape[1]), fetch, mask)
+            positions, scores = _rescore(vectors, queries, candidates, k)
+        else:
+            positions, scores = _blocked_top_k(vectors, queries, k, mask)
+        return [self._documents(row_positions, row_scores) for row_positions, row_scores in zip(positions, scores)]
+
+    def iter_documents(self, page_size=1000):
+        last = -1
+        while True:
+            rows = self._conn.execute(
+                "SELECT position, id, document, metadata FROM rows WHERE alive = 1 AND position > ? "
+                "ORDER BY position LIMIT ?",
+                (last, page_size),
+            ).fetchall()
+            if not rows:
+                return
+            yield [row[1] for row in rows], [row[2] for row in rows], [json.loads(row[3]) for row in rows]
+            last = rows[-1][0]
+
+    def iter_rows(self, page_size=1000):
+        self._refresh()
+        last = -1
+        while True:
+            rows = self._conn.execute(
+                "SELECT position, id, document, metadata FROM rows WHERE alive = 1 AND position > ? "
+                "ORDER BY position LIMIT ?",
+                (last, page_size),
+            ).fetchall()
+            if not rows:
+                return
+            vectors = np.asarray(self._vectors[[row[0] for row in rows]], dtype=np.float32)
+            yield [row[1] for row in rows], vectors, [row[2] for row in rows], [json.loads(row[3]) for row in rows]
+            last = rows[-1][0]
+
+    def optimize(self, max_dead_fraction=0.3):
+        # Rewrite the files without tombstoned rows once enough have piled up.
+        with self._lock:
+            dead = self._rows - self.count()
+            if not self._rows or dead / self._rows <= max_dead_fraction:
+                return
+            keep = np.flatnonzero(self._alive)
+            _rewrite(self._path("vectors.f32"), np.asarray(self._vectors[keep]))
+            if self._codes is not None:
+                _rewrite(self._path("vectors.i8"), np.asarray(self._codes[keep]))
+                _rewrite(self._path("scales.f32"), np.asarray(self._scales[keep]))
+            if self._reduced is not None:
+                _rewrite(self._reduced_path(), np.asarray(self._reduced[keep]))
+            # Other copies no longer line up with the renumbered rows.
+            for path, _dimensions in list(self._reduced_files()):
+                if self._reduced is None or path != self._reduced_path():
+                    os.remove(path)
+            self._conn.execute("DELETE FROM rows WHERE alive = 0")
+            self._conn.execute("UPDATE rows SET position = -1 - position")
+            self._conn.executemany(
+                "UPDATE rows SET position = ? WHERE position = ?",
+                [(new, -1 - int(old)) for new, old in enumerate(keep)],
+            )
+            self._bump_generation()
+            self._conn.commit()
+            self._remap()
+
+    def drop(self):
+        # Removes the collection's files; the store is unusable afterwards.
+        with self._lock:
+            self._conn.close()
+            self._vectors = self._codes = self._scales = self._reduced = None
+            shutil.rmtree(self.directory)
+
+    def _load_dimensions(self):
+        dimensions = self._conn.execute("SELECT value FROM meta WHERE key = 'dimensions'").fetchone()
+        self.dimensions = int(dimensions[0]) if dimensions else None
+
+    def _row_files(self, vectors, rows):
+        # (file, bytes per row, rows to append) for every file that holds the
+        # first `rows` rows. A reduced copy that fell behind (its setting was
+        # off for some upserts) is left alone until a search rebuilds it.
+        files = [(self._path("vectors.f32"), self.dimensions * 4, vectors)]
+        if self.quantize:
+            codes, scales = _quantize(vectors)
+            files += [(self._path("vectors.i8"), self.dimensions, codes), (self._path("scales.f32"), 4, scales)]
+        reduced = dict(self._reduced_files())
+        if self._reduced_dimensions() and not rows:
+            reduced[self._reduced_path()] = self._reduced_dimensions()
+        for path, dimensions in reduced.items():
+            if not rows or os.path.getsize(path) >= rows * dimensions * 4:
+                files.append((path, dimensions * 4, _truncate(vectors, dimensions)))
+        return files
+
+    def _append(self, start, vectors):
+        for path, row_bytes, rows in self._row_files(vectors, start):
+            with open(path, "ab") as file:
+                if file.seek(0, os.SEEK_END) > start * row_bytes:
+                    file.truncate(start * row_bytes)
+                file.write(np.ascontiguousarray(rows).tobytes())
+
+    def _cut_files(self, rows):
+        # Undo a failed _append: drop everything past the committed rows.
+        for path, row_bytes, _ in self._row_files(np.zeros((0, self.dimensions or 0), dtype=np.float32), rows):
+            if os.path.exists(path) and os.path.getsize(path) > rows * row_bytes:
+                os.truncate(path, rows * row_bytes)
+
+    def _tombstone(self, ids):
+        self._conn.executemany("UPDATE rows SET alive = 0 WHERE id = ? AND alive = 1", [(i,) for i in ids])
+
+    def _bump_generation(self):
+        self._conn.execute("INSERT INTO meta (key, value) VALUES ('generation', 1) "
+                           "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+    def _generation(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _refresh(self):
+        # Pick up writes committed through another connection since the last remap.
+        if self._generation() != self._mapped_generation:
+            with self._lock:
+                self._remap()
+
+    def _remap(self):
+        # Reopen the memory maps after the files grew or were rewritten.
+        self._mapped_generation = self._generation()
+        self._load_dimensions()
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+        self._vectors = _memmap(self._path("vectors.f32"), np.float32, self._rows, self.dimensions)
+        self._codes = _memmap(self._path("vectors.i8"), np.int8, self._rows, self.dimensions)
+        self._scales = _memmap(self._path("scales.f32"), np.float32, self._rows, None)
+        self._reduced = None
+        dimensions = self._reduced_dimensions()
+        # A copy shorter than the store missed upserts; search rebuilds it.
+        if dimensions and self._rows and os.path.exists(self._reduced_path()) and \
+                os.path.getsize(self._reduced_path()) >= self._rows * dimensions * 4:
+            self._reduced = _memmap(self._reduced_path(), np.float32, self._rows, dimensions)
+        alive = np.zeros(self._rows, dtype=bool)
+        alive[np.fromiter((p for (p,) in self._conn.execute("SELECT position FROM rows WHERE alive = 1")),
+                          dtype=np.int64)] = True
+        self._alive = alive
+        self._filter_cache = {}
+
+    def _build_reduced(self):
+        # Truncates every row of the full vectors into a fresh copy.
+        with self._lock:
+            if self._reduced is None and self._rows:
+                dimensions = self._reduced_dimensions()
+                _rewrite(self._reduced_path(), np.concatenate([
+                    _truncate(np.asarray(self._vectors[start:start + SEARCH_BLOCK_ROWS]), dimensions)
+                    for start in range(0, self._rows, SEARCH_BLOCK_ROWS)
+                ]))
+                self._reduced = _memmap(self._reduced_path(), np.float32, self._rows, dimensions)
+            return self._reduced
+
+    def _reduced_files(self):
+        # (path, dimensions) of the reduced copies on disk, for any setting.
+        for name in os.listdir(self.directory):
+            match = REDUCED_FILE.fullmatch(name)
+            if match:
+                yield self._path(name), int(match[1])
+
+    def _reduced_dimensions(self):
+        # None when off, or when the vectors are not longer than that anyway.
+        if self.search_dimensions and self.dimensions and self.search_dimensions < self.dimensions:
+            return self.search_dimensions
+        return None
+
+    def _reduced_path(self):
+        return self._path(f"vectors.d{self._reduced_dimensions()}.f32")
+
+    def _filter_mask(self, where, rows):
+        # Equality filters on metadata fields, e.g. {"source": "data/x.pdf"}.
+        key = json.dumps(where, sort_keys=True)
+        mask = self._filter_cache.get(key)
+        if mask is None:
+            clauses = " AND ".join("json_extract(metadata, ?) = ?" for _ in where)
+            params = [value for field, expected in where.items() for value in (f"$.{field}", expected)]
+            mask = np.zeros(rows, dtype=bool)
+            positions = [p for (p,) in self._conn.execute(f"SELECT position FROM rows WHERE {clauses}", params)]
+            mask[np.asarray(positions, dtype=np.int64)] = True
+            self._filter_cache[key] = mask
+        return mask
+
+    def _documents(self, positions, scores):
+        if not len(positions):
+            return []
+        wanted = [int(position) for position in positions]
+        placeholders = ",".join("?" * len(wanted))
+        rows = {
+            position: (document, metadata)
+            for position, document, metadata in self._conn.execute(
+                f"SELECT position, document, metadata FROM rows WHERE position IN ({placeholders})", wanted
+            )
+        }
+        return [
+            (Document(page_content=rows[position][0], metadata=json.loads(rows[position][1])), float(score))
+            for position, score in zip(wanted, scores)
+        ]
+
+
+def get_vector_store(backend=None, persist_directory="chroma", collection_name=COLLECTION_NAME,
+                     embedding_function=None):
+    backend = backend or VECTOR_STORE_BACKEND
+    if backend == "chroma":
+        return ChromaStore(persist_directory, collection_name, embedding_function)
+    if backend == "numpy":
+        return NumpyStore(persist_directory, collection_name, embedding_function, rescore_factor=RESCORE_FACTOR,
+                          search_dimensions=SEARCH_DIMENSIONS or None)
+    if backend == "numpy-int8":
+        return NumpyStore(persist_directory, collection_name, embedding_function, quantize=True,
+                          rescore_factor=RESCORE_FACTOR)
+    if backend == "snapshot":
+        # Read-only, served from the file snapshot.py imported into the directory.
+        from snapshot import SNAPSHOT_FILE, SnapshotStore
+        return SnapshotStore(os.path.join(persist_directory, SNAPSHOT_FILE), collection_name, embedding_function)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def _unit_rows(matrix):
+    matrix = np.atleast_2d(matrix)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _truncate(vectors, dimensions):
+    # Matryoshka-style: the leading dimensions, back on the unit sphere.
+    return _unit_rows(np.asarray(vectors, dtype=np.float32)[:, :dimensions]).astype(np.float32)
+
+
+def _quantize(vectors):
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _memmap(path, dtype, rows, dimensions):
+    if not rows or not os.path.exists(path):
+        return None
+    shape = (rows, dimensions) if dimensions else (rows,)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _rewrite(path, array):
+    with open(path + ".tmp", "wb") as file:
+        file.write(np.ascontiguousarray(array).tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def _blocked_top_k(matrix, queries, k, mask, scales=None):
+    # Exact top-k by inner product, scanning `matrix` in row blocks and
+    # keeping a running (queries, k) best list. Returns positions and scores.
+    best_positions = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    k = max(k, 1)
+    for start in range(0, matrix.shape[0], SEARCH_BLOCK_ROWS):
+        block_mask = mask[start:start + SEARCH_BLOCK_ROWS]
+        if not block_mask.any():
+            continue
+        block = np.asarray(matrix[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+        scores = queries @ block.T
+        if scales is not None:
+            scores *= scales[start:start + SEARCH_BLOCK_ROWS]
+        scores[:, ~block_mask] = -np.inf
+
+        positions = np.broadcast_to(np.arange(start, start + block.shape[0]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        positions = np.concatenate([best_positions, positions], axis=1)
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, top, axis=1)
+            positions = np.take_along_axis(positions, top, axis=1)
+        best_scores, best_positions = scores, positions
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_positions = np.take_along_axis(best_positions, order, axis=1)
+    return _drop_masked(best_positions, best_scores)
+
+
+def _rescore(vectors, queries, candidates, k):
+    positions_out, scores_out = [], []
+    for query, positions in zip(queries, candidates):
+        if not len(positions):
+            positions_out.append(positions)
+            scores_out.append(np.zeros(0, dtype=np.float32))
+            continue
+        order = np.argsort(positions)  # sorted reads are friendlier to the page cache
+        positions = positions[order]
+        scores = np.asarray(vectors[positions], dtype=np.float32) @ query
+        top = np.argsort(-scores, kind="stable")[:k]
+        positions_out.append(positions[top])
+        scores_out.append(scores[top])
+    return positions_out, scores_out
+
+
+def _drop_masked(positions, scores):
+    keep = np.isfinite(scores)
+    return [row[valid] for row, valid in zip(positions, keep)], [row[valid] for row, valid in zip(scores, keep)]
@@ -1,49 +1,68 @@
-import sounddevice as sd
-import scipy.io.wavfile as wav
-import whisper
 import numpy as np
-import tempfile
+from transcriber import SAMPLE_RATE, get_transcriber
+from vad import StreamResampler, VoiceActivityDetector
 
-# Function to detect silence
-def is_silence(data, threshold=0.01):
-    return np.abs(data).mean() < threshold
+BLOCK_SECONDS = 0.1  # audio read from the device at a time
+MAX_RECORDING_SECONDS = 300
+NO_SPEECH_SECONDS = 5  # give up if nobody has started talking by then
 
-def record_audio(fs=44100, silence_threshold=0.01, silence_duration=1):
-    silence_count = 0
-    audio_data = []
+def record_audio(fs=44100, silence_duration=1, on_audio=None, on_pause=None,
+                 max_seconds=MAX_RECORDING_SECONDS, stream_factory=None, no_speech_seconds=NO_SPEECH_SECONDS):
+    # Records until `silence_duration` seconds of silence follow speech, or
+    # for `no_speech_seconds` when no speech starts at all.
+    # Returns the speech at 16 kHz with leading and trailing silence trimmed;
+    # with `on_audio`, the speech is handed on as it is detected instead.
+    if stream_factory is None:
+        # sounddevice needs PortAudio; only load it when recording.
+        import sounddevice as sd
+        stream_factory = sd.InputStream
 
-    print("Recording... Press 'Stop' to finish.")
+    utterance = None
+    length = 0
+    if on_audio is None:
+        # Preallocated, so a long dictation never grows a list of chunks
+        utterance = np.zeros(int(max_seconds * SAMPLE_RATE), dtype=np.float32)
 
-    # Open an input stream and listen for silence
-    with sd.InputStream(samplerate=fs, channels=1) as stream:
-        while True:
-            # Record in chunks (buffer size)
-            chunk = stream.read(int(fs * 0.2))  # 200ms chunks
-            audio_chunk = chunk[0]  # Extract audio data
+        def on_audio(audio):
+            nonlocal length
+            count = min(len(audio), len(utterance) - length)
+            utterance[length:length + count] = audio[:count]
+            length += count
 
-            audio_data.append(audio_chunk)
+    resampler = StreamResampler(fs)  # Device rate to Whisper's rate, on the fly
+    vad = VoiceActivityDetector(on_audio=on_audio, on_pause=on_pause, silence_duration=silence_duration)
+    block = int(fs * BLOCK_SECONDS)
 
-            # Check for silence
-            if is_silence(audio_chunk, silence_threshold):
-                silence_count += 0.2
-            else:
-                silence_count = 0  # Reset silence counter when sound is detected
+    print("Recording... Press 'Stop' to finish.")
 
-            # Stop after a certain duration of silence
-            if silence_count > silence_duration:
+    with stream_factory(samplerate=fs, channels=1, dtype="float32") as stream:
+        for blocks in range(1, int(max_seconds / BLOCK_SECONDS) + 1):
+            chunk, _overflowed = stream.read(block)
+            if vad.process(resampler.process(chunk[:, 0])):
                 break
+            if blocks * BLOCK_SECONDS >= no_speech_seconds and vad.speech_frames < vad.min_speech_frames:
+                print("No speech detected.")
+                break
+    vad.finish()
 
-    # Convert the list to a numpy array
-    audio_data = np.concatenate(audio_data)
-
-    # Save the audio data to a temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_wav_file:
-        wav.write(tmp_wav_file.name, fs, audio_data)
-        print(f"Recording saved: {tmp_wav_file.name}")
-        return tmp_wav_file.name  # Return path to temp audio file
+    if utterance is not None:
+        return utterance[:length].copy()
 
 # Function to transcribe audio to text using Whisper
-def speech_to_text_whisper(audio_file):
-    model = whisper.load_model("base")  # Load the whisper model (use a smaller model if needed)
-    result = model.transcribe(audio_file)
-    return result['text']  # Return the transcribed text
\ No newline at end of file
+def speech_to_text_whisper(audio):
+    # Accepts a 16 kHz float array or a WAV path; the model stays loaded between calls
+    return get_transcriber().transcribe(audio)
+
+def warm_up():
+    # Loads PortAudio and the Whisper model (and with it torch) ahead of the
+    # first recording
+    import sounddevice  # noqa: F401
+    get_transcriber().model
+
+def record_and_transcribe(fs=44100, silence_duration=1, transcriber=None, stream_factory=None):
+    # Transcribes each segment while the rest is still being recorded, so the
+    # text is ready shortly after the speaker stops
+    transcription = (transcriber or get_transcriber()).start_stream()
+    record_audio(fs, silence_duration, on_audio=transcription.feed, on_pause=transcription.pause,
+                 stream_factory=stream_factory)
+    return transcription.finish()
@@ -0,0 +1,39 @@
+#warmup.py
+
+import os
+import threading
+import time
+
+# What to load in the background at startup, e.g. "voice" for the app or
+# "engine" for the query service. Empty: everything loads on first use.
+WARMUP = os.getenv("WARMUP", "")
+
+
+def selected(tasks, names=WARMUP):
+    # The {label: callable} tasks named in the comma-separated `names`.
+    wanted = {name.strip() for name in names.split(",")}
+    return {label: task for label, task in tasks.items() if label in wanted}
+
+
+def warm_up(tasks):
+    # Runs `tasks` ({label: callable}) one after another in a daemon thread, so
+    # heavy imports and model loads happen before the first request needs
+    # them without holding up startup. Failures are only reported: the real
+    # use loads again and surfaces the error. Returns the thread, or None when
+    # there is nothing to do.
+    if not tasks:
+        return None
+
+    def run():
+        for label, task in tasks.items():
+            start = time.perf_counter()
+            try:
+                task()
+            except Exception as e:
+                print(f"⚠️ Warm-up of {label} failed ({e.__class__.__name__}: {e})")
+            else:
+                print(f"🔥 Warmed up {label} in {time.perf_counter() - start:.2f}s")
+
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+    thread.start()
+    return thread